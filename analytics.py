@@ -0,0 +1,197 @@
+from create import HealthMetrics, DailyUserSummary, julian_day, EPOCH_JULIAN_DAY
+from partitions import partition_source
+from sharding import scatter
+from sqlalchemy import select, cast, Float
+import numpy as np
+
+# Numeric health metrics that can be analyzed as series.
+NUMERIC_METRICS = ('weight', 'bmi', 'heart_rate', 'systolic', 'diastolic')
+
+# Columnar analytics:
+# Each public function pulls the needed series for one user, a list of users or everyone with a single query into
+# NumPy arrays, sorted by (user_id, x). All statistics are then computed per user with grouped reductions
+# (np.add.reduceat over the user boundaries), so the multi-user mode has no Python loop over users or rows.
+# With sharding enabled the series of each shard are fetched in parallel and merged by user_id.
+
+def _gather_columns(rows, width, user_ids, *args):
+    """
+    Runs rows(session, user_ids, *args) on every shard holding the users (all users for None) and returns the
+    combined result as a (rows, width) float array sorted by user_id and then by the shards' own row order.
+    """
+    parts = scatter(rows, None, *args) if user_ids is None else scatter(rows, *args, user_ids=user_ids)
+    columns = np.array([row for part in parts for row in part], dtype=float).reshape(-1, width)
+    # Each user lives on one shard, so a stable sort on user_id merges the already sorted parts.
+    return columns[np.argsort(columns[:, 0], kind='stable')]
+
+def _user_filter(statement, column, user_ids):
+    if user_ids is None:
+        return statement
+    return statement.where(column.in_(list(user_ids)))
+
+def _group_bounds(groups):
+    """
+    For a sorted group array returns the start offset of each group and, per element, the index of its group.
+    """
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else np.array([], dtype=int)
+    group_index = np.cumsum(np.r_[True, groups[1:] != groups[:-1]]) - 1 if len(groups) else np.array([], dtype=int)
+    return starts, group_index
+
+def _centered_sums(groups, x, y):
+    """
+    Per-group count and centered sums Sxx, Syy, Sxy; centering by the group mean keeps them numerically stable.
+    """
+    starts, group_index = _group_bounds(groups)
+    counts = np.diff(np.r_[starts, len(groups)])
+    dx = x - (np.add.reduceat(x, starts) / counts)[group_index]
+    dy = y - (np.add.reduceat(y, starts) / counts)[group_index]
+    return (starts, counts, np.add.reduceat(dx * dx, starts), np.add.reduceat(dy * dy, starts),
+            np.add.reduceat(dx * dy, starts))
+
+def grouped_pearson(groups, x, y):
+    """
+    Pearson correlation of x and y within each group of the sorted `groups` array.
+    Returns (group_ids, counts, r); r is NaN for groups with fewer than two points or a constant series.
+    """
+    if not len(groups):
+        return groups, np.array([], dtype=int), np.array([])
+    starts, counts, sxx, syy, sxy = _centered_sums(groups, x, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = sxy / np.sqrt(sxx * syy)
+    r[(counts < 2) | ~np.isfinite(r)] = np.nan
+    return groups[starts], counts, r
+
+def grouped_ranks(groups, values):
+    """
+    1-based ranks of `values` within each group, with ties sharing their average rank (as in Spearman's rho).
+    """
+    n = len(values)
+    order = np.lexsort((values, groups))
+    sorted_values, sorted_groups = values[order], groups[order]
+    positions = np.arange(n)
+    new_group = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    new_run = new_group | np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+    run_starts = positions[new_run]
+    run_ends = np.r_[run_starts[1:], n]
+    run_index = np.cumsum(new_run) - 1
+    group_starts = np.maximum.accumulate(np.where(new_group, positions, 0))
+    ranks = np.empty(n)
+    ranks[order] = (run_starts[run_index] + run_ends[run_index] - 1) / 2 - group_starts + 1
+    return ranks
+
+def grouped_spearman(groups, x, y):
+    """
+    Spearman rank correlation of x and y within each group of the sorted `groups` array; returns (group_ids, counts, rho).
+    """
+    if not len(groups):
+        return grouped_pearson(groups, x, y)
+    return grouped_pearson(groups, grouped_ranks(groups, x), grouped_ranks(groups, y))
+
+def grouped_slope(groups, t, y):
+    """
+    Least-squares slope of y over t within each group of the sorted `groups` array; returns (group_ids, counts, slope).
+    """
+    if not len(groups):
+        return groups, np.array([], dtype=int), np.array([])
+    starts, counts, stt, _, sty = _centered_sums(groups, t, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = sty / stt
+    slope[(counts < 2) | ~np.isfinite(slope)] = np.nan
+    return groups[starts], counts, slope
+
+def rolling_mean(values, window, groups=None):
+    """
+    Trailing rolling mean over `window` points, restarting at every group boundary of the sorted `groups` array.
+    The first points of each group average over the points available so far.
+    """
+    values = np.asarray(values, dtype=float)
+    if groups is None:
+        groups = np.zeros(len(values))
+    positions = np.arange(len(values))
+    starts, group_index = _group_bounds(np.asarray(groups))
+    cumulative = np.r_[0.0, np.cumsum(values)]
+    low = np.maximum(positions - window + 1, starts[group_index] if len(values) else positions)
+    return (cumulative[positions + 1] - cumulative[low]) / (positions + 1 - low)
+
+def _protein_duration_rows(session, user_ids):
+    statement = select(
+        DailyUserSummary.user_id,
+        julian_day(DailyUserSummary.date),
+        DailyUserSummary.protein / DailyUserSummary.meal_count,
+        cast(DailyUserSummary.workout_minutes, Float) / DailyUserSummary.workout_count
+    ).where(
+        DailyUserSummary.meal_count > 0,
+        DailyUserSummary.workout_count > 0
+    ).order_by(DailyUserSummary.user_id, DailyUserSummary.date)
+    return [tuple(row) for row in session.execute(_user_filter(statement, DailyUserSummary.user_id, user_ids))]
+
+def _protein_duration_series(user_ids=None):
+    """
+    (user_id, julian day, average protein, average workout duration) for every day with both meals and workouts.
+    """
+    return _gather_columns(_protein_duration_rows, 4, user_ids)
+
+def _metric_rows(session, user_ids, metric):
+    # The whole history is analyzed, so archived measurements are included.
+    source = partition_source(session, HealthMetrics)
+    column = getattr(source, metric)
+    statement = select(
+        source.user_id,
+        julian_day(source.date),
+        column
+    ).where(column.isnot(None)).order_by(source.user_id, source.date, source.metric_id)
+    return [tuple(row) for row in session.execute(_user_filter(statement, source.user_id, user_ids))]
+
+def _metric_series(metric, user_ids=None):
+    """
+    (user_id, julian day, value) for one numeric health metric, skipping missing values.
+    """
+    if metric not in NUMERIC_METRICS:
+        raise ValueError(f"Unknown numeric health metric {metric!r}; expected one of {', '.join(NUMERIC_METRICS)}")
+    return _gather_columns(_metric_rows, 3, user_ids, metric)
+
+def nutrition_workout_correlations(user_ids=None):
+    """
+    Pearson and Spearman correlation between daily average protein intake and daily average workout duration,
+    for every user (or the given user ids) at once. Returns columnar arrays keyed 'user_id', 'days', 'pearson'
+    and 'spearman'; users without at least two days of both nutrition and workouts get NaN.
+    """
+    series = _protein_duration_series(user_ids)
+    groups, protein, duration = series[:, 0], series[:, 2], series[:, 3]
+    user_id, days, pearson = grouped_pearson(groups, protein, duration)
+    _, _, spearman = grouped_spearman(groups, protein, duration)
+    return {'user_id': user_id.astype(int), 'days': days, 'pearson': pearson, 'spearman': spearman}
+
+def correlate_protein_and_duration(user_id):
+    """
+    Single-user form of nutrition_workout_correlations: returns {'days', 'pearson', 'spearman'} as Python numbers.
+    """
+    result = nutrition_workout_correlations([user_id])
+    if not len(result['user_id']):
+        return {'days': 0, 'pearson': float('nan'), 'spearman': float('nan')}
+    return {'days': int(result['days'][0]), 'pearson': float(result['pearson'][0]),
+            'spearman': float(result['spearman'][0])}
+
+def health_metric_trends(metric='weight', user_ids=None):
+    """
+    Least-squares trend of a numeric health metric for every user (or the given user ids) at once.
+    Returns columnar arrays keyed 'user_id', 'points', 'slope_per_day' (NaN with fewer than two points or a
+    single date) and 'latest' (the most recent value).
+    """
+    series = _metric_series(metric, user_ids)
+    groups, days, values = series[:, 0], series[:, 1], series[:, 2]
+    user_id, points, slope = grouped_slope(groups, days, values)
+    latest = values[np.r_[np.flatnonzero(groups[1:] != groups[:-1]), len(groups) - 1]] if len(groups) else values
+    return {'user_id': user_id.astype(int), 'points': points, 'slope_per_day': slope, 'latest': latest}
+
+def health_metric_trend(user_id, metric='weight', window=7):
+    """
+    One user's series for a numeric health metric with its rolling mean over `window` measurements and its
+    least-squares slope per day. Returns {'dates', 'values', 'rolling_mean', 'slope_per_day'}.
+    """
+    series = _metric_series(metric, [user_id])
+    days, values = series[:, 1], series[:, 2]
+    _, _, slope = grouped_slope(series[:, 0], days, values)
+    # julian_day() counts from the same epoch as DayNumber and datetime64.
+    dates = (days - EPOCH_JULIAN_DAY).astype('int64').astype('datetime64[D]')
+    return {'dates': dates, 'values': values, 'rolling_mean': rolling_mean(values, window),
+            'slope_per_day': float(slope[0]) if len(slope) else float('nan')}
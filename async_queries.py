@@ -0,0 +1,164 @@
+from create import Session, HealthMetrics, UserRecommendation, configure_sqlite_connection, shards
+from query_data import (HEALTH_METRICS, daily_calorie_totals_statement, sleep_quality_totals_statement,
+                        logged_qualities, metric_history_statement)
+from recommendations import (recent_workouts_statement, average_calories_statement, stored_recommendation_statement,
+                             fitness_advice, nutrition_advice)
+from cache import result_cache
+from partitions import partition_source
+from snapshot import file_bind
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from contextlib import asynccontextmanager
+import asyncio
+import weakref
+
+# Asyncio variants of the dashboard queries and recommendations:
+# They run the same statements as query_data.py and recommendations.py on an aiosqlite engine, return the same
+# values (without printing) and share the result cache, so an async server can await them instead of wrapping the
+# blocking functions in threads.
+
+# Pooled aiosqlite connections belong to the event loop that opened them, so engines are kept per loop and URL.
+_engines = weakref.WeakKeyDictionary()
+
+def create_async_app_engine(url='sqlite+aiosqlite:///health_fitness_app.db', pool_size=5, max_overflow=10, busy_timeout=30):
+    """
+    Async counterpart of create_app_engine: a pooled aiosqlite engine with the same WAL, busy timeout and sync settings.
+    """
+    async_engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size,
+                                       max_overflow=max_overflow)
+
+    @event.listens_for(async_engine.sync_engine, 'connect')
+    def configure_connection(dbapi_connection, connection_record):
+        configure_sqlite_connection(dbapi_connection, busy_timeout)
+
+    return async_engine
+
+def get_async_engine(user_id=None):
+    """
+    Async engine for the database file the shared Session is bound to (or, with sharding enabled, the shard of
+    `user_id`), created once per running event loop with the same pool size. Following Session's bind means tools
+    that redirect Session (load tests, benchmarks) redirect the async API too; while a snapshot is active it reads
+    the snapshot's source file. Raises ValueError when Session is bound to an in-memory database.
+    """
+    bind = shards.engine_for(user_id) if user_id is not None and shards.sharded else file_bind(Session.kw['bind'])
+    if not bind.url.database or bind.url.database == ':memory:':
+        raise ValueError("The async API reads database files, not in-memory databases")
+    url = str(bind.url.set(drivername='sqlite+aiosqlite'))
+    engines = _engines.setdefault(asyncio.get_running_loop(), {})
+    if url not in engines:
+        engines[url] = create_async_app_engine(url, pool_size=bind.pool.size())
+    return engines[url]
+
+async def dispose_async_engines():
+    """
+    Closes the pooled connections of every async engine created on the running event loop; call before the loop ends.
+    """
+    for async_engine in _engines.pop(asyncio.get_running_loop(), {}).values():
+        await async_engine.dispose()
+
+@asynccontextmanager
+async def async_session_scope(user_id=None):
+    """
+    Async counterpart of session_scope: commits on success, rolls back on error and always closes the session.
+    Each call gets its own session and connection, so concurrent tasks never share one.
+    """
+    session = AsyncSession(get_async_engine(user_id))
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+@result_cache.cached
+async def _daily_calorie_totals(user_id, days):
+    async with async_session_scope(user_id) as session:
+        return tuple(await session.execute(daily_calorie_totals_statement(user_id, days)))
+
+async def get_average_daily_calories(user_id, days=7):
+    """
+    Average daily calorie intake over the last `days` days, or 0 without nutrition logs.
+    """
+    calories = await _daily_calorie_totals(user_id, days)
+    if not calories:
+        return 0
+    return sum(cal.total_calories for cal in calories) / len(calories)
+
+@result_cache.cached
+async def _sleep_quality_counts(user_id, days):
+    async with async_session_scope(user_id) as session:
+        totals = (await session.execute(sleep_quality_totals_statement(user_id, days))).one()
+    return logged_qualities(totals)
+
+async def analyze_sleep_quality(user_id, days=30):
+    """
+    Nights per sleep quality over the last `days` days, e.g. {'Good': 12, 'Poor': 3}; empty without sleep records.
+    """
+    return dict(await _sleep_quality_counts(user_id, days))
+
+@result_cache.cached
+async def _metric_history(user_id, metric):
+    async with async_session_scope(user_id) as session:
+        source = await session.run_sync(partition_source, HealthMetrics)
+        return tuple(await session.execute(metric_history_statement(user_id, metric, source)))
+
+async def analyze_health_metric_trends(user_id, metric='weight'):
+    """
+    (date, value) rows of one health metric in date order.
+    """
+    if metric not in HEALTH_METRICS:
+        raise ValueError(f"Unknown health metric {metric!r}; expected one of {', '.join(HEALTH_METRICS)}")
+    return list(await _metric_history(user_id, metric))
+
+@result_cache.cached
+async def get_fitness_recommendations(user_id):
+    """
+    Fitness recommendation from the last 30 days of workouts.
+    """
+    async with async_session_scope(user_id) as session:
+        stored = (await session.execute(stored_recommendation_statement(user_id, UserRecommendation.fitness))).scalar()
+        if stored is not None:
+            return stored
+        recent_workouts = (await session.execute(recent_workouts_statement(user_id))).one()
+    return fitness_advice(recent_workouts.workout_count or 0, recent_workouts.workout_days,
+                          recent_workouts.high_intensity_count or 0)
+
+@result_cache.cached
+async def get_nutrition_recommendations(user_id):
+    """
+    Nutrition recommendation from the last 7 days of calorie intake.
+    """
+    async with async_session_scope(user_id) as session:
+        stored = (await session.execute(stored_recommendation_statement(user_id, UserRecommendation.nutrition))).scalar()
+        if stored is not None:
+            return stored
+        average_calories = (await session.execute(average_calories_statement(user_id))).scalar()
+    return nutrition_advice(average_calories)
+
+async def get_dashboard(user_id, calorie_days=7, sleep_days=30, metric='weight'):
+    """
+    Runs every dashboard query concurrently, each on its own pooled connection, and returns
+    {'average_daily_calories', 'sleep_quality', 'metric_trend', 'fitness_recommendation', 'nutrition_recommendation'}.
+    """
+    results = await asyncio.gather(
+        get_average_daily_calories(user_id, calorie_days),
+        analyze_sleep_quality(user_id, sleep_days),
+        analyze_health_metric_trends(user_id, metric),
+        get_fitness_recommendations(user_id),
+        get_nutrition_recommendations(user_id),
+    )
+    keys = ('average_daily_calories', 'sleep_quality', 'metric_trend', 'fitness_recommendation', 'nutrition_recommendation')
+    return dict(zip(keys, results))
+
+if __name__ == '__main__':
+    async def main(user_id=1):
+        try:
+            for key, value in (await get_dashboard(user_id)).items():
+                print(f"{key}: {value}")
+        finally:
+            await dispose_async_engines()
+
+    asyncio.run(main())
@@ -0,0 +1,365 @@
+from create import Base, Session, STORAGE, EPOCH, create_app_engine
+from insert_data import bulk_load
+from cache import result_cache
+import query_data
+import recommendations
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+import argparse
+import importlib
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+# Public functions under benchmark: (name, call taking a user id, whether it scans the whole population).
+# Population-wide calls are sampled only a few times since one call already touches every user.
+BENCHMARKS = [
+    ('get_user_workout_history', lambda user_id: query_data.get_user_workout_history(user_id, 30), False),
+    ('get_average_daily_calories', lambda user_id: query_data.get_average_daily_calories(user_id, 7), False),
+    ('analyze_sleep_quality', lambda user_id: query_data.analyze_sleep_quality(user_id, 30), False),
+    ('correlate_nutrition_and_workout', query_data.correlate_nutrition_and_workout, False),
+    ('analyze_health_metric_trends', lambda user_id: query_data.analyze_health_metric_trends(user_id, 'weight'), False),
+    ('get_workout_history_page', lambda user_id: query_data.get_workout_history_page(user_id), False),
+    ('iter_workout_history', lambda user_id: sum(1 for _ in query_data.iter_workout_history(user_id)), False),
+    ('get_health_metric_page', lambda user_id: query_data.get_health_metric_page(user_id), False),
+    ('get_user_dashboard', query_data.get_user_dashboard, False),
+    ('get_health_metric_trend', lambda user_id: query_data.get_health_metric_trend(user_id, 'weight'), False),
+    ('get_health_metric_alerts', lambda user_id: query_data.get_health_metric_alerts(user_id, 30), False),
+    ('get_fitness_recommendations', recommendations.get_fitness_recommendations, False),
+    ('get_nutrition_recommendations', recommendations.get_nutrition_recommendations, False),
+    ('get_batch_recommendations', lambda user_id: recommendations.get_batch_recommendations(), True),
+    ('find_health_alerts', lambda user_id: query_data.find_health_alerts(1), True),
+]
+
+# Samples taken for population-wide functions, whatever --samples says.
+POPULATION_SAMPLES = 3
+
+# Full scans compared between the storage layouts; '?' is a date 90 days back, bound as each layout stores it.
+STORAGE_SCANS = [
+    ('workouts_by_intensity', "SELECT intensity, COUNT(*), SUM(duration) FROM Workouts NOT INDEXED GROUP BY intensity"),
+    ('recent_nutrition', "SELECT type, COUNT(*), SUM(calories) FROM Nutrition NOT INDEXED WHERE date >= ? GROUP BY type"),
+    ('sleep_quality_index', "SELECT quality, COUNT(*) FROM Sleep INDEXED BY ix_sleep_user_date GROUP BY quality"),
+]
+
+# Tables and indexes holding the logs, i.e. the working set whose size the compact layout reduces.
+LOG_OBJECTS = ('Workouts', 'Nutrition', 'Sleep', 'Health_Metrics', 'Daily_User_Summary', 'ix_workouts_user_date',
+               'ix_nutrition_user_date', 'ix_sleep_user_date', 'ix_health_metrics_user_date', 'ix_health_metrics_date_bp')
+
+# Rows per user of each log table, as bulk_load's keyword arguments.
+DEFAULT_PER_USER = {'workouts': 50, 'nutrition_logs': 150, 'sleep_records': 100, 'health_metrics': 50}
+
+# Datasets are generated as of this date and benchmarked with the clock pinned to it, so a cached dataset keeps the
+# same rows inside the 7- and 30-day query windows and reruns are reproducible.
+REFERENCE_DATE = date(2024, 6, 30)
+
+# Modules whose date.today() and datetime.now() follow the pinned clock.
+CLOCK_MODULES = ('insert_data', 'migrate', 'partitions', 'cache', 'recommendations', 'query_data')
+
+class _PinnedClass(type):
+    # Plain dates and datetimes still pass isinstance checks against the pinned classes.
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, cls.__bases__[0])
+
+@contextmanager
+def pinned_clock(today=REFERENCE_DATE):
+    """
+    Makes date.today() return `today` and datetime.now() noon of `today` in CLOCK_MODULES for the duration of the block.
+    """
+    class PinnedDate(date, metaclass=_PinnedClass):
+        @classmethod
+        def today(cls):
+            return today
+
+    class PinnedDateTime(datetime, metaclass=_PinnedClass):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.combine(today, datetime.min.time(), tz) + timedelta(hours=12)
+
+    patched = []
+    for name in CLOCK_MODULES:
+        module = importlib.import_module(name)
+        for real, pinned in ((date, PinnedDate), (datetime, PinnedDateTime)):
+            if getattr(module, real.__name__, None) is real:
+                setattr(module, real.__name__, pinned)
+                patched.append((module, real))
+    try:
+        yield
+    finally:
+        for module, real in patched:
+            setattr(module, real.__name__, real)
+
+def dataset_path(data_dir, users, seed, per_user, storage=STORAGE):
+    """
+    Cache file of a benchmark dataset; the name covers every input of the build, so changing one builds a new file.
+    """
+    per_user = {**DEFAULT_PER_USER, **per_user}
+    rows = f"w{per_user['workouts']}n{per_user['nutrition_logs']}s{per_user['sleep_records']}m{per_user['health_metrics']}"
+    suffix = '' if storage == 'standard' else f"_{storage}"
+    return os.path.join(data_dir, f"bench_{users}u_seed{seed}_{rows}_{REFERENCE_DATE:%Y%m%d}{suffix}.db")
+
+def build_dataset(data_dir, users, seed, per_user):
+    """
+    Creates (once) a deterministic database with `users` users seeded by `seed`, dated up to REFERENCE_DATE, and
+    returns its path. Datasets are written under a temporary name and renamed when complete, so an interrupted build
+    is not reused.
+    """
+    path = dataset_path(data_dir, users, seed, per_user)
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    build_engine = create_app_engine(f"sqlite:///{partial}")
+    try:
+        Base.metadata.create_all(build_engine)
+        with pinned_clock():
+            bulk_load(users, seed=seed, bind=build_engine, defer_summaries=True, **{**DEFAULT_PER_USER, **per_user})
+        with build_engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        build_engine.dispose()
+    os.replace(partial, path)
+    return path
+
+def converted_dataset(data_dir, users, seed, per_user, storage):
+    """
+    Path of the benchmark dataset in `storage` layout, converted (once) from this process's layout by running
+    migrate.py in a child process configured for that layout.
+    """
+    source = build_dataset(data_dir, users, seed, per_user)
+    path = dataset_path(data_dir, users, seed, per_user, storage)
+    if storage == STORAGE or os.path.exists(path):
+        return path
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    migrate_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrate.py')
+    subprocess.run([sys.executable, migrate_script, '--convert', source, partial], check=True, stdout=subprocess.DEVNULL,
+                   env={**os.environ, 'HEALTH_FITNESS_STORAGE': storage})
+    os.replace(partial, path)
+    return path
+
+def storage_profile(path, storage, cache_mib, repeats):
+    """
+    File size, log-table size, page-cache coverage and full-scan latency of one dataset. SQLite's Python binding
+    exposes no page-cache counters, so the cache hit ratio is the share of the log tables and indexes a cache of
+    `cache_mib` MiB can hold, which is the steady-state hit ratio of uniformly spread reads.
+    """
+    cutoff = REFERENCE_DATE - timedelta(days=90)
+    cutoff = (cutoff - EPOCH).days if storage == 'compact' else cutoff.isoformat()
+    connection = sqlite3.connect(path)
+    try:
+        page_size, = connection.execute("PRAGMA page_size").fetchone()
+        pages, = connection.execute("PRAGMA page_count").fetchone()
+        free_pages, = connection.execute("PRAGMA freelist_count").fetchone()
+        log_bytes, = connection.execute(
+            f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({', '.join('?' * len(LOG_OBJECTS))})", LOG_OBJECTS).fetchone()
+    finally:
+        connection.close()
+    scans = {}
+    for name, statement in STORAGE_SCANS:
+        timings = []
+        for _ in range(repeats):
+            # A fresh connection starts with an empty page cache of the configured size.
+            connection = sqlite3.connect(path)
+            connection.execute(f"PRAGMA cache_size=-{int(cache_mib * 1024)}")
+            started = time.perf_counter()
+            connection.execute(statement, (cutoff,) if '?' in statement else ()).fetchall()
+            timings.append(time.perf_counter() - started)
+            connection.close()
+        scans[name] = round(float(np.median(timings)) * 1000, 3)
+    return {'file_bytes': (pages - free_pages) * page_size, 'log_bytes': log_bytes,
+            'cache_hit_ratio': round(min(1.0, cache_mib * 2 ** 20 / log_bytes), 4), 'scan_ms': scans}
+
+def compare_storage(users, seed=42, data_dir='bench_data', per_user=None, cache_mib=8, repeats=5):
+    """
+    Builds the dataset in both storage layouts and profiles each. Returns {'users', 'cache_mib', 'standard',
+    'compact'} plus 'ratios' (compact / standard) for the file size, the cache hit ratio and each scan.
+    """
+    per_user = per_user or {}
+    report = {'users': users, 'cache_mib': cache_mib}
+    for storage in ('standard', 'compact'):
+        report[storage] = storage_profile(converted_dataset(data_dir, users, seed, per_user, storage),
+                                          storage, cache_mib, repeats)
+    standard, compact = report['standard'], report['compact']
+    report['ratios'] = {
+        'file_bytes': round(compact['file_bytes'] / standard['file_bytes'], 3),
+        'cache_hit_ratio': round(compact['cache_hit_ratio'] / standard['cache_hit_ratio'], 3),
+        **{name: round(compact['scan_ms'][name] / standard['scan_ms'][name], 3) for name in standard['scan_ms']},
+    }
+    return report
+
+def print_storage_report(report):
+    print(f"{report['users']} users, {report['cache_mib']} MiB page cache")
+    print(f"{'layout':<9} {'file MiB':>9} {'logs MiB':>9} {'cache hit':>9} " + " ".join(f"{name + ' ms':>24}" for name, _ in STORAGE_SCANS))
+    for storage in ('standard', 'compact'):
+        profile = report[storage]
+        print(f"{storage:<9} {profile['file_bytes'] / 2 ** 20:>9.2f} {profile['log_bytes'] / 2 ** 20:>9.2f} "
+              f"{profile['cache_hit_ratio']:>9.1%} " + " ".join(f"{profile['scan_ms'][name]:>24.3f}" for name, _ in STORAGE_SCANS))
+
+def percentiles(samples):
+    p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+    return {'p50_ms': round(float(p50), 4), 'p95_ms': round(float(p95), 4), 'p99_ms': round(float(p99), 4),
+            'samples': len(samples)}
+
+def time_call(function, user_id):
+    started = time.perf_counter()
+    function(user_id)
+    return time.perf_counter() - started
+
+def peak_memory_kib(function, user_id):
+    """
+    Peak Python heap allocated during one call, measured separately so tracing does not distort the latencies.
+    """
+    tracemalloc.start()
+    try:
+        function(user_id)
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+def benchmark_scale(bench_engine, users, samples, seed):
+    """
+    Times every benchmarked function against one dataset. A cold call runs with an empty result cache and a fresh
+    connection pool (so SQLite's page cache is empty too); the warm call repeats it immediately afterwards.
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, users + 1, size=samples).tolist()
+    results = []
+    for name, function, population in BENCHMARKS:
+        sampled = user_ids[:POPULATION_SAMPLES] if population else user_ids
+        cold, warm = [], []
+        for user_id in sampled:
+            result_cache.clear()
+            bench_engine.dispose()
+            cold.append(time_call(function, user_id))
+            warm.append(time_call(function, user_id))
+        result_cache.clear()
+        memory = peak_memory_kib(function, sampled[0])
+        for phase, timings in (('cold', cold), ('warm', warm)):
+            results.append({'scale': users, 'function': name, 'phase': phase, **percentiles(timings), 'peak_kib': memory})
+    return results
+
+def run_benchmarks(scales, samples=50, seed=42, data_dir='bench_data', per_user=None):
+    """
+    Builds (or reuses) one seeded dataset per scale, points the shared Session at it and benchmarks every function.
+    Returns a JSON-serializable report.
+    """
+    per_user = per_user or {}
+    original_bind = Session.kw['bind']
+    results = []
+    try:
+        for users in scales:
+            bench_engine = create_app_engine(f"sqlite:///{build_dataset(data_dir, users, seed, per_user)}")
+            Session.configure(bind=bench_engine)
+            try:
+                # The query functions print their results; keep the report readable.
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), pinned_clock():
+                    results.extend(benchmark_scale(bench_engine, users, samples, seed))
+            finally:
+                bench_engine.dispose()
+    finally:
+        Session.configure(bind=original_bind)
+        result_cache.clear()
+    return {
+        'meta': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'seed': seed,
+                 'samples': samples, 'per_user': {**DEFAULT_PER_USER, **per_user},
+                 'reference_date': REFERENCE_DATE.isoformat()},
+        'results': results,
+    }
+
+def compare(report, baseline, tolerance=0.5, min_delta_ms=0.5):
+    """
+    Lists results whose p50 or p95 latency grew by more than `tolerance` (a fraction) over the baseline report.
+    Differences under `min_delta_ms` are ignored as timer noise.
+    """
+    previous = {(r['scale'], r['function'], r['phase']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        before = previous.get((result['scale'], result['function'], result['phase']))
+        if before is None:
+            continue
+        for key in ('p50_ms', 'p95_ms'):
+            if result[key] > before[key] * (1 + tolerance) and result[key] - before[key] > min_delta_ms:
+                regressions.append(f"{result['function']} ({result['phase']}, {result['scale']} users): "
+                                   f"{key} {before[key]:.3f} -> {result[key]:.3f} ms")
+    return regressions
+
+def print_report(report):
+    print(f"{'users':>8} {'function':<32} {'phase':<5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KiB':>9}")
+    for r in report['results']:
+        print(f"{r['scale']:>8} {r['function']:<32} {r['phase']:<5} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} "
+              f"{r['p99_ms']:>9.3f} {r['peak_kib']:>9.1f}")
+
+# Median start-up time `cli.py --help` must stay under, so cron jobs and shell pipelines start instantly.
+STARTUP_TARGET_MS = 100
+
+def measure_startup(command=None, runs=20):
+    """
+    Wall-clock latency percentiles of running `command` (default: `python cli.py --help`) in a fresh interpreter.
+    """
+    command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py'), '--help']
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return percentiles(timings)
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Benchmark the query and recommendation functions at several dataset scales.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 10000], help="user counts to benchmark (e.g. 10 10000 1000000)")
+    parser.add_argument('--samples', type=int, default=50, help="calls per function and phase")
+    parser.add_argument('--seed', type=int, default=42, help="seed for the datasets and the sampled users")
+    parser.add_argument('--data-dir', default='bench_data', help="where seeded datasets are cached between runs")
+    parser.add_argument('--workouts', type=int, default=DEFAULT_PER_USER['workouts'], help="workouts per user")
+    parser.add_argument('--nutrition', type=int, default=DEFAULT_PER_USER['nutrition_logs'], help="nutrition logs per user")
+    parser.add_argument('--sleep', type=int, default=DEFAULT_PER_USER['sleep_records'], help="sleep records per user")
+    parser.add_argument('--metrics', type=int, default=DEFAULT_PER_USER['health_metrics'], help="health metric records per user")
+    parser.add_argument('--output', default='bench_results.json', help="machine-readable results file")
+    parser.add_argument('--baseline', help="results file from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed latency growth over the baseline, as a fraction")
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help="ignore latency differences smaller than this")
+    parser.add_argument('--storage', action='store_true', help="compare file size, cache hit ratio and scan speed "
+                                                                "of the standard and compact storage layouts instead")
+    parser.add_argument('--cache-mib', type=float, default=8, help="page cache size for the storage comparison")
+    parser.add_argument('--startup', action='store_true', help="measure the start-up time of `cli.py --help` instead")
+    parser.add_argument('--startup-target-ms', type=float, default=STARTUP_TARGET_MS,
+                        help="fail when the median start-up time exceeds this")
+    args = parser.parse_args(argv)
+
+    per_user = {'workouts': args.workouts, 'nutrition_logs': args.nutrition,
+                'sleep_records': args.sleep, 'health_metrics': args.metrics}
+    if args.startup:
+        timings = measure_startup(runs=args.samples)
+        print(f"cli.py --help: p50 {timings['p50_ms']:.1f} ms, p95 {timings['p95_ms']:.1f} ms "
+              f"(target {args.startup_target_ms:.0f} ms)")
+        sys.exit(1 if timings['p50_ms'] > args.startup_target_ms else 0)
+    elif args.storage:
+        reports = [compare_storage(users, args.seed, args.data_dir, per_user, args.cache_mib) for users in args.scales]
+        with open(args.output, 'w') as output:
+            json.dump({'storage': reports}, output, indent=2)
+        for report in reports:
+            print_storage_report(report)
+    else:
+        report = run_benchmarks(args.scales, args.samples, args.seed, args.data_dir, per_user)
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print_report(report)
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                regressions = compare(report, json.load(baseline_file), args.tolerance, args.min_delta_ms)
+            for regression in regressions:
+                print(f"REGRESSION: {regression}")
+            sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+from create import Workout, Nutrition, Sleep, HealthMetrics
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession
+from collections import OrderedDict
+from datetime import date
+from functools import wraps
+import inspect as pyinspect
+import threading
+import time
+
+# The cache lives in one process and is invalidated by the flush/commit events of that process's sessions (and by
+# result_cache.clear() after Core writes). Writes made by another process -- a second app worker, importer.py,
+# migrate.py, partitions.py or a pool process -- are not seen, so the entries of the users it wrote can be served
+# stale until they expire after `ttl` seconds (300 by default). Deployments with several writer processes should
+# lower the TTL or set maxsize to 0.
+
+# Models whose rows feed the cached analytics; flushing one of them invalidates its user's entries.
+TRACKED_MODELS = (Workout, Nutrition, Sleep, HealthMetrics)
+
+class QueryCache:
+    """
+    Bounded LRU cache for per-user query results with a TTL and hit/miss counters.
+    Entries are keyed on the function, its arguments and the current date (date-windowed results change at midnight),
+    and indexed by user_id so a write for one user drops exactly that user's entries. Only writes made in this
+    process invalidate entries; see the note above.
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, user_id, value)
+        self._keys_by_user = {}
+        # Bumped on every invalidation (per user) and clear (globally), so results computed across a write are not stored.
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """
+        Returns (True, value) for a live entry, (False, None) otherwise.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return False, None
+
+    def set(self, key, user_id, value, generation=None):
+        """
+        Stores `value` for `user_id`, unless the user was invalidated after `generation` was read.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation(user_id):
+                return
+            self._discard(key)
+            self._entries[key] = (time.monotonic() + self.ttl, user_id, value)
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._epoch, self._generations.get(user_id, 0)
+
+    def invalidate_user(self, user_id):
+        """
+        Drops every entry computed for `user_id`.
+        """
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._discard(key)
+                self.invalidations += 1
+
+    def clear(self):
+        """
+        Drops every entry; used after writes that bypass the ORM (bulk Core inserts, bulk query updates).
+        """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._epoch += 1
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._keys_by_user.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_user[entry[1]]
+
+    def cached(self, function):
+        """
+        Decorator caching a function (or coroutine function) whose arguments include `user_id`. Defaults are bound
+        before building the key, so f(1) and f(1, 30) share an entry. Cached values are shared between callers and
+        must not be mutated.
+        """
+        signature = pyinspect.signature(function)
+
+        def lookup(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (function.__module__, function.__qualname__, tuple(bound.arguments.items()), date.today())
+            return (key, bound.arguments['user_id']) + self.get(key)
+
+        if pyinspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                key, user_id, found, value = lookup(args, kwargs)
+                if found:
+                    return value
+                generation = self.generation(user_id)
+                value = await function(*args, **kwargs)
+                self.set(key, user_id, value, generation)
+                return value
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                key, user_id, found, value = lookup(args, kwargs)
+                if found:
+                    return value
+                generation = self.generation(user_id)
+                value = function(*args, **kwargs)
+                self.set(key, user_id, value, generation)
+                return value
+
+        wrapper.cache = self
+        return wrapper
+
+# Shared cache for the analytics in query_data.py and recommendations.py.
+result_cache = QueryCache()
+
+def _touched_user_ids(session):
+    """
+    User ids of tracked rows that are new, changed or deleted in `session`, including the previous owner of a row
+    whose user_id changed.
+    """
+    user_ids = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, TRACKED_MODELS):
+            history = inspect(instance).attrs.user_id.history
+            user_ids.update(history.added or ())
+            user_ids.update(history.deleted or ())
+            user_ids.update(history.unchanged or ())
+    user_ids.discard(None)
+    return user_ids
+
+@event.listens_for(OrmSession, 'after_flush')
+def _invalidate_flushed_users(session, flush_context):
+    # After a flush the pending lists and attribute history still describe what was written, with foreign keys
+    # populated. Invalidate right away and again on commit, since a reader may cache the pre-commit state in between.
+    user_ids = _touched_user_ids(session)
+    session.info.setdefault('touched_user_ids', set()).update(user_ids)
+    for user_id in user_ids:
+        result_cache.invalidate_user(user_id)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_committed_users(session):
+    for user_id in session.info.pop('touched_user_ids', ()):
+        result_cache.invalidate_user(user_id)
+
+@event.listens_for(OrmSession, 'after_soft_rollback')
+def _forget_rolled_back_users(session, previous_transaction):
+    session.info.pop('touched_user_ids', None)
+
+@event.listens_for(OrmSession, 'after_bulk_update')
+@event.listens_for(OrmSession, 'after_bulk_delete')
+def _invalidate_bulk_writes(update_context):
+    # Query.update()/delete() do not report which users they touched.
+    if update_context.mapper.class_ in TRACKED_MODELS:
+        result_cache.clear()
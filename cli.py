@@ -0,0 +1,83 @@
+import argparse
+
+# Single entry point for the app's commands:
+# `python3 cli.py init|seed|query|recommend|benchmark`. Only argparse is imported up front; every command imports
+# the modules it needs when it runs, so `--help` and usage errors return without loading SQLAlchemy, NumPy or Faker,
+# and no engine or session exists before a command touches the database. benchmark.py --startup checks the
+# start-up time against its target.
+
+# Commands whose options belong to the module they run; everything after the command name is passed on to it.
+FORWARDED_COMMANDS = ('seed', 'benchmark')
+
+def _init(args, rest):
+    from create import create_tables
+    create_tables()
+    if args.migrate:
+        from create import engine, shards
+        from migrate import migrate
+        for shard_engine in shards.engines or [engine]:
+            migrate(shard_engine)
+
+def _seed(args, rest):
+    from insert_data import main
+    main(rest, prog='cli.py seed')
+
+def _query(args, rest):
+    if args.dashboard:
+        from query_data import get_user_dashboard
+        print(get_user_dashboard(args.user_id))
+    else:
+        from query_data import print_user_report
+        print_user_report(args.user_id)
+
+def _recommend(args, rest):
+    from recommendations import get_fitness_recommendations, get_nutrition_recommendations, refresh_recommendations
+    if args.refresh:
+        print(f"Refreshed the recommendations of {refresh_recommendations(args.batch_size)} users")
+    for user_id in args.user_ids:
+        print(f"User {user_id} fitness: {get_fitness_recommendations(user_id)}")
+        print(f"User {user_id} nutrition: {get_nutrition_recommendations(user_id)}")
+
+def _benchmark(args, rest):
+    from benchmark import main
+    main(rest, prog='cli.py benchmark')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description="Health and fitness tracking app.")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='COMMAND')
+
+    init = commands.add_parser('init', help="create the database and its tables")
+    init.add_argument('--migrate', action='store_true', help="also upgrade an existing database (see migrate.py)")
+    init.set_defaults(run=_init)
+
+    seed = commands.add_parser('seed', add_help=False, help="populate the database with sample data "
+                                                           "(options of insert_data.py; `seed --help` lists them)")
+    seed.set_defaults(run=_seed)
+
+    query = commands.add_parser('query', help="print the queries and recommendations for a user")
+    query.add_argument('user_id', type=int)
+    query.add_argument('--dashboard', action='store_true', help="print only the one-query dashboard")
+    query.set_defaults(run=_query)
+
+    recommend = commands.add_parser('recommend', help="print users' recommendations or refresh the stored ones")
+    recommend.add_argument('user_ids', type=int, nargs='*', metavar='USER_ID')
+    recommend.add_argument('--refresh', action='store_true', help="refresh the stored recommendations first")
+    recommend.add_argument('--batch-size', type=int, default=500, help="users recomputed per transaction (--refresh)")
+    recommend.set_defaults(run=_recommend)
+
+    benchmark = commands.add_parser('benchmark', add_help=False, help="run the latency benchmarks "
+                                                                     "(options of benchmark.py; `benchmark --help` lists them)")
+    benchmark.set_defaults(run=_benchmark)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args, rest = parser.parse_known_args(argv)
+    if rest and args.command not in FORWARDED_COMMANDS:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    if args.command == 'recommend' and not (args.user_ids or args.refresh):
+        parser.error("recommend needs a USER_ID or --refresh")
+    args.run(args, rest)
+
+if __name__ == '__main__':
+    main()
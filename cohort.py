@@ -0,0 +1,277 @@
+from create import User, HealthMetrics, DailyUserSummary, session_scope
+from partitions import partition_source
+from sharding import scatter
+from sqlalchemy import select, func
+from datetime import date, timedelta
+import numpy as np
+import argparse
+import math
+
+# Cohort analytics:
+# Users are grouped into cohorts by goal, gender and age band, and each user contributes one value per metric: the
+# average daily calories, workout minutes and sleep hours over the days they logged any in the window, or their
+# average BMI reading. Percentiles per cohort are computed in one of two modes. 'exact' pulls every user's value
+# into NumPy, which suits small populations. 'sketch' streams the values into one QuantileSketch per cohort and
+# shard; sketches are small, are built where the data lives and merge by adding counts, so it scales to millions of
+# users with a bounded relative error.
+
+COHORT_ATTRIBUTES = ('goal', 'gender', 'age')
+
+# Metric name -> (per-day rollup value, count that must be positive for the day to count).
+_ROLLUP_METRICS = {
+    'calories': (DailyUserSummary.calories, DailyUserSummary.meal_count),
+    'workout_minutes': (DailyUserSummary.workout_minutes, DailyUserSummary.workout_count),
+    'sleep_hours': (DailyUserSummary.sleep_hours, DailyUserSummary.sleep_count),
+}
+COHORT_METRICS = tuple(_ROLLUP_METRICS) + ('bmi',)
+
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90)
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with a relative error guarantee (DDSketch). A value v > 0 is counted in the logarithmic
+    bucket ceil(log(v) / log(gamma)), gamma = (1 + a) / (1 - a), so every estimated quantile is within a factor
+    `relative_accuracy` (a) of the true value of that rank. Values <= 0 are counted as 0. Sketches of the same
+    accuracy merge exactly by adding their bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.bins = {}  # bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, values):
+        """
+        Counts every finite value of `values` (a number or an array).
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        indexes, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of `other` into this sketch.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _buckets(self):
+        """
+        Sorted bucket indexes, their representative values and the cumulative counts up to each, zeros first.
+        """
+        indexes = np.array(sorted(self.bins), dtype=np.int64)
+        counts = np.array([self.bins[index] for index in indexes.tolist()], dtype=np.int64)
+        # The point of bucket (gamma^(i-1), gamma^i] with the same relative distance to both ends.
+        values = 2 * np.exp(indexes * self._log_gamma) / (1 + math.exp(self._log_gamma))
+        return indexes, values, self.zero_count + np.cumsum(counts)
+
+    def quantiles(self, qs):
+        """
+        Estimated values at the quantiles `qs` (0 to 1), each the value of rank q * (count - 1) in sorted order.
+        NaN for an empty sketch.
+        """
+        qs = np.asarray(qs, dtype=float)
+        if not self.count:
+            return np.full(qs.shape, np.nan)
+        _, values, cumulative = self._buckets()
+        ranks = qs * (self.count - 1)
+        positions = np.minimum(np.searchsorted(cumulative, ranks, side='right'), len(values) - 1)
+        return np.where(ranks < self.zero_count, 0.0, values[positions] if len(values) else 0.0)
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+    def percentile_rank(self, value):
+        """
+        Estimated percentage of the counted values below `value`, counting those in its bucket as half below.
+        """
+        if not self.count:
+            return float('nan')
+        if value <= 0:
+            below, same = 0, self.zero_count
+        else:
+            indexes, _, cumulative = self._buckets()
+            index = math.ceil(math.log(value) / self._log_gamma)
+            position = np.searchsorted(indexes, index)
+            below = int(cumulative[position - 1]) if position else self.zero_count
+            same = self.bins.get(index, 0)
+        return 100.0 * (below + same / 2) / self.count
+
+def age_band(age, width=10):
+    """
+    The 'low-high' age band of `age`, e.g. '30-39' for bands of 10 years.
+    """
+    low = int(age) // width * width
+    return f"{low}-{low + width - 1}"
+
+def _check(metric, by):
+    if metric not in COHORT_METRICS:
+        raise ValueError(f"Unknown cohort metric {metric!r}; expected one of {', '.join(COHORT_METRICS)}")
+    unknown = [attribute for attribute in by if attribute not in COHORT_ATTRIBUTES]
+    if unknown:
+        raise ValueError(f"Unknown cohort attribute {unknown[0]!r}; expected one of {', '.join(COHORT_ATTRIBUTES)}")
+
+def _user_values_statement(session, metric, days, cohort=None, age_width=10, user_id=None):
+    """
+    (user_id, goal, gender, age, value) of every user with `metric` data in the last `days` days, optionally
+    restricted to one cohort ({attribute: value}, the age as an age band) or one user.
+    """
+    start = date.today() - timedelta(days=days)
+    if metric == 'bmi':
+        source = partition_source(session, HealthMetrics, start)
+        values = select(source.user_id.label('user_id'), func.avg(source.bmi).label('value')).where(
+            source.date >= start, source.bmi.isnot(None)).group_by(source.user_id)
+        user_column = source.user_id
+    else:
+        value, logged = _ROLLUP_METRICS[metric]
+        values = select(DailyUserSummary.user_id.label('user_id'), func.avg(value).label('value')).where(
+            DailyUserSummary.date >= start, logged > 0).group_by(DailyUserSummary.user_id)
+        user_column = DailyUserSummary.user_id
+    if user_id is not None:
+        values = values.where(user_column == user_id)
+    values = values.subquery('user_values')
+    statement = select(User.user_id, User.goal, User.gender, User.age, values.c.value).join_from(
+        User, values, User.user_id == values.c.user_id)
+    for attribute, wanted in (cohort or {}).items():
+        if attribute == 'age':
+            low = int(wanted.split('-')[0])
+            statement = statement.where(User.age.between(low, low + age_width - 1))
+        else:
+            statement = statement.where(getattr(User, attribute) == wanted)
+    return statement
+
+def _cohort_key(row, by, age_width):
+    return tuple(age_band(row.age, age_width) if attribute == 'age' else getattr(row, attribute) for attribute in by)
+
+def _user_value_rows(session, metric, days, cohort, age_width):
+    return [tuple(row) for row in session.execute(_user_values_statement(session, metric, days, cohort, age_width))]
+
+def _cohort_sketches(session, metric, by, days, age_width, relative_accuracy, chunk_size, cohort=None):
+    """
+    One QuantileSketch per cohort, fed `chunk_size` users at a time so memory does not grow with the population.
+    """
+    sketches = {}
+    result = session.execute(_user_values_statement(session, metric, days, cohort, age_width))
+    for rows in result.partitions(chunk_size):
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(_cohort_key(row, by, age_width), []).append(row.value)
+        for key, values in grouped.items():
+            sketches.setdefault(key, QuantileSketch(relative_accuracy)).add(values)
+    return sketches
+
+def merge_cohort_sketches(parts):
+    """
+    Merges {cohort: QuantileSketch} dicts built on different shards or user ranges into one.
+    """
+    merged = {}
+    for part in parts:
+        for key, sketch in part.items():
+            if key in merged:
+                merged[key].merge(sketch)
+            else:
+                merged[key] = sketch
+    return merged
+
+def build_cohort_sketches(metric, by=COHORT_ATTRIBUTES, days=30, age_width=10, relative_accuracy=0.01,
+                          chunk_size=10000, processes=None):
+    """
+    {cohort key: QuantileSketch} of `metric` for every cohort of the `by` attributes, built on every shard in
+    parallel (see sharding.scatter) and merged. Cohort keys are tuples in `by` order, with ages as age bands.
+    """
+    _check(metric, by)
+    return merge_cohort_sketches(scatter(_cohort_sketches, metric, tuple(by), days, age_width, relative_accuracy,
+                                         chunk_size, processes=processes))
+
+def _exact_values(metric, by, days, age_width, cohort=None):
+    """
+    {cohort key: sorted array of user values}.
+    """
+    rows = [row for part in scatter(_user_value_rows, metric, days, cohort, age_width) for row in part]
+    grouped = {}
+    for user_id, goal, gender, age, value in rows:
+        attributes = {'goal': goal, 'gender': gender, 'age': age_band(age, age_width)}
+        grouped.setdefault(tuple(attributes[attribute] for attribute in by), []).append(value)
+    return {key: np.sort(np.array(values, dtype=float)) for key, values in grouped.items()}
+
+def cohort_percentiles(metric, percentiles=DEFAULT_PERCENTILES, by=COHORT_ATTRIBUTES, days=30, age_width=10,
+                       mode='exact', relative_accuracy=0.01, processes=None):
+    """
+    Percentiles of `metric` ('calories', 'workout_minutes', 'sleep_hours' or 'bmi') per cohort of the `by`
+    attributes. 'exact' mode interpolates between the users' values like np.percentile; 'sketch' mode estimates
+    them within `relative_accuracy` from merged per-shard sketches. Returns {cohort key: {'users': n,
+    'percentiles': {p: value}}}.
+    """
+    _check(metric, by)
+    result = {}
+    if mode == 'exact':
+        for key, values in _exact_values(metric, tuple(by), days, age_width).items():
+            result[key] = {'users': len(values),
+                           'percentiles': dict(zip(percentiles, np.percentile(values, percentiles).tolist()))}
+    elif mode == 'sketch':
+        sketches = build_cohort_sketches(metric, by, days, age_width, relative_accuracy, processes=processes)
+        for key, sketch in sketches.items():
+            estimates = sketch.quantiles(np.asarray(percentiles, dtype=float) / 100).tolist()
+            result[key] = {'users': sketch.count, 'percentiles': dict(zip(percentiles, estimates))}
+    else:
+        raise ValueError(f"Unknown mode {mode!r}; expected 'exact' or 'sketch'")
+    return dict(sorted(result.items()))
+
+def user_percentile(user_id, metric, by=COHORT_ATTRIBUTES, days=30, age_width=10, mode='exact', sketches=None,
+                    relative_accuracy=0.01):
+    """
+    Where one user's `metric` value falls within their cohort: {'cohort', 'value', 'percentile', 'users'}, the
+    percentile being the share of the cohort below the user's value (ties count half). Returns None when the user
+    has no value in the window. In 'sketch' mode pass prebuilt `sketches` (build_cohort_sketches with the same
+    arguments) to avoid rebuilding the user's cohort.
+    """
+    _check(metric, by)
+    with session_scope(user_id) as session:
+        row = session.execute(_user_values_statement(session, metric, days, age_width=age_width,
+                                                     user_id=user_id)).first()
+    if row is None:
+        return None
+    key = _cohort_key(row, by, age_width)
+    cohort = dict(zip(by, key))
+    if mode == 'exact':
+        values = _exact_values(metric, tuple(by), days, age_width, cohort)[key]
+        below = np.searchsorted(values, row.value, side='left')
+        same = np.searchsorted(values, row.value, side='right') - below
+        return {'cohort': key, 'value': row.value, 'percentile': float(100.0 * (below + same / 2) / len(values)),
+                'users': len(values)}
+    if mode != 'sketch':
+        raise ValueError(f"Unknown mode {mode!r}; expected 'exact' or 'sketch'")
+    if sketches is None:
+        sketches = merge_cohort_sketches(scatter(_cohort_sketches, metric, tuple(by), days, age_width,
+                                                 relative_accuracy, 10000, cohort))
+    sketch = sketches[key]
+    return {'cohort': key, 'value': row.value, 'percentile': sketch.percentile_rank(row.value), 'users': sketch.count}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print percentiles of a metric per user cohort.")
+    parser.add_argument('metric', choices=COHORT_METRICS)
+    parser.add_argument('--by', nargs='+', choices=COHORT_ATTRIBUTES, default=list(COHORT_ATTRIBUTES),
+                        help="attributes defining the cohorts")
+    parser.add_argument('--days', type=int, default=30, help="window the per-user averages cover")
+    parser.add_argument('--mode', choices=['exact', 'sketch'], default='exact')
+    args = parser.parse_args()
+    header = ' '.join(f"{'p' + str(p):>9}" for p in DEFAULT_PERCENTILES)
+    print(f"{'cohort':<36} {'users':>7} {header}")
+    for key, cohort in cohort_percentiles(args.metric, by=args.by, days=args.days, mode=args.mode).items():
+        values = ' '.join(f"{value:>9.1f}" for value in cohort['percentiles'].values())
+        print(f"{' / '.join(map(str, key)):<36} {cohort['users']:>7} {values}")
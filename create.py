@@ -1,15 +1,263 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Text, CheckConstraint
+from sqlalchemy import create_engine, event, DDL, Column, Integer, String, Float, Date, ForeignKey, Text, CheckConstraint, Index, \
+    Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session, validates
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import TypeDecorator, SmallInteger
+from sqlalchemy import func, select, type_coerce
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import itertools
+import os
+import threading
 
 Base = declarative_base()
 
+# Storage layout of the log tables, chosen per process before the models are defined:
+# 'standard' stores categories as strings and dates as ISO strings; 'compact' (opt-in, e.g.
+# HEALTH_FITNESS_STORAGE=compact) stores both as small integers. The ORM API is identical either way.
+STORAGE = os.environ.get('HEALTH_FITNESS_STORAGE', 'standard')
+if STORAGE not in ('standard', 'compact'):
+    raise ValueError(f"Unknown HEALTH_FITNESS_STORAGE {STORAGE!r}; expected 'standard' or 'compact'")
+COMPACT_STORAGE = STORAGE == 'compact'
+
+WORKOUT_TYPES = ('Cardio', 'Strength', 'Flexibility', 'Balance')
+INTENSITIES = ('Low', 'Medium', 'High')
+MEAL_TYPES = ('Breakfast', 'Lunch', 'Dinner', 'Snack')
+SLEEP_QUALITIES = ('Poor', 'Fair', 'Good', 'Excellent')
+
+# Day numbers count days since 1970-01-01, the NumPy datetime64 epoch; Julian day 2440587.5 is that date.
+EPOCH = date(1970, 1, 1)
+EPOCH_JULIAN_DAY = 2440587.5
+
+class EnumCode(TypeDecorator):
+    """
+    Stores one of a fixed tuple of strings as its index, so a category costs one byte on disk instead of a string.
+    """
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, choices):
+        super().__init__()
+        self.choices = tuple(choices)
+        self._codes = {choice: code for code, choice in enumerate(self.choices)}
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return self._codes[value]
+        except KeyError:
+            raise ValueError(f"{value!r} is not one of {', '.join(self.choices)}") from None
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.choices[value]
+
+    def encode_array(self, values):
+        """
+        Vectorized bind conversion for the bulk loader: an array of strings to an array of codes.
+        """
+        # NumPy is only needed by bulk loads; importing it here keeps it out of every other command's startup.
+        import numpy as np
+        codes = np.full(len(values), -1, dtype=np.int64)
+        for code, choice in enumerate(self.choices):
+            codes[values == choice] = code
+        if (codes < 0).any():
+            raise ValueError(f"Values outside {', '.join(self.choices)}: {sorted(set(values[codes < 0].tolist()))}")
+        return codes
+
+class DayNumber(TypeDecorator):
+    """
+    Stores a date as its day number since 1970-01-01 (a 1-3 byte integer instead of a 10 byte ISO string).
+    Datetimes are truncated to their date.
+    """
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            value = value.date()
+        return (value - EPOCH).days
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + timedelta(days=value)
+
+    def encode_array(self, values):
+        """
+        Vectorized bind conversion for the bulk loader: an array of ISO date strings to an array of day numbers.
+        """
+        import numpy as np
+        return np.asarray(values).astype('datetime64[D]').astype(np.int64)
+
+def date_column(**kwargs):
+    """
+    A date column in the configured storage layout.
+    """
+    kwargs.setdefault('nullable', False)
+    return Column(DayNumber if COMPACT_STORAGE else Date, **kwargs)
+
+def choice_column(name, choices):
+    """
+    A required column holding one of `choices`: a string checked by a CHECK constraint in the standard layout, a
+    range-checked integer code in the compact layout. Free-form categories stay plain String columns in both.
+    """
+    info = {'choices': tuple(choices)}  # Lets migrate.py convert the column between layouts.
+    if COMPACT_STORAGE:
+        return Column(EnumCode(choices), CheckConstraint(f"{name} BETWEEN 0 AND {len(choices) - 1}"),
+                      nullable=False, info=info)
+    return Column(String, CheckConstraint(f"{name} IN ({', '.join(repr(choice) for choice in choices)})"),
+                  nullable=False, info=info)
+
+def stored_literal(column, value):
+    """
+    SQL literal for `value` as `column` stores it, for hand-written SQL such as the rollup triggers.
+    """
+    if isinstance(column.type, EnumCode):
+        return str(column.type.choices.index(value))
+    return "'" + value.replace("'", "''") + "'"
+
+def julian_day(column):
+    """
+    SQL expression giving the Julian day of a date column in either storage layout.
+    """
+    if isinstance(column.type, DayNumber):
+        return type_coerce(column, Float) + EPOCH_JULIAN_DAY
+    return func.julianday(column)
+
+def create_app_engine(url='sqlite:///health_fitness_app.db', pool_size=5, max_overflow=10, busy_timeout=30):
+    """
+    Creates an engine configured for concurrent readers alongside a writer.
+    Every connection switches SQLite to WAL journal mode (readers no longer block on the writer) and waits up to
+    `busy_timeout` seconds for a lock instead of failing. Connections are kept in a sized pool and may be handed
+    between threads, since each thread checks one out for the duration of its own session.
+    """
+    app_engine = create_engine(url, echo=False, poolclass=QueuePool, pool_size=pool_size,
+                               max_overflow=max_overflow, connect_args={'check_same_thread': False})
+
+    @event.listens_for(app_engine, 'connect')
+    def configure_connection(dbapi_connection, connection_record):
+        configure_sqlite_connection(dbapi_connection, busy_timeout)
+
+    return app_engine
+
+def configure_sqlite_connection(dbapi_connection, busy_timeout=30):
+    """
+    Applies the WAL, busy timeout and sync settings of create_app_engine to a new DBAPI connection.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # Durable in WAL mode, fsyncs only at checkpoints.
+    cursor.close()
+
 # Establish a connection to the SQLite database. 'echo=False' suppresses log output for clarity.
-engine = create_engine('sqlite:///health_fitness_app.db', echo=False)
+engine = create_app_engine()
 
 # Create a sessionmaker instance for database interactions.
 Session = sessionmaker(bind=engine)
 
+# Thread-local registry for long-lived sessions, e.g. one per worker thread; call ThreadSession.remove() when the thread is done.
+ThreadSession = scoped_session(Session)
+
+# User sharding (opt-in, e.g. HEALTH_FITNESS_SHARDS=4):
+# Every user and all of their rows live in one of N database files (health_fitness_app_shard0.db, ...), chosen by
+# user_id % N, so N writers can commit at once instead of queueing on a single file's write lock. Per-user work opens
+# its session on the user's shard with session_scope(user_id); cross-user work fans out over every shard with
+# sharding.scatter. New users take their id from shards.allocate_user_id() and are added inside session_scope(user_id).
+# With one shard (the default) everything uses `engine` and Session as before.
+SHARD_COUNT = int(os.environ.get('HEALTH_FITNESS_SHARDS', '1'))
+if SHARD_COUNT < 1:
+    raise ValueError(f"HEALTH_FITNESS_SHARDS must be at least 1, not {SHARD_COUNT}")
+
+def shard_url(url, index):
+    """
+    URL of shard `index` of the database at `url`.
+    """
+    stem, extension = os.path.splitext(url)
+    return f"{stem}_shard{index}{extension or '.db'}"
+
+class ShardRouter:
+    """
+    Maps user ids to the engine of their shard. `shards` below is the process-wide instance; reconfigure it (like
+    Session.configure) to point the application at another set of shard files.
+    """
+
+    def __init__(self, url='sqlite:///health_fitness_app.db', count=1, **engine_options):
+        self.engines = []
+        self._lock = threading.Lock()
+        self.configure(url, count, **engine_options)
+
+    def configure(self, url, count, **engine_options):
+        self.dispose()
+        self.url = url
+        self.count = count
+        self.engines = [create_app_engine(shard_url(url, index), **engine_options) for index in range(count)] if count > 1 else []
+        self._turn = itertools.count()
+        self._allocated = {}
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def shard_for(self, user_id):
+        return int(user_id) % self.count
+
+    def engine_for(self, user_id):
+        return self.engines[self.shard_for(user_id)]
+
+    def allocate_user_id(self):
+        """
+        Reserves the user_id of a new user. Shards take new users in turn, and shard `index` hands out ids of the
+        form k * count + index above the largest one it holds, so the id routes the user to the shard that issued it.
+        Ids are unique within the process; writers in other processes racing for the same id fail on the primary key.
+        """
+        if not self.sharded:
+            raise ValueError("User ids are allocated by the database when sharding is disabled")
+        with self._lock:
+            index = next(self._turn) % self.count
+            with self.engines[index].connect() as connection:
+                largest = connection.execute(select(func.max(User.user_id))).scalar() or 0
+            largest = max(largest, self._allocated.get(index, 0))
+            self._allocated[index] = largest + 1 + (index - largest - 1) % self.count
+            return self._allocated[index]
+
+    def dispose(self):
+        for shard_engine in self.engines:
+            shard_engine.dispose()
+
+shards = ShardRouter(count=SHARD_COUNT)
+
+def _refuse_unrouted_flush(session, flush_context, instances):
+    raise ValueError("With sharding enabled, write inside session_scope(user_id) so the rows reach the user's shard")
+
+def _refuse_unrouted_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _refuse_unrouted_flush(orm_execute_state.session, None, None)
+
+@contextmanager
+def session_scope(user_id=None):
+    """
+    Provides a transactional scope around a series of operations: the session is committed on success,
+    rolled back on error, and always closed so its connection returns to the pool.
+    Each call gets its own session, which makes it safe to use from concurrent threads.
+    Pass the `user_id` the work is about to run it on that user's shard when sharding is enabled; without one the
+    session is read-only then, since no single shard owns its writes.
+    """
+    session = Session(bind=shards.engine_for(user_id)) if user_id is not None and shards.sharded else Session()
+    if user_id is None and shards.sharded:
+        event.listen(session, 'before_flush', _refuse_unrouted_flush)
+        event.listen(session, 'do_orm_execute', _refuse_unrouted_statement)
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 class User(Base):
     """
     Represents a user in the app, containing personal info and health goals.
@@ -30,18 +278,30 @@ class User(Base):
     sleep_records = relationship("Sleep", back_populates="user")
     health_metrics = relationship("HealthMetrics", back_populates="user")
 
+@event.listens_for(User, 'before_insert')
+def _check_user_shard(mapper, connection, target):
+    """
+    With sharding enabled a shard's own autoincrement would issue ids that route to other shards, so a new User must
+    carry an id from shards.allocate_user_id() and be inserted on that id's shard.
+    """
+    if shards.sharded and (target.user_id is None or connection.engine is not shards.engine_for(target.user_id)):
+        raise ValueError("With sharding enabled, add new users with an id from shards.allocate_user_id() "
+                         "inside session_scope(user_id)")
+
 class Workout(Base):
     """
     Stores details of user workouts. Linked to the User table, allowing tracking of each user's exercise routines,
     critical for personalizing fitness plans and tracking progress.
     """
     __tablename__ = 'Workouts'
+    # Every query filters by user and date range; intensity is appended so recommendation aggregates are index-only.
+    __table_args__ = (Index('ix_workouts_user_date', 'user_id', 'date', 'intensity'),)
     workout_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"))
-    date = Column(Date, nullable=False)
-    type = Column(String, nullable=False)
+    date = date_column()
+    type = Column(String, nullable=False)  # Free-form; WORKOUT_TYPES are the common ones
     duration = Column(Integer, nullable=False)  # Stored in minutes
-    intensity = Column(String, CheckConstraint("intensity IN ('Low', 'Medium', 'High')"), nullable=False)
+    intensity = choice_column('intensity', INTENSITIES)
     user = relationship("User", back_populates="workouts")
 
 class Nutrition(Base):
@@ -50,10 +310,12 @@ class Nutrition(Base):
     Linked to the User table for personalized dietary recommendations.
     """
     __tablename__ = 'Nutrition'
+    # Calories are appended so the daily calorie aggregates are answered from the index alone.
+    __table_args__ = (Index('ix_nutrition_user_date', 'user_id', 'date', 'calories'),)
     meal_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"))
-    date = Column(Date, nullable=False)
-    type = Column(String, CheckConstraint("type IN ('Breakfast', 'Lunch', 'Dinner', 'Snack')"), nullable=False)
+    date = date_column()
+    type = choice_column('type', MEAL_TYPES)
     calories = Column(Integer, nullable=False)
     protein = Column(Float, nullable=False)  # Stored in grams
     carbs = Column(Float, nullable=False)    # Stored in grams
@@ -66,11 +328,13 @@ class Sleep(Base):
     thus linked to the User table for a comprehensive health analysis.
     """
     __tablename__ = 'Sleep'
+    # Quality is appended so the sleep quality breakdown is answered from the index alone.
+    __table_args__ = (Index('ix_sleep_user_date', 'user_id', 'date', 'quality'),)
     sleep_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"))
-    date = Column(Date, nullable=False)
+    date = date_column()
     duration = Column(Float, nullable=False)  # Stored in hours
-    quality = Column(String, CheckConstraint("quality IN ('Poor', 'Fair', 'Good', 'Excellent')"), nullable=False)
+    quality = choice_column('quality', SLEEP_QUALITIES)
     user = relationship("User", back_populates="sleep_records")
 
 class HealthMetrics(Base):
@@ -80,18 +344,325 @@ class HealthMetrics(Base):
     The relationship with the User table allows for personalized health tracking and recommendations.
     """
     __tablename__ = 'Health_Metrics'
+    __table_args__ = (
+        Index('ix_health_metrics_user_date', 'user_id', 'date'),
+        # Date-leading and covering, so population screens over a recent window never touch the table.
+        Index('ix_health_metrics_date_bp', 'date', 'user_id', 'systolic', 'diastolic'),
+    )
     metric_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"))
-    date = Column(Date, nullable=False)
+    date = date_column()
     weight = Column(Float, nullable=False)  # Stored in kilograms
     bmi = Column(Float, nullable=False)     # BMI calculated based on weight and height
     heart_rate = Column(Integer)            # Stored in beats per minute
     blood_pressure = Column(String)         # Stored as a string, e.g., "120/80"
+    # Numeric copies of blood_pressure (mmHg) so blood pressure can be aggregated and filtered in SQL.
+    systolic = Column(Integer, CheckConstraint("systolic BETWEEN 50 AND 300"))
+    diastolic = Column(Integer, CheckConstraint("diastolic BETWEEN 30 AND 200"))
     user = relationship("User", back_populates="health_metrics")
 
+    @validates('blood_pressure')
+    def _split_blood_pressure(self, key, value):
+        # Keep the numeric columns in sync whenever the reading is set through the ORM.
+        self.systolic, self.diastolic = parse_blood_pressure(value)
+        return value
+
+def parse_blood_pressure(value):
+    """
+    Splits a reading such as "120/80" into (systolic, diastolic) integers.
+    Returns (None, None) for missing, malformed or physiologically impossible readings.
+    """
+    try:
+        systolic, diastolic = (int(part) for part in value.split('/'))
+    except (AttributeError, ValueError):
+        return None, None
+    if not (50 <= systolic <= 300 and 30 <= diastolic <= 200):
+        return None, None
+    return systolic, diastolic
+
+class DailyUserSummary(Base):
+    """
+    Per-user, per-day rollup of nutrition, workout and sleep logs. Rows are maintained incrementally by SQLite
+    triggers on the Nutrition, Workouts and Sleep tables, so every write path (ORM, Core or bulk loads) keeps it current,
+    and the daily aggregates in query_data.py and recommendations.py read O(days) rows instead of O(logs).
+    """
+    __tablename__ = 'Daily_User_Summary'
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+    date = date_column(primary_key=True)
+    meal_count = Column(Integer, nullable=False, server_default='0')
+    calories = Column(Integer, nullable=False, server_default='0')
+    protein = Column(Float, nullable=False, server_default='0')  # Stored in grams
+    carbs = Column(Float, nullable=False, server_default='0')    # Stored in grams
+    fats = Column(Float, nullable=False, server_default='0')     # Stored in grams
+    workout_count = Column(Integer, nullable=False, server_default='0')
+    high_intensity_count = Column(Integer, nullable=False, server_default='0')
+    workout_minutes = Column(Integer, nullable=False, server_default='0')
+    low_intensity_minutes = Column(Integer, nullable=False, server_default='0')
+    medium_intensity_minutes = Column(Integer, nullable=False, server_default='0')
+    high_intensity_minutes = Column(Integer, nullable=False, server_default='0')
+    sleep_count = Column(Integer, nullable=False, server_default='0')
+    sleep_hours = Column(Float, nullable=False, server_default='0')
+    poor_sleep_count = Column(Integer, nullable=False, server_default='0')
+    fair_sleep_count = Column(Integer, nullable=False, server_default='0')
+    good_sleep_count = Column(Integer, nullable=False, server_default='0')
+    excellent_sleep_count = Column(Integer, nullable=False, server_default='0')
+
+class ImportedRecord(Base):
+    """
+    Natural keys of the rows written by importer.py, one per imported record, so re-importing an export (or an
+    overlapping one) skips the records that are already stored.
+    """
+    __tablename__ = 'Imported_Records'
+    source = Column(String, primary_key=True)       # Table the record was imported into
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+    natural_key = Column(String, primary_key=True)  # e.g. "2024-03-01|Cardio" or the record's timestamp
+
+class UserRecommendation(Base):
+    """
+    Stored fitness and nutrition recommendations with the inputs they were computed from, refreshed by
+    recommendations.refresh_recommendations. Triggers on Workouts and Nutrition bump data_version on every write;
+    computed_version is the data_version the stored advice was computed at (its watermark), so a row is current while
+    the two are equal and computed_on is today (the advice windows move with the date).
+    """
+    __tablename__ = 'User_Recommendations'
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+    fitness = Column(Text)
+    nutrition = Column(Text)
+    workout_count = Column(Integer)         # Last 30 days
+    workout_days = Column(Integer)          # Last 30 days
+    high_intensity_count = Column(Integer)  # Last 30 days
+    average_calories = Column(Float)        # Average daily total of the last 7 days, NULL without meals
+    data_version = Column(Integer, nullable=False, server_default='0')
+    computed_version = Column(Integer)
+    computed_on = date_column(nullable=True)
+
+class UserMetricState(Base):
+    """
+    Streaming per-user state of the health metrics in STREAM_METRICS, folded in by a trigger on Health_Metrics as
+    each reading is inserted: an exponentially weighted moving average and variance, the number of readings and the
+    last value per metric. Reading a user's trend is one primary key lookup however long their history is.
+    Readings are folded in date order. A reading dated before last_date, or an edit or delete of a reading, sets
+    `stale` instead; the state and the user's alerts stay as they were until migrate.rebuild_metric_states replays
+    the history, and readers replay it themselves meanwhile.
+    """
+    __tablename__ = 'User_Metric_State'
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), primary_key=True)
+    weight_readings = Column(Integer, nullable=False, server_default='0')
+    weight_average = Column(Float)
+    weight_variance = Column(Float)
+    last_weight = Column(Float)
+    bmi_readings = Column(Integer, nullable=False, server_default='0')
+    bmi_average = Column(Float)
+    bmi_variance = Column(Float)
+    last_bmi = Column(Float)
+    heart_rate_readings = Column(Integer, nullable=False, server_default='0')
+    heart_rate_average = Column(Float)
+    heart_rate_variance = Column(Float)
+    last_heart_rate = Column(Float)
+    last_metric_id = Column(Integer)  # Newest reading folded in
+    last_date = date_column(nullable=True)
+    stale = Column(Boolean, nullable=False, server_default='0')
+
+class HealthMetricAlert(Base):
+    """
+    A reading that deviated from its user's moving average by more than METRIC_ALERT_RULES allow, written by the
+    Health_Metrics insert trigger when the reading arrives. average and variance are the user's state before it.
+    """
+    __tablename__ = 'Health_Metric_Alerts'
+    __table_args__ = (
+        Index('ix_health_metric_alerts_user_date', 'user_id', 'date'),
+        Index('ix_health_metric_alerts_date', 'date'),
+    )
+    alert_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('Users.user_id', ondelete="CASCADE"), nullable=False)
+    metric_id = Column(Integer, nullable=False)  # Not a foreign key: readings move to the archives (partitions.py)
+    date = date_column()
+    metric = Column(String, nullable=False)
+    value = Column(Float, nullable=False)
+    average = Column(Float, nullable=False)
+    variance = Column(Float, nullable=False)
+
+# How each source row contributes to its Daily_User_Summary row; '{row}' is NEW/OLD in triggers or the table in rebuilds.
+SUMMARY_SOURCES = {
+    'Nutrition': {
+        'meal_count': "1",
+        'calories': "{row}.calories",
+        'protein': "{row}.protein",
+        'carbs': "{row}.carbs",
+        'fats': "{row}.fats",
+    },
+    'Workouts': {
+        'workout_count': "1",
+        'high_intensity_count': f"({{row}}.intensity = {stored_literal(Workout.intensity, 'High')})",
+        'workout_minutes': "{row}.duration",
+        'low_intensity_minutes': f"CASE WHEN {{row}}.intensity = {stored_literal(Workout.intensity, 'Low')} THEN {{row}}.duration ELSE 0 END",
+        'medium_intensity_minutes': f"CASE WHEN {{row}}.intensity = {stored_literal(Workout.intensity, 'Medium')} THEN {{row}}.duration ELSE 0 END",
+        'high_intensity_minutes': f"CASE WHEN {{row}}.intensity = {stored_literal(Workout.intensity, 'High')} THEN {{row}}.duration ELSE 0 END",
+    },
+    'Sleep': {
+        'sleep_count': "1",
+        'sleep_hours': "{row}.duration",
+        'poor_sleep_count': f"({{row}}.quality = {stored_literal(Sleep.quality, 'Poor')})",
+        'fair_sleep_count': f"({{row}}.quality = {stored_literal(Sleep.quality, 'Fair')})",
+        'good_sleep_count': f"({{row}}.quality = {stored_literal(Sleep.quality, 'Good')})",
+        'excellent_sleep_count': f"({{row}}.quality = {stored_literal(Sleep.quality, 'Excellent')})",
+    },
+}
+
+def _summary_add_sql(contributions, row):
+    """
+    Upsert adding one source row's contributions to its summary row.
+    """
+    columns = ", ".join(contributions)
+    values = ", ".join(expression.format(row=row) for expression in contributions.values())
+    updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in contributions)
+    return (f"INSERT INTO Daily_User_Summary (user_id, date, {columns}) SELECT {row}.user_id, {row}.date, {values} "
+            f"WHERE {row}.user_id IS NOT NULL ON CONFLICT (user_id, date) DO UPDATE SET {updates};")
+
+def _summary_subtract_sql(contributions, row):
+    """
+    Removes one source row's contributions from its summary row, dropping the row once nothing is left in it.
+    """
+    updates = ", ".join(f"{column} = {column} - {expression.format(row=row)}" for column, expression in contributions.items())
+    return (f"UPDATE Daily_User_Summary SET {updates} WHERE user_id = {row}.user_id AND date = {row}.date; "
+            f"DELETE FROM Daily_User_Summary WHERE user_id = {row}.user_id AND date = {row}.date "
+            f"AND meal_count = 0 AND workout_count = 0 AND sleep_count = 0;")
+
+def summary_trigger_name(table, operation):
+    """
+    Name of the trigger maintaining Daily_User_Summary for `operation` ('insert', 'update' or 'delete') on `table`.
+    """
+    return f"trg_{table.lower()}_summary_{operation}"
+
+def summary_trigger_ddl():
+    """
+    Returns the CREATE TRIGGER statements that keep Daily_User_Summary in sync with its source tables.
+    """
+    statements = []
+    for table, contributions in SUMMARY_SOURCES.items():
+        statements.append(
+            f"CREATE TRIGGER IF NOT EXISTS {summary_trigger_name(table, 'insert')} AFTER INSERT ON {table} "
+            f"WHEN NEW.user_id IS NOT NULL BEGIN {_summary_add_sql(contributions, 'NEW')} END")
+        statements.append(
+            f"CREATE TRIGGER IF NOT EXISTS {summary_trigger_name(table, 'delete')} AFTER DELETE ON {table} "
+            f"WHEN OLD.user_id IS NOT NULL BEGIN {_summary_subtract_sql(contributions, 'OLD')} END")
+        statements.append(
+            f"CREATE TRIGGER IF NOT EXISTS {summary_trigger_name(table, 'update')} AFTER UPDATE ON {table} "
+            f"BEGIN {_summary_subtract_sql(contributions, 'OLD')} {_summary_add_sql(contributions, 'NEW')} END")
+    return statements
+
+# Install the triggers whenever the summary table is created (create_all on a new or migrated database).
+for statement in summary_trigger_ddl():
+    event.listen(DailyUserSummary.__table__, 'after_create', DDL(statement))
+
+# Tables whose writes make the stored recommendations of the row's user stale.
+RECOMMENDATION_SOURCES = ('Workouts', 'Nutrition')
+
+def _recommendation_bump_sql(row):
+    return (f"INSERT INTO User_Recommendations (user_id, data_version) SELECT {row}.user_id, 1 "
+            f"WHERE {row}.user_id IS NOT NULL ON CONFLICT (user_id) DO UPDATE SET data_version = data_version + 1;")
+
+def recommendation_trigger_name(table, operation):
+    return f"trg_{table.lower()}_recommendation_{operation}"
+
+def recommendation_trigger_ddl():
+    """
+    Returns the CREATE TRIGGER statements that bump User_Recommendations.data_version on writes to its source tables.
+    """
+    rows = {'insert': ('NEW',), 'delete': ('OLD',), 'update': ('OLD', 'NEW')}
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {recommendation_trigger_name(table, operation)} AFTER {operation.upper()} ON {table} "
+        f"BEGIN {' '.join(_recommendation_bump_sql(row) for row in operation_rows)} END"
+        for table in RECOMMENDATION_SOURCES for operation, operation_rows in rows.items()
+    ]
+
+for statement in recommendation_trigger_ddl():
+    event.listen(UserRecommendation.__table__, 'after_create', DDL(statement))
+
+# Health metrics folded into User_Metric_State as readings arrive.
+STREAM_METRICS = ('weight', 'bmi', 'heart_rate')
+# Weight of a new reading in the moving averages and variances; roughly the last 1/alpha readings dominate.
+METRIC_STATE_ALPHA = 0.1
+# Metrics that raise alerts: metric -> (direction, minimum distance from the moving average). 'rise' only flags
+# readings above the average, such as resting heart-rate spikes; 'change' flags both directions.
+METRIC_ALERT_RULES = {'heart_rate': ('rise', 10), 'weight': ('change', 2.0)}
+# A flagged reading must also lie more than this many moving standard deviations from the average...
+ALERT_SIGMAS = 3
+# ...and follow at least this many readings of the metric, so a user's first readings set a baseline instead.
+ALERT_MIN_READINGS = 10
+
+def metric_state_trigger_name(operation):
+    """
+    Name of the trigger maintaining User_Metric_State for `operation` ('insert', 'update' or 'delete') on Health_Metrics.
+    """
+    return f"trg_health_metrics_state_{operation}"
+
+METRIC_STATE_TRIGGER = metric_state_trigger_name('insert')
+
+def _metric_alert_sql(metric, direction, minimum):
+    deviation = f"(NEW.{metric} - {metric}_average)"
+    distance = deviation if direction == 'rise' else f"ABS{deviation}"
+    # Compared squared, since SQLite may be built without sqrt().
+    return (f"INSERT INTO Health_Metric_Alerts (user_id, metric_id, date, metric, value, average, variance) "
+            f"SELECT NEW.user_id, NEW.metric_id, NEW.date, '{metric}', NEW.{metric}, {metric}_average, {metric}_variance "
+            f"FROM User_Metric_State WHERE user_id = NEW.user_id AND NOT stale AND {metric}_readings >= {ALERT_MIN_READINGS} "
+            f"AND {distance} > {minimum} AND {deviation} * {deviation} > {ALERT_SIGMAS ** 2} * {metric}_variance;")
+
+def _metric_state_fold_sql():
+    """
+    Upsert folding the NEW reading into its user's state; metrics the reading leaves NULL keep their state, and a
+    stale state is left for the rebuild.
+    """
+    alpha = METRIC_STATE_ALPHA
+    columns, values, updates = ['user_id', 'last_metric_id', 'last_date'], ['NEW.user_id', 'NEW.metric_id', 'NEW.date'], []
+    for metric in STREAM_METRICS:
+        value, deviation = f"NEW.{metric}", f"(NEW.{metric} - {metric}_average)"
+        columns += [f"{metric}_readings", f"{metric}_average", f"{metric}_variance", f"last_{metric}"]
+        values += [f"({value} IS NOT NULL)", value, f"CASE WHEN {value} IS NULL THEN NULL ELSE 0.0 END", value]
+        updates += [
+            f"{metric}_readings = {metric}_readings + ({value} IS NOT NULL)",
+            f"{metric}_average = CASE WHEN {value} IS NULL THEN {metric}_average WHEN {metric}_readings = 0 THEN {value} "
+            f"ELSE {metric}_average + {alpha} * {deviation} END",
+            f"{metric}_variance = CASE WHEN {value} IS NULL THEN {metric}_variance WHEN {metric}_readings = 0 THEN 0.0 "
+            f"ELSE (1 - {alpha}) * ({metric}_variance + {alpha} * {deviation} * {deviation}) END",
+            f"last_{metric} = COALESCE({value}, last_{metric})",
+        ]
+    updates += ["last_metric_id = NEW.metric_id", "last_date = NEW.date"]
+    return (f"INSERT INTO User_Metric_State ({', '.join(columns)}) VALUES ({', '.join(values)}) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {', '.join(updates)} WHERE NOT stale;")
+
+def metric_state_trigger_ddl():
+    """
+    Returns the CREATE TRIGGER statements maintaining User_Metric_State. The insert trigger checks each new
+    Health_Metrics reading against its user's state (writing Health_Metric_Alerts rows) and then folds it in, or marks
+    the state stale when the reading predates it. The update and delete triggers mark the affected states stale.
+    """
+    mark_stale = "UPDATE User_Metric_State SET stale = 1 WHERE user_id"
+    alerts = " ".join(_metric_alert_sql(metric, *rule) for metric, rule in METRIC_ALERT_RULES.items())
+    watched = ", ".join(('user_id', 'date') + STREAM_METRICS)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {METRIC_STATE_TRIGGER} AFTER INSERT ON Health_Metrics "
+        f"WHEN NEW.user_id IS NOT NULL BEGIN {mark_stale} = NEW.user_id AND NEW.date < last_date; "
+        f"{alerts} {_metric_state_fold_sql()} END",
+        f"CREATE TRIGGER IF NOT EXISTS {metric_state_trigger_name('update')} AFTER UPDATE OF {watched} ON Health_Metrics "
+        f"BEGIN {mark_stale} IN (OLD.user_id, NEW.user_id); END",
+        f"CREATE TRIGGER IF NOT EXISTS {metric_state_trigger_name('delete')} AFTER DELETE ON Health_Metrics "
+        f"BEGIN {mark_stale} = OLD.user_id; END",
+    ]
+
+for statement in metric_state_trigger_ddl():
+    event.listen(UserMetricState.__table__, 'after_create', DDL(statement))
+
+def create_tables():
+    """
+    Creates the database (every shard file when sharding is enabled) and any missing tables.
+    """
+    for shard_engine in shards.engines or [engine]:
+        Base.metadata.create_all(shard_engine)
+
 if __name__ == '__main__':
    # This script will create the database and tables based on the defined schema when run directly.
-   Base.metadata.create_all(engine)
+   create_tables()
 
 # Design Justification:
 # The schema is designed to provide a comprehensive and holistic view of a user's health and fitness journey.
@@ -0,0 +1,285 @@
+from create import (User, Workout, Nutrition, Sleep, HealthMetrics, ImportedRecord, DayNumber, EnumCode, Session,
+                    shards, parse_blood_pressure)
+from cache import result_cache
+from migrate import rebuild_metric_states
+from sqlalchemy import MetaData, Table, Column, String, Date, CheckConstraint, PrimaryKeyConstraint, insert, select, delete, \
+    exists, literal, and_
+from collections import Counter
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from datetime import datetime
+import argparse
+import csv
+import gzip
+import json
+import math
+import os
+import time
+
+# Streaming import of wearable-device exports:
+# import_file() reads a CSV or NDJSON file (optionally gzip-compressed) one record at a time, validates every record
+# against the column types, nullability and constrained choices of its model, and writes the valid ones in large batched
+# transactions, so memory use does not grow with the file. Each record has a natural key: the user, the record's
+# timestamp (or its date when the export has none) and its type where the table has one. The keys are kept in
+# Imported_Records, so importing the same or an overlapping export again skips the records already stored.
+
+IMPORT_MODELS = {'workouts': Workout, 'nutrition': Nutrition, 'sleep': Sleep, 'health_metrics': HealthMetrics}
+
+# Rejected records kept with their line number and reason in ImportReport.examples.
+MAX_EXAMPLES = 20
+
+class RecordError(ValueError):
+    """
+    A record breaks a constraint of its model; `field` names the offending field.
+    """
+
+    def __init__(self, field, message):
+        super().__init__(f"{field}: {message}")
+        self.field = field
+
+@dataclass
+class ImportReport:
+    path: str
+    read: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    rejected: int = 0
+    seconds: float = 0.0
+    rejected_by_field: Counter = field(default_factory=Counter)
+    examples: list = field(default_factory=list)
+
+    @property
+    def rows_per_second(self):
+        return self.read / self.seconds if self.seconds else 0.0
+
+    def reject(self, line, error, count=1):
+        self.rejected += count
+        self.rejected_by_field[error.field] += count
+        if line is not None and len(self.examples) < MAX_EXAMPLES:
+            self.examples.append((line, str(error)))
+
+def _staging_table(model):
+    """
+    Per-connection TEMP table a batch is written to before it is deduplicated into `model`'s table.
+    The (user_id, natural_key) primary key drops duplicates within the batch.
+    """
+    columns = [Column(column.name, column.type) for column in model.__table__.columns if not column.primary_key]
+    return Table(f"import_{model.__tablename__.lower()}", _staging_metadata, *columns, Column('natural_key', String),
+                 PrimaryKeyConstraint('user_id', 'natural_key'), prefixes=['TEMPORARY'])
+
+_staging_metadata = MetaData()
+_staging_tables = {model: _staging_table(model) for model in IMPORT_MODELS.values()}
+
+def read_records(path, format=None):
+    """
+    Yields (line number, record) for every record of a CSV or NDJSON file, one at a time. The format follows the
+    extension (.csv, .ndjson, .jsonl, optionally followed by .gz) unless given. Unparseable NDJSON lines yield None.
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    format = format or ('csv' if name.endswith('.csv') else 'ndjson')
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as stream:
+        if format == 'csv':
+            reader = csv.DictReader(stream)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_number, record if isinstance(record, dict) else None
+
+def _parse_datetime(name, raw):
+    try:
+        # fromisoformat only accepts the 'Z' suffix from Python 3.11 on.
+        return datetime.fromisoformat(raw.strip().replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise RecordError(name, f"{raw!r} is not an ISO date") from None
+
+def _allowed_choices(column):
+    """
+    The values `column` accepts when the table restricts it to a fixed set (an EnumCode or a CHECK constraint),
+    None for free-form columns.
+    """
+    if isinstance(column.type, EnumCode):
+        return column.type.choices
+    if 'choices' in column.info and any(isinstance(constraint, CheckConstraint) for constraint in column.constraints):
+        return column.info['choices']
+    return None
+
+def _converter(column):
+    """
+    Function converting one present raw field of `column` to its Python value.
+    """
+    name = column.name
+    allowed = _allowed_choices(column)
+    if allowed is not None:
+        choices = frozenset(allowed)
+        listed = ', '.join(allowed)
+
+        def convert(raw):
+            if isinstance(raw, str) and raw in choices:
+                return raw
+            raise RecordError(name, f"{raw!r} is not one of {listed}")
+        return convert
+    if isinstance(column.type, (Date, DayNumber)):
+        return lambda raw: _parse_datetime(name, raw).date()
+    python_type = column.type.python_type
+    if python_type is str:
+        return str
+
+    def convert(raw):
+        if type(raw) is python_type:
+            value = raw
+        else:
+            try:
+                value = python_type(raw) if not isinstance(raw, bool) else None
+            except (TypeError, ValueError):
+                value = None
+            # "72.0" is an acceptable integer.
+            if value is None and python_type is int and isinstance(raw, (str, float)):
+                number = _number(raw)
+                value = int(number) if number is not None and number.is_integer() else None
+        if value is None or (python_type is float and not math.isfinite(value)):
+            raise RecordError(name, f"{raw!r} is not {'an integer' if python_type is int else 'a number'}")
+        return value
+    return convert
+
+def _number(raw):
+    try:
+        number = float(raw)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+# (column name, converter, required) per importable model, in column order. Primary keys are assigned on insert and
+# the numeric blood pressure columns are derived from blood_pressure. user_id is nullable in the schema, but an
+# imported record must belong to a user.
+_fields = {
+    model: [(column.name, _converter(column), not column.nullable or column.name == 'user_id')
+            for column in model.__table__.columns if not column.primary_key and column.name not in ('systolic', 'diastolic')]
+    for model in IMPORT_MODELS.values()
+}
+
+def validate_record(model, record):
+    """
+    Converts one raw record (a dict of CSV strings or JSON values) into column values for `model` and its natural key.
+    Raises RecordError for the first field that breaks the model's types, nullability or choices.
+    """
+    if record is None:
+        raise RecordError('record', "not a JSON object")
+    timestamp = _parse_datetime('timestamp', record['timestamp']) if record.get('timestamp') else None
+    values = {}
+    for name, convert, required in _fields[model]:
+        raw = record.get(name)
+        value = None if raw is None or (isinstance(raw, str) and not raw.strip()) else convert(raw)
+        if name == 'date' and timestamp is not None:
+            if value not in (None, timestamp.date()):
+                raise RecordError('date', f"{value} does not match the timestamp {timestamp.isoformat()}")
+            value = timestamp.date()
+        if value is None and required:
+            raise RecordError(name, "is required")
+        values[name] = value
+    if model is HealthMetrics:
+        # The same derivation as the model's blood_pressure validator.
+        values['systolic'], values['diastolic'] = parse_blood_pressure(values['blood_pressure'])
+    natural_key = timestamp.isoformat() if timestamp is not None else values['date'].isoformat()
+    if 'type' in values:
+        natural_key += f"|{values['type']}"
+    return values, natural_key
+
+def _write_batch(connection, model, rows):
+    """
+    Writes one batch in one transaction: stages it, drops records of unknown users and records whose natural key
+    was imported before, inserts the rest and records their keys. Returns (inserted, unknown user records).
+    """
+    table, staging = model.__table__, _staging_tables[model]
+    names = [column.name for column in staging.columns if column.name != 'natural_key']
+    imported = ImportedRecord.__table__
+    with connection.begin():
+        staging.create(connection, checkfirst=True)
+        connection.execute(insert(staging).prefix_with('OR IGNORE'), rows)
+        unknown = connection.execute(delete(staging).where(
+            ~exists().where(User.__table__.c.user_id == staging.c.user_id))).rowcount
+        new = ~exists().where(and_(imported.c.source == table.name, imported.c.user_id == staging.c.user_id,
+                                   imported.c.natural_key == staging.c.natural_key))
+        inserted = connection.execute(insert(table).from_select(
+            names, select(*(staging.c[name] for name in names)).where(new))).rowcount
+        connection.execute(insert(imported).prefix_with('OR IGNORE').from_select(
+            ['source', 'user_id', 'natural_key'], select(literal(table.name), staging.c.user_id, staging.c.natural_key)))
+        connection.execute(delete(staging))
+    return inserted, unknown
+
+def import_file(path, kind, format=None, batch_size=10000, bind=None):
+    """
+    Imports the `kind` records ('workouts', 'nutrition', 'sleep' or 'health_metrics') of a CSV or NDJSON export,
+    committing every `batch_size` valid records. Without `bind` records go to Session's database, or to their
+    user's shard when sharding is enabled. Health metric imports end by replaying the metric states they made stale.
+    Returns an ImportReport with the read, inserted, duplicate and rejected counts, the rejections per field and the
+    first rejected lines.
+    """
+    if kind not in IMPORT_MODELS:
+        raise ValueError(f"Unknown record kind {kind!r}; expected one of {', '.join(IMPORT_MODELS)}")
+    model = IMPORT_MODELS[kind]
+    binds = [bind] if bind is not None else shards.engines or [Session.kw['bind']]
+    report = ImportReport(path)
+    started = time.perf_counter()
+    with ExitStack() as stack:
+        connections = [stack.enter_context(target.connect()) for target in binds]
+        pending = [[] for _ in connections]
+        pending_count = 0
+
+        def flush():
+            for connection, rows in zip(connections, pending):
+                if not rows:
+                    continue
+                inserted, unknown = _write_batch(connection, model, rows)
+                report.inserted += inserted
+                report.duplicates += len(rows) - inserted - unknown
+                if unknown:
+                    report.reject(None, RecordError('user_id', "unknown user"), unknown)
+                # These inserts bypass the ORM flush events that invalidate cached results per user.
+                for user_id in {row['user_id'] for row in rows}:
+                    result_cache.invalidate_user(user_id)
+                rows.clear()
+
+        for line, record in read_records(path, format):
+            report.read += 1
+            try:
+                values, natural_key = validate_record(model, record)
+            except RecordError as error:
+                report.reject(line, error)
+                continue
+            values['natural_key'] = natural_key
+            pending[shards.shard_for(values['user_id']) if len(connections) > 1 else 0].append(values)
+            pending_count += 1
+            if pending_count >= batch_size:
+                flush()
+                pending_count = 0
+        flush()
+    if model is HealthMetrics and report.inserted:
+        # Historical readings predate the users' metric states, which the insert trigger then marks stale.
+        for target in binds:
+            rebuild_metric_states(target, stale_only=True)
+    report.seconds = time.perf_counter() - started
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import a CSV or NDJSON export of workouts, meals, sleep or health metrics.")
+    parser.add_argument('kind', choices=sorted(IMPORT_MODELS), help="what the file contains")
+    parser.add_argument('path', help="the export file (.csv, .ndjson or .jsonl, optionally .gz)")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help="override the format implied by the extension")
+    parser.add_argument('--batch-size', type=int, default=10000, help="valid records per transaction")
+    args = parser.parse_args()
+    report = import_file(args.path, args.kind, args.format, args.batch_size)
+    print(f"{os.path.basename(report.path)}: read {report.read} records in {report.seconds:.1f}s "
+          f"({report.rows_per_second:.0f} rows/s)")
+    print(f"inserted {report.inserted}, skipped {report.duplicates} duplicates, rejected {report.rejected}")
+    for name, count in report.rejected_by_field.most_common():
+        print(f"  rejected for {name}: {count}")
+    for line, reason in report.examples:
+        print(f"  line {line}: {reason}")
@@ -1,15 +1,40 @@
-from create import User, Workout, Nutrition, Sleep, HealthMetrics, engine
-from sqlalchemy.orm import sessionmaker
-from faker import Faker
+from create import (User, Workout, Nutrition, Sleep, HealthMetrics, SUMMARY_SOURCES, Session, engine, shards, summary_trigger_ddl,
+                    summary_trigger_name, METRIC_STATE_TRIGGER, metric_state_trigger_ddl, WORKOUT_TYPES, INTENSITIES,
+                    MEAL_TYPES, SLEEP_QUALITIES)
+from migrate import rebuild_daily_summaries, rebuild_metric_states
+from cache import result_cache
+from sqlalchemy import func, select
+import numpy as np
+import argparse
 import random
+import time
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 
-# Initialize Faker
-fake = Faker()
+# Faker and the ORM generators' sessions are created on first use, so importing this module (e.g. for bulk_load)
+# neither pays for importing Faker nor opens a session.
+_fake = None
+_sessions = None
 
-# Create a session
-Session = sessionmaker(bind=engine)
-session = Session()
+def fake_name():
+    """
+    A random full name from Faker.
+    """
+    global _fake
+    if _fake is None:
+        from faker import Faker
+        _fake = Faker()
+    return _fake.name()
+
+def generator_sessions():
+    """
+    The sessions shared by the ORM generators below: one per shard with sharding enabled, otherwise one on Session's
+    database.
+    """
+    global _sessions
+    if _sessions is None:
+        _sessions = [Session(bind=shard_engine) for shard_engine in shards.engines] or [Session()]
+    return _sessions
 
 def generate_random_date(start_date, end_date):
     """
@@ -23,96 +48,320 @@ def generate_random_date(start_date, end_date):
 def generate_users(n=10):
     """
     Populates the database with sample user data. Each user has a unique set of attributes like name, age, gender, etc.
+    With sharding enabled every user takes an id from shards.allocate_user_id() and is written to that id's shard.
     """
+    sessions = generator_sessions()
     for _ in range(n):
         user = User(
-            name=fake.name(),
+            name=fake_name(),
             age=random.randint(18, 65),
             gender=random.choice(['Male', 'Female', 'Other']),
             height=round(random.uniform(150.0, 200.0), 2),
             weight=round(random.uniform(50.0, 120.0), 2),
             goal=random.choice(['Weight Loss', 'Muscle Gain', 'Improve Fitness'])
         )
-        session.add(user)
-    session.commit()
+        if shards.sharded:
+            user.user_id = shards.allocate_user_id()
+            sessions[shards.shard_for(user.user_id)].add(user)
+        else:
+            sessions[0].add(user)
+    for session in sessions:
+        session.commit()
 
 def generate_workouts(n=50):
     """
     Generates workout records for each user. Workouts vary by type, duration, and intensity, reflecting realistic fitness activities.
     """
-    users = session.query(User).all()
-    for user in users:
-        for _ in range(n):
-            workout = Workout(
-                user_id=user.user_id,
-                date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
-                type=random.choice(['Cardio', 'Strength', 'Flexibility', 'Balance']),
-                duration=random.randint(15, 120),
-                intensity=random.choice(['Low', 'Medium', 'High'])
-            )
-            session.add(workout)
-    session.commit()
+    for session in generator_sessions():
+        users = session.query(User).all()
+        for user in users:
+            for _ in range(n):
+                workout = Workout(
+                    user_id=user.user_id,
+                    date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
+                    type=random.choice(['Cardio', 'Strength', 'Flexibility', 'Balance']),
+                    duration=random.randint(15, 120),
+                    intensity=random.choice(['Low', 'Medium', 'High'])
+                )
+                session.add(workout)
+        session.commit()
 
 def generate_nutrition_logs(n=150):
     """
     Creates detailed nutrition logs for each user, tracking daily food intake, calories, and macronutrients.
     """
-    users = session.query(User).all()
-    for user in users:
-        for _ in range(n):
-            nutrition = Nutrition(
-                user_id=user.user_id,
-                date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
-                type=random.choice(['Breakfast', 'Lunch', 'Dinner', 'Snack']),
-                calories=random.randint(100, 800),
-                protein=round(random.uniform(0, 50), 2),
-                carbs=round(random.uniform(0, 100), 2),
-                fats=round(random.uniform(0, 50), 2)
-            )
-            session.add(nutrition)
-    session.commit()
+    for session in generator_sessions():
+        users = session.query(User).all()
+        for user in users:
+            for _ in range(n):
+                nutrition = Nutrition(
+                    user_id=user.user_id,
+                    date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
+                    type=random.choice(['Breakfast', 'Lunch', 'Dinner', 'Snack']),
+                    calories=random.randint(100, 800),
+                    protein=round(random.uniform(0, 50), 2),
+                    carbs=round(random.uniform(0, 100), 2),
+                    fats=round(random.uniform(0, 50), 2)
+                )
+                session.add(nutrition)
+        session.commit()
 
 def generate_sleep_records(n=100):
     """
     Simulates sleep data for users, recording the duration and quality of sleep, to analyze its impact on health and fitness.
     """
-    users = session.query(User).all()
-    for user in users:
-        for _ in range(n):
-            sleep = Sleep(
-                user_id=user.user_id,
-                date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
-                duration=round(random.uniform(4, 12), 2),
-                quality=random.choice(['Poor', 'Fair', 'Good', 'Excellent'])
-            )
-            session.add(sleep)
-    session.commit()
+    for session in generator_sessions():
+        users = session.query(User).all()
+        for user in users:
+            for _ in range(n):
+                sleep = Sleep(
+                    user_id=user.user_id,
+                    date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
+                    duration=round(random.uniform(4, 12), 2),
+                    quality=random.choice(['Poor', 'Fair', 'Good', 'Excellent'])
+                )
+                session.add(sleep)
+        session.commit()
 
 def generate_health_metrics(n=50):
     """
     Generates records of various health metrics for users, such as weight, BMI, heart rate, and blood pressure, to monitor health changes over time.
     """
-    users = session.query(User).all()
-    for user in users:
-        for _ in range(n):
-            weight = round(random.uniform(50.0, 120.0), 2)
-            height = user.height / 100  # convert cm to m
-            bmi = round(weight / (height ** 2), 2)
-            health_metric = HealthMetrics(
-                user_id=user.user_id,
-                date=generate_random_date(datetime.now() - timedelta(days=365), datetime.now()),
-                weight=weight,
-                bmi=bmi,
-                heart_rate=random.randint(60, 100),
-                blood_pressure=f"{random.randint(100, 140)}/{random.randint(60, 90)}"
-            )
-            session.add(health_metric)
-    session.commit()
+    for session in generator_sessions():
+        users = session.query(User).all()
+        for user in users:
+            # Readings are logged in date order, so the metric state trigger folds them in as they arrive.
+            dates = sorted(generate_random_date(datetime.now() - timedelta(days=365), datetime.now()) for _ in range(n))
+            for reading_date in dates:
+                weight = round(random.uniform(50.0, 120.0), 2)
+                height = user.height / 100  # convert cm to m
+                bmi = round(weight / (height ** 2), 2)
+                health_metric = HealthMetrics(
+                    user_id=user.user_id,
+                    date=reading_date,
+                    weight=weight,
+                    bmi=bmi,
+                    heart_rate=random.randint(60, 100),
+                    blood_pressure=f"{random.randint(100, 140)}/{random.randint(60, 90)}"
+                )
+                session.add(health_metric)
+        session.commit()
+
+# Bulk-load path:
+# The generators above build one ORM object per row, which is fine for a demo dataset but far too slow for
+# load-test fixtures. The functions below draw whole columns at once with NumPy and write them with batched
+# executemany inserts, so memory stays flat (one block of users at a time) regardless of the total row count.
+
+WORKOUT_TYPES = np.array(WORKOUT_TYPES)
+INTENSITIES = np.array(INTENSITIES)
+MEAL_TYPES = np.array(MEAL_TYPES)
+SLEEP_QUALITIES = np.array(SLEEP_QUALITIES)
+GENDERS = np.array(['Male', 'Female', 'Other'])
+GOALS = np.array(['Weight Loss', 'Muscle Gain', 'Improve Fitness'])
+
+def _insert_columns(connection, table, columns):
+    """
+    Writes a dict of equally sized NumPy columns to `table` with a single driver-level executemany.
+    Rows are passed as positional tuples of native Python values (sqlite3 cannot bind NumPy scalars), which
+    skips SQLAlchemy's per-row parameter processing, the dominant cost when inserting millions of rows.
+    Columns stored in the compact layout are encoded here with their type's vectorized conversion instead.
+    """
+    columns = {key: table.c[key].type.encode_array(values) if hasattr(table.c[key].type, 'encode_array') else values
+               for key, values in columns.items()}
+    keys = list(columns)
+    quote = connection.dialect.identifier_preparer.quote
+    statement = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(table.name), ", ".join(quote(key) for key in keys), ", ".join("?" * len(keys)))
+    rows = list(zip(*(columns[key].tolist() for key in keys)))
+    if rows:
+        connection.exec_driver_sql(statement, rows)
+    return len(rows)
+
+def _random_dates(rng, size, days=365):
+    """
+    Vectorized counterpart of generate_random_date: draws `size` dates from the last `days` days.
+    Dates are rendered as ISO strings, the same format SQLAlchemy's Date type stores in SQLite.
+    """
+    start = np.datetime64(datetime.now().date() - timedelta(days=days), 'D')
+    return np.datetime_as_string(start + rng.integers(0, days, size=size), unit='D')
+
+def generate_user_block(rng, first_id, n, name_pool):
+    """
+    Draws the columns for `n` users with consecutive ids starting at `first_id`.
+    Names are sampled from a pre-generated Faker pool so Faker is called a fixed number of times.
+    """
+    return {
+        'user_id': np.arange(first_id, first_id + n),
+        'name': rng.choice(name_pool, size=n),
+        'age': rng.integers(18, 66, size=n),
+        'gender': rng.choice(GENDERS, size=n),
+        'height': np.round(rng.uniform(150.0, 200.0, size=n), 2),
+        'weight': np.round(rng.uniform(50.0, 120.0, size=n), 2),
+        'goal': rng.choice(GOALS, size=n),
+    }
+
+def generate_workout_block(rng, user_ids, n):
+    """
+    Draws `n` workouts for every user in `user_ids`, matching the value ranges of generate_workouts.
+    """
+    size = len(user_ids) * n
+    return {
+        'user_id': np.repeat(user_ids, n),
+        'date': _random_dates(rng, size),
+        'type': rng.choice(WORKOUT_TYPES, size=size),
+        'duration': rng.integers(15, 121, size=size),
+        'intensity': rng.choice(INTENSITIES, size=size),
+    }
+
+def generate_nutrition_block(rng, user_ids, n):
+    """
+    Draws `n` nutrition logs for every user in `user_ids`, matching the value ranges of generate_nutrition_logs.
+    """
+    size = len(user_ids) * n
+    return {
+        'user_id': np.repeat(user_ids, n),
+        'date': _random_dates(rng, size),
+        'type': rng.choice(MEAL_TYPES, size=size),
+        'calories': rng.integers(100, 801, size=size),
+        'protein': np.round(rng.uniform(0, 50, size=size), 2),
+        'carbs': np.round(rng.uniform(0, 100, size=size), 2),
+        'fats': np.round(rng.uniform(0, 50, size=size), 2),
+    }
+
+def generate_sleep_block(rng, user_ids, n):
+    """
+    Draws `n` sleep records for every user in `user_ids`, matching the value ranges of generate_sleep_records.
+    """
+    size = len(user_ids) * n
+    return {
+        'user_id': np.repeat(user_ids, n),
+        'date': _random_dates(rng, size),
+        'duration': np.round(rng.uniform(4, 12, size=size), 2),
+        'quality': rng.choice(SLEEP_QUALITIES, size=size),
+    }
+
+def generate_health_metric_block(rng, user_ids, heights, n):
+    """
+    Draws `n` health metric records for every user in `user_ids`; BMI is derived from each user's height (cm).
+    Each user's readings are in date order, as they arrive from a device, so the metric state trigger folds them in.
+    """
+    size = len(user_ids) * n
+    weight = np.round(rng.uniform(50.0, 120.0, size=size), 2)
+    height = np.repeat(heights, n) / 100  # convert cm to m
+    systolic = rng.integers(100, 141, size=size)
+    diastolic = rng.integers(60, 91, size=size)
+    return {
+        'user_id': np.repeat(user_ids, n),
+        'date': np.sort(_random_dates(rng, size).reshape(len(user_ids), n), axis=1).ravel(),
+        'weight': weight,
+        'bmi': np.round(weight / height ** 2, 2),
+        'heart_rate': rng.integers(60, 101, size=size),
+        'blood_pressure': np.char.add(np.char.add(systolic.astype(str), '/'), diastolic.astype(str)),
+        'systolic': systolic,
+        'diastolic': diastolic,
+    }
+
+def bulk_load(n_users, workouts=50, nutrition_logs=150, sleep_records=100, health_metrics=50,
+              chunk_size=50000, commit_interval=10, seed=None, bind=None, defer_summaries=False):
+    """
+    Seeds `n_users` new users plus their child rows using vectorized generation and batched inserts.
+    Users are processed in blocks sized so that no single executemany exceeds `chunk_size` rows, and the
+    transaction is committed every `commit_interval` blocks. Returns the number of rows written per table.
+    With `defer_summaries` the Daily_User_Summary and User_Metric_State insert triggers are dropped for the load and
+    both are rebuilt in one pass afterwards, which is faster for large fixtures (but not safe with concurrent writers).
+    Without `bind` and with sharding enabled, every block is split by shard and written to each shard's file.
+    """
+    binds = [bind] if bind is not None else shards.engines or [engine]
+    if defer_summaries:
+        for target in binds:
+            with target.begin() as connection:
+                for table in SUMMARY_SOURCES:
+                    connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {summary_trigger_name(table, 'insert')}")
+                connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {METRIC_STATE_TRIGGER}")
+        try:
+            return bulk_load(n_users, workouts, nutrition_logs, sleep_records, health_metrics,
+                             chunk_size, commit_interval, seed, bind)
+        finally:
+            for target in binds:
+                with target.begin() as connection:
+                    for statement in summary_trigger_ddl() + metric_state_trigger_ddl():
+                        connection.exec_driver_sql(statement)
+                rebuild_daily_summaries(target)
+                rebuild_metric_states(target)
+
+    rng = np.random.default_rng(seed)
+    name_pool = np.array([fake_name() for _ in range(min(n_users, 1000))])
+    per_user = max(workouts, nutrition_logs, sleep_records, health_metrics, 1)
+    users_per_block = max(1, chunk_size // per_user)
+    counts = {'Users': 0, 'Workouts': 0, 'Nutrition': 0, 'Sleep': 0, 'Health_Metrics': 0}
+
+    with ExitStack() as stack:
+        connections = [stack.enter_context(target.connect()) for target in binds]
+        # New ids continue after the largest id on any shard, so ids stay unique across shards.
+        first_id = max(connection.execute(select(func.max(User.user_id))).scalar() or 0 for connection in connections) + 1
+        transactions = [connection.begin() for connection in connections]
+        for block_number, offset in enumerate(range(0, n_users, users_per_block), start=1):
+            users = generate_user_block(rng, first_id + offset, min(users_per_block, n_users - offset), name_pool)
+            user_ids = users['user_id']
+            blocks = [
+                (User, users),
+                (Workout, generate_workout_block(rng, user_ids, workouts) if workouts else None),
+                (Nutrition, generate_nutrition_block(rng, user_ids, nutrition_logs) if nutrition_logs else None),
+                (Sleep, generate_sleep_block(rng, user_ids, sleep_records) if sleep_records else None),
+                (HealthMetrics, generate_health_metric_block(rng, user_ids, users['height'], health_metrics) if health_metrics else None),
+            ]
+            for model, columns in blocks:
+                if columns is None:
+                    continue
+                shard_of_row = columns['user_id'] % len(connections)
+                for index, connection in enumerate(connections):
+                    rows = shard_of_row == index
+                    part = columns if len(connections) == 1 else {key: values[rows] for key, values in columns.items()}
+                    counts[model.__tablename__] += _insert_columns(connection, model.__table__, part)
+            if block_number % commit_interval == 0:
+                for index, connection in enumerate(connections):
+                    transactions[index].commit()
+                    transactions[index] = connection.begin()
+        for transaction in transactions:
+            transaction.commit()
+    # These inserts bypass the ORM flush events that invalidate cached results per user.
+    result_cache.clear()
+    return counts
+
+def parse_args(argv=None, prog=None):
+    """
+    Parses the command-line options; `--users` is the scale parameter for both the ORM and bulk paths.
+    """
+    parser = argparse.ArgumentParser(prog=prog, description="Populate the health and fitness database with sample data.")
+    parser.add_argument('--users', type=int, default=10, help="number of users to generate")
+    parser.add_argument('--workouts', type=int, default=50, help="workouts per user")
+    parser.add_argument('--nutrition', type=int, default=150, help="nutrition logs per user")
+    parser.add_argument('--sleep', type=int, default=100, help="sleep records per user")
+    parser.add_argument('--metrics', type=int, default=50, help="health metric records per user")
+    parser.add_argument('--bulk', action='store_true', help="use the vectorized bulk-load path")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="maximum rows per executemany batch (bulk only)")
+    parser.add_argument('--commit-interval', type=int, default=10, help="batches per transaction (bulk only)")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for reproducible fixtures (bulk only)")
+    parser.add_argument('--defer-summaries', action='store_true', help="rebuild the daily rollup and metric states after loading instead of per row (bulk only)")
+    return parser.parse_args(argv)
+
+def main(argv=None, prog=None):
+    args = parse_args(argv, prog)
+    if args.bulk:
+        started = time.perf_counter()
+        counts = bulk_load(args.users, args.workouts, args.nutrition, args.sleep, args.metrics,
+                           chunk_size=args.chunk_size, commit_interval=args.commit_interval, seed=args.seed,
+                           defer_summaries=args.defer_summaries)
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        print(f"Inserted {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s): {counts}")
+    else:
+        # Generate sample data to populate the database, ensuring a variety of user profiles and activities for testing.
+        generate_users(args.users)  # Generate 10 sample users by default
+        generate_workouts(args.workouts)  # Generate 50 workouts per user by default
+        generate_nutrition_logs(args.nutrition)  # Generate 150 nutrition logs per user by default
+        generate_sleep_records(args.sleep)  # Generate 100 sleep records per user by default
+        generate_health_metrics(args.metrics)  # Generate 50 health metrics records per user by default
 
 if __name__ == '__main__':
-    # Generate sample data to populate the database, ensuring a variety of user profiles and activities for testing.
-    generate_users(10)  # Generate 10 sample users
-    generate_workouts(50)  # Generate 50 workouts per user
-    generate_nutrition_logs(150)  # Generate 150 nutrition logs per user
-    generate_sleep_records(100)  # Generate 100 sleep records per user
-    generate_health_metrics(50)  # Generate 50 health metrics records per user
+    main()
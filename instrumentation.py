@@ -0,0 +1,177 @@
+from create import Base, Session, shards
+from sqlalchemy import event
+from collections import Counter, deque
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Frames from these files are skipped when attributing a statement to the application function that issued it.
+_SKIPPED_PATHS = (
+    os.path.dirname(sys.modules['sqlalchemy'].__file__),
+    os.path.abspath(__file__),
+    os.path.abspath(contextlib.__file__),
+)
+
+def _calling_function():
+    """
+    Returns 'module.function' of the innermost frame outside SQLAlchemy, contextlib and this module.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(_SKIPPED_PATHS):
+            return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return '?'
+
+class QueryProfiler:
+    """
+    Opt-in statement profiler built on the engine's before/after_cursor_execute events.
+    Records every statement's SQL, parameters, latency, affected row count and calling function, counts ORM objects
+    hydrated by each statement, and flags SQL that repeats within the profiled operation (the N+1 signature of lazy
+    loads through relationships such as User.workouts). Use it as a context manager around one logical operation,
+    or call start()/stop() to profile a long-running process. Without `bind` it listens on Session's engine and,
+    with sharding enabled, on every shard engine; scatter() work running in pool processes is not seen.
+    Statistics are aggregated per SQL string as statements run; only the last `max_records` raw records are kept.
+    """
+
+    def __init__(self, bind=None, n_plus_one_threshold=3, current_thread_only=True, max_records=10000):
+        self.bind = bind
+        self._binds = []
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.thread = threading.current_thread() if current_thread_only else None
+        self.records = deque(maxlen=max_records)
+        self.hydrated = Counter()
+        self._aggregated = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._active = False
+
+    def _tracked(self):
+        return self.thread is None or threading.current_thread() is self.thread
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._tracked():
+            self._local.started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self._tracked() or getattr(self._local, 'started', None) is None:
+            return
+        record = {
+            'sql': statement,
+            'parameters': parameters,
+            'duration_ms': (time.perf_counter() - self._local.started) * 1000,
+            'rows': cursor.rowcount if cursor.rowcount >= 0 else None,  # DML only; SELECTs report hydration below
+            'hydrated': 0,
+            'caller': _calling_function(),
+        }
+        self._local.started = None
+        self._local.last_record = record
+        with self._lock:
+            self.records.append(record)
+            entry = self._aggregated.setdefault(statement, {
+                'sql': statement, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'hydrated': 0,
+                'callers': Counter()})
+            entry['calls'] += 1
+            entry['total_ms'] += record['duration_ms']
+            entry['max_ms'] = max(entry['max_ms'], record['duration_ms'])
+            entry['rows'] += record['rows'] or 0
+            entry['callers'][record['caller']] += 1
+
+    def _on_load(self, target, context):
+        if not self._tracked():
+            return
+        record = getattr(self._local, 'last_record', None)
+        with self._lock:
+            if record is not None:
+                record['hydrated'] += 1
+                self._aggregated[record['sql']]['hydrated'] += 1
+            self.hydrated[type(target).__name__] += 1
+
+    def start(self):
+        if not self._active:
+            # Resolved at start, since Session and the shards can be rebound between operations.
+            binds = [self.bind] if self.bind is not None else [Session.kw['bind']] + shards.engines
+            self._binds = list(dict.fromkeys(binds))
+            for bind in self._binds:
+                event.listen(bind, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(bind, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Base, 'load', self._on_load, propagate=True)
+            self._active = True
+        return self
+
+    def stop(self):
+        if self._active:
+            for bind in self._binds:
+                event.remove(bind, 'before_cursor_execute', self._before_cursor_execute)
+                event.remove(bind, 'after_cursor_execute', self._after_cursor_execute)
+            self._binds = []
+            event.remove(Base, 'load', self._on_load)
+            self._active = False
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """
+        Per distinct SQL string of every profiled statement: calls, total/max latency, rows, hydrated objects and
+        callers. Sorted by total time, slowest first.
+        """
+        with self._lock:
+            aggregated = [dict(entry, callers=Counter(entry['callers'])) for entry in self._aggregated.values()]
+        return sorted(aggregated, key=lambda entry: entry['total_ms'], reverse=True)
+
+    def n_plus_one(self):
+        """
+        Statements issued at least `n_plus_one_threshold` times with identical SQL inside the profiled operation.
+        """
+        return [entry for entry in self.stats() if entry['calls'] >= self.n_plus_one_threshold]
+
+    def summary(self):
+        stats = self.stats()
+        with self._lock:
+            hydrated = dict(self.hydrated)
+        return {
+            'statements': sum(entry['calls'] for entry in stats),
+            'total_ms': sum(entry['total_ms'] for entry in stats),
+            'hydrated': hydrated,
+            'n_plus_one': [{'sql': entry['sql'], 'calls': entry['calls'], 'callers': dict(entry['callers'])}
+                           for entry in self.n_plus_one()],
+        }
+
+    def report(self, limit=10):
+        """
+        Human-readable summary of the slowest statements and any N+1 suspects.
+        """
+        summary = self.summary()
+        lines = [f"{summary['statements']} statements, {summary['total_ms']:.2f} ms, hydrated {summary['hydrated'] or 'nothing'}"]
+        for entry in self.stats()[:limit]:
+            callers = ', '.join(entry['callers'])
+            lines.append(f"{entry['calls']:>5}x {entry['total_ms']:>9.2f} ms  [{callers}]  {' '.join(entry['sql'].split())[:120]}")
+        for suspect in summary['n_plus_one']:
+            lines.append(f"N+1 suspect: {suspect['calls']} identical statements from {', '.join(suspect['callers'])}")
+        return '\n'.join(lines)
+
+def profile(bind=None, n_plus_one_threshold=3, current_thread_only=True, max_records=10000):
+    """
+    Context manager profiling the statements issued inside the block:
+
+        with profile() as profiler:
+            get_fitness_recommendations(user_id)
+        print(profiler.report())
+    """
+    return QueryProfiler(bind, n_plus_one_threshold, current_thread_only, max_records)
+
+def profile_call(function, *args, **kwargs):
+    """
+    Calls `function(*args, **kwargs)` under a profiler and returns (result, profiler).
+    """
+    with profile() as profiler:
+        result = function(*args, **kwargs)
+    return result, profiler
@@ -0,0 +1,237 @@
+from create import Base, Session, Nutrition, create_app_engine, session_scope, shards
+from insert_data import bulk_load
+from query_data import get_average_daily_calories, analyze_sleep_quality, analyze_health_metric_trends
+from recommendations import get_fitness_recommendations, get_nutrition_recommendations
+from cache import result_cache
+import async_queries
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+# The read mix a dashboard request issues; each reader thread cycles through it for random users.
+READ_MIX = [
+    lambda user_id: get_average_daily_calories(user_id, 7),
+    lambda user_id: analyze_sleep_quality(user_id, 30),
+    get_fitness_recommendations,
+    get_nutrition_recommendations,
+]
+
+def _reader(user_count, stop, counts, index):
+    """
+    Issues read-mix calls for random users until `stop` is set, counting completed calls in counts[index].
+    """
+    rng = random.Random(index)
+    while not stop.is_set():
+        rng.choice(READ_MIX)(rng.randint(1, user_count))
+        counts[index] += 1
+
+def _writer(user_count, stop, counts, index, batch=10):
+    """
+    Keeps inserting nutrition logs in small transactions until `stop` is set, counting inserted rows in counts[index].
+    """
+    rng = random.Random(-1)
+    while not stop.is_set():
+        _log_snacks(rng, rng.randint(1, user_count), batch)
+        counts[index] += batch
+
+def _log_snacks(rng, user_id, batch):
+    """
+    Inserts `batch` nutrition logs for one user in one transaction on the user's shard.
+    """
+    with session_scope(user_id) as session:
+        session.add_all([
+            Nutrition(user_id=user_id, date=datetime.now(), type='Snack',
+                      calories=rng.randint(100, 800), protein=10.0, carbs=20.0, fats=5.0)
+            for _ in range(batch)
+        ])
+
+def measure(reader_threads, user_count, duration):
+    """
+    Runs `reader_threads` readers next to one writer for `duration` seconds and returns reads/s and writes/s.
+    """
+    stop = threading.Event()
+    counts = [0] * (reader_threads + 1)
+    threads = [threading.Thread(target=_reader, args=(user_count, stop, counts, i)) for i in range(reader_threads)]
+    threads.append(threading.Thread(target=_writer, args=(user_count, stop, counts, reader_threads)))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'readers': reader_threads, 'reads_per_sec': sum(counts[:-1]) / elapsed, 'writes_per_sec': counts[-1] / elapsed}
+
+@contextmanager
+def seeded_database(users, pool_size):
+    """
+    Seeds a throwaway database with `users` users and points the shared Session at it for the duration of the block.
+    """
+    original_bind = Session.kw['bind']
+    with tempfile.TemporaryDirectory() as directory:
+        load_engine = create_app_engine(f"sqlite:///{os.path.join(directory, 'load_test.db')}", pool_size=pool_size)
+        Base.metadata.create_all(load_engine)
+        bulk_load(users, seed=0, bind=load_engine)
+        Session.configure(bind=load_engine)
+        try:
+            # The query functions print their results; keep the report readable.
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                yield load_engine
+        finally:
+            Session.configure(bind=original_bind)
+            load_engine.dispose()
+
+@contextmanager
+def result_cache_disabled():
+    """
+    Turns the result cache off for the duration of the block, so every call reaches the database.
+    """
+    maxsize = result_cache.maxsize
+    result_cache.maxsize = 0
+    result_cache.clear()
+    try:
+        yield
+    finally:
+        result_cache.maxsize = maxsize
+
+def run_load_test(reader_counts=(1, 2, 4, 8), duration=3.0, users=200):
+    """
+    Measures read throughput on a seeded database for each reader thread count while a writer keeps inserting
+    nutrition logs. The result cache is disabled, so the readers measure SQLite concurrency rather than cache hits.
+    """
+    with result_cache_disabled(), seeded_database(users, max(reader_counts) + 1):
+        return [measure(readers, users, duration) for readers in reader_counts]
+
+# The blocking calls behind one dashboard request, as an async server runs them when it wraps each in a thread.
+SYNC_DASHBOARD = [
+    lambda user_id: get_average_daily_calories(user_id, 7),
+    lambda user_id: analyze_sleep_quality(user_id, 30),
+    lambda user_id: analyze_health_metric_trends(user_id, 'weight'),
+    get_fitness_recommendations,
+    get_nutrition_recommendations,
+]
+
+async def _thread_wrapped_dashboard(executor, user_id):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(executor, call, user_id) for call in SYNC_DASHBOARD))
+
+async def _drive(dashboard, clients, user_count, duration):
+    """
+    Runs `clients` concurrent tasks that each request dashboards for random users until `duration` seconds pass.
+    Returns the number of dashboards served.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    served = [0] * clients
+
+    async def client(index):
+        rng = random.Random(index)
+        while loop.time() < deadline:
+            await dashboard(rng.randint(1, user_count))
+            served[index] += 1
+
+    await asyncio.gather(*(client(index) for index in range(clients)))
+    return sum(served)
+
+async def _measure_dashboards(clients, user_count, duration, executor):
+    try:
+        native = await _drive(async_queries.get_dashboard, clients, user_count, duration)
+        wrapped = await _drive(lambda user_id: _thread_wrapped_dashboard(executor, user_id), clients, user_count, duration)
+    finally:
+        await async_queries.dispose_async_engines()
+    return {'clients': clients, 'async_per_sec': native / duration, 'threaded_per_sec': wrapped / duration}
+
+def run_dashboard_comparison(client_counts=(1, 4, 16), duration=3.0, users=200, pool_size=16):
+    """
+    Compares dashboard requests per second served by async_queries.get_dashboard against the same calls run
+    through a thread pool, for each number of concurrent clients. Both paths get `pool_size` connections (and the
+    thread pool as many threads), and the result cache is disabled so every request reaches the database.
+    """
+    with result_cache_disabled(), seeded_database(users, pool_size), ThreadPoolExecutor(max_workers=pool_size) as executor:
+        return [asyncio.run(_measure_dashboards(clients, users, duration, executor)) for clients in client_counts]
+
+@contextmanager
+def sharded_database(users, shard_count):
+    """
+    Creates a throwaway database split into `shard_count` shard files (one plain file for 1), seeds it with `users`
+    users and points the shard router and Session at it for the duration of the block. Yields the database URL.
+    """
+    original_bind, original_url, original_count = Session.kw['bind'], shards.url, shards.count
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'ingest.db')}"
+        plain_engine = create_app_engine(url)
+        shards.configure(url, shard_count)
+        Session.configure(bind=plain_engine)
+        try:
+            for target in shards.engines or [plain_engine]:
+                Base.metadata.create_all(target)
+            bulk_load(users, 0, 0, 0, 0, seed=0, bind=None if shards.sharded else plain_engine)
+            yield url
+        finally:
+            shards.configure(original_url, original_count)
+            Session.configure(bind=original_bind)
+            plain_engine.dispose()
+
+def _ingest_writer(task):
+    """
+    Process-pool task: logs snacks for random users in `batch`-row transactions for `duration` seconds on the
+    database at `url` split into `shard_count` shards. Returns the number of rows written.
+    """
+    url, shard_count, user_count, duration, batch, seed = task
+    shards.configure(url, shard_count, pool_size=1)
+    Session.configure(bind=create_app_engine(url, pool_size=1))
+    rng = random.Random(seed)
+    rows = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        _log_snacks(rng, rng.randint(1, user_count), batch)
+        rows += batch
+    return rows
+
+def run_ingest_benchmark(shard_counts=(1, 2, 4), writers=4, duration=3.0, users=200, batch=10):
+    """
+    Measures write throughput (rows/s) of `writers` processes logging nutrition rows for random users, for each
+    shard count. With one shard every commit queues on the same write lock; with N shards up to N commit at once.
+    """
+    results = []
+    for shard_count in shard_counts:
+        with sharded_database(users, shard_count) as url:
+            tasks = [(url, shard_count, users, duration, batch, seed) for seed in range(writers)]
+            with ProcessPoolExecutor(max_workers=writers) as pool:
+                rows = sum(pool.map(_ingest_writer, tasks))
+        results.append({'shards': shard_count, 'writers': writers, 'rows_per_sec': rows / duration})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure read throughput under a concurrent writer.")
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 2, 4, 8], help="reader thread counts to test")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per measurement")
+    parser.add_argument('--users', type=int, default=200, help="users in the seeded database")
+    parser.add_argument('--dashboards', action='store_true',
+                        help="compare async and thread-wrapped dashboard throughput instead (--readers sets the client counts)")
+    parser.add_argument('--ingest', action='store_true', help="measure write throughput per shard count instead")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help="shard counts to test (--ingest)")
+    parser.add_argument('--writers', type=int, default=4, help="writer processes (--ingest)")
+    args = parser.parse_args()
+    if args.ingest:
+        # Shards only commit in parallel when there are cores to run the writers on.
+        print(f"{os.cpu_count()} CPUs")
+        print(f"{'shards':>8} {'writers':>8} {'rows/s':>10}")
+        for result in run_ingest_benchmark(args.shards, args.writers, args.duration, args.users):
+            print(f"{result['shards']:>8} {result['writers']:>8} {result['rows_per_sec']:>10.0f}")
+    elif args.dashboards:
+        print(f"{'clients':>8} {'async/s':>10} {'threads/s':>10}")
+        for result in run_dashboard_comparison(args.readers, args.duration, args.users):
+            print(f"{result['clients']:>8} {result['async_per_sec']:>10.0f} {result['threaded_per_sec']:>10.0f}")
+    else:
+        print(f"{'readers':>8} {'reads/s':>10} {'writes/s':>10}")
+        for result in run_load_test(args.readers, args.duration, args.users):
+            print(f"{result['readers']:>8} {result['reads_per_sec']:>10.0f} {result['writes_per_sec']:>10.0f}")
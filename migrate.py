@@ -0,0 +1,363 @@
+from create import (Base, DailyUserSummary, HealthMetrics, SUMMARY_SOURCES, STORAGE, COMPACT_STORAGE, EPOCH_JULIAN_DAY,
+                    DayNumber, create_app_engine, engine, shards, parse_blood_pressure, summary_trigger_ddl, summary_trigger_name,
+                    RECOMMENDATION_SOURCES, recommendation_trigger_ddl, recommendation_trigger_name, UserMetricState,
+                    STREAM_METRICS, METRIC_STATE_ALPHA, METRIC_ALERT_RULES, ALERT_SIGMAS, ALERT_MIN_READINGS,
+                    METRIC_STATE_TRIGGER, metric_state_trigger_ddl)
+from partitions import archive_schema, archive_years, attach_archives
+from cache import result_cache
+from sqlalchemy import inspect, select, update, bindparam, Date
+from sqlalchemy.schema import CreateColumn
+import argparse
+import os
+
+def add_missing_columns(bind=engine):
+    """
+    Adds columns declared on the models that are missing from existing tables (SQLite ALTER TABLE ADD COLUMN).
+    Existing rows get NULL, so only nullable columns can be added this way. Returns the added 'table.column' names.
+    """
+    added = []
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {definition}')
+                    added.append(f"{table.name}.{column.name}")
+    return added
+
+def create_missing_indexes(bind=engine):
+    """
+    Creates every index declared on the models that is missing from an existing database.
+    `Base.metadata.create_all` only builds indexes together with new tables, so databases created before an
+    index was declared (e.g. an older health_fitness_app.db) need this step. Returns the names of the created indexes.
+    """
+    created = []
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+                    created.append(index.name)
+        if created:
+            # Refresh the planner statistics so SQLite can weigh the new indexes against each other.
+            connection.exec_driver_sql("ANALYZE")
+    return created
+
+def rebuild_daily_summaries(bind=engine):
+    """
+    Recomputes Daily_User_Summary from scratch with one GROUP BY pass per source table and partition (the hot
+    tables plus every archive written by partitions.compact). The triggers keep the rollup current afterwards;
+    a rebuild is only needed to backfill a new summary table or to repair it (e.g. after rows were written with
+    the triggers dropped). Returns the number of summary rows.
+    """
+    schemas = ['main'] + [archive_schema(year) for year in archive_years(bind)]
+    with bind.connect() as connection:
+        attach_archives(connection, [int(schema[len('archive_'):]) for schema in schemas[1:]])
+        with connection.begin():
+            connection.exec_driver_sql("DELETE FROM Daily_User_Summary")
+            for table, contributions in SUMMARY_SOURCES.items():
+                columns = ", ".join(contributions)
+                sums = ", ".join(f"SUM({expression.format(row=table)})" for expression in contributions.values())
+                # Partitions of one table can share a day, so later passes add to what earlier ones wrote.
+                updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in contributions)
+                for schema in schemas:
+                    connection.exec_driver_sql(
+                        f"INSERT INTO main.Daily_User_Summary (user_id, date, {columns}) "
+                        f"SELECT user_id, date, {sums} FROM {schema}.{table} AS {table} WHERE user_id IS NOT NULL "
+                        f"GROUP BY user_id, date ON CONFLICT (user_id, date) DO UPDATE SET {updates}")
+            count = connection.exec_driver_sql("SELECT COUNT(*) FROM Daily_User_Summary").scalar()
+    # Core writes skip the ORM flush events that invalidate cached results.
+    result_cache.clear()
+    return count
+
+def _replay_reading(state, reading, alerts):
+    """
+    Python twin of the Health_Metrics insert trigger: appends the alerts `reading` raises to `alerts` and folds it
+    into `state` (a dict of User_Metric_State columns).
+    """
+    alpha = METRIC_STATE_ALPHA
+    for metric in STREAM_METRICS:
+        value = reading[metric]
+        if value is None:
+            continue
+        readings, average = state[f'{metric}_readings'], state[f'{metric}_average']
+        rule = METRIC_ALERT_RULES.get(metric)
+        if rule and readings >= ALERT_MIN_READINGS:
+            direction, minimum = rule
+            deviation = value - average
+            distance = deviation if direction == 'rise' else abs(deviation)
+            if distance > minimum and deviation * deviation > ALERT_SIGMAS ** 2 * state[f'{metric}_variance']:
+                alerts.append((reading['user_id'], reading['metric_id'], reading['date'], metric, value, average,
+                               state[f'{metric}_variance']))
+        if readings == 0:
+            state[f'{metric}_average'], state[f'{metric}_variance'] = value, 0.0
+        else:
+            deviation = value - average
+            state[f'{metric}_average'] = average + alpha * deviation
+            state[f'{metric}_variance'] = (1 - alpha) * (state[f'{metric}_variance'] + alpha * deviation * deviation)
+        state[f'{metric}_readings'] = readings + 1
+        state[f'last_{metric}'] = value
+    state['last_metric_id'], state['last_date'] = reading['metric_id'], reading['date']
+
+def new_metric_state(user_id):
+    """
+    The User_Metric_State row of `user_id` before any reading, as a dict of its columns.
+    """
+    state = {column.name: None for column in UserMetricState.__table__.columns}
+    state.update({f'{metric}_readings': 0 for metric in STREAM_METRICS}, user_id=user_id, stale=False)
+    return state
+
+def replay_metric_state(user_id, readings):
+    """
+    Replays `readings` of `user_id` (mappings of user_id, metric_id, date and the STREAM_METRICS values, in date and
+    metric_id order) like the insert trigger. Returns the state (a dict of User_Metric_State columns) and the alerts
+    (Health_Metric_Alerts rows without alert_id).
+    """
+    state, alerts = new_metric_state(user_id), []
+    for reading in readings:
+        _replay_reading(state, reading, alerts)
+    return state, alerts
+
+def rebuild_metric_states(bind=engine, batch_size=10000, stale_only=False):
+    """
+    Recomputes User_Metric_State and Health_Metric_Alerts by replaying every Health_Metrics reading (hot tables and
+    archives) per user in date and metric_id order through the same updates and alert rules as the insert trigger.
+    Readings are streamed, so memory holds one user's state plus a batch of rows to write. Needed to backfill new
+    tables or after loading with the trigger dropped; with `stale_only` only the users whose state the triggers
+    marked stale (readings inserted out of date order, edited or deleted) are replayed. Returns the number of users
+    replayed.
+    """
+    schemas = ['main'] + [archive_schema(year) for year in archive_years(bind)]
+    state_columns = [column.name for column in UserMetricState.__table__.columns]
+    users_filter = "user_id IN (SELECT user_id FROM temp.stale_users)" if stale_only else "user_id IS NOT NULL"
+    readings = " UNION ALL ".join(
+        f"SELECT user_id, metric_id, date, {', '.join(STREAM_METRICS)} FROM {schema}.Health_Metrics WHERE {users_filter}"
+        for schema in schemas)
+    insert_state = (f"INSERT INTO User_Metric_State ({', '.join(state_columns)}) "
+                    f"VALUES ({', '.join('?' * len(state_columns))})")
+    insert_alert = ("INSERT INTO Health_Metric_Alerts (user_id, metric_id, date, metric, value, average, variance) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)")
+    with bind.connect() as connection:
+        attach_archives(connection, [int(schema[len('archive_'):]) for schema in schemas[1:]])
+        with connection.begin():
+            if stale_only:
+                connection.exec_driver_sql(
+                    "CREATE TEMP TABLE stale_users AS SELECT user_id FROM main.User_Metric_State WHERE stale")
+            connection.exec_driver_sql(f"DELETE FROM Health_Metric_Alerts WHERE {users_filter}")
+            connection.exec_driver_sql(f"DELETE FROM User_Metric_State WHERE {users_filter}")
+            states, alerts, state, users = [], [], None, 0
+            # The pysqlite cursor steps through the sorted readings as they are iterated; the writes use other cursors.
+            for row in connection.exec_driver_sql(f"{readings} ORDER BY user_id, date, metric_id"):
+                reading = row._mapping
+                if state is None or state['user_id'] != reading['user_id']:
+                    if state is not None:
+                        states.append(tuple(state[column] for column in state_columns))
+                    state = new_metric_state(reading['user_id'])
+                    users += 1
+                _replay_reading(state, reading, alerts)
+                if len(states) >= batch_size:
+                    connection.exec_driver_sql(insert_state, states)
+                    states = []
+                if len(alerts) >= batch_size:
+                    connection.exec_driver_sql(insert_alert, alerts)
+                    alerts = []
+            if state is not None:
+                states.append(tuple(state[column] for column in state_columns))
+            if states:
+                connection.exec_driver_sql(insert_state, states)
+            if alerts:
+                connection.exec_driver_sql(insert_alert, alerts)
+            if stale_only:
+                connection.exec_driver_sql("DROP TABLE temp.stale_users")
+    result_cache.clear()
+    return users
+
+def backfill_blood_pressure(bind=engine, batch_size=10000):
+    """
+    Fills systolic/diastolic from the blood_pressure strings of rows written before those columns existed.
+    Rows are walked in metric_id order in batches of `batch_size`, each committed on its own, so the backfill holds
+    the write lock only briefly and can resume after an interruption. Malformed readings stay NULL.
+    Returns the number of rows updated.
+    """
+    table = HealthMetrics.__table__
+    statement = update(table).where(table.c.metric_id == bindparam('row_id')).values(
+        systolic=bindparam('new_systolic'), diastolic=bindparam('new_diastolic'))
+    updated, last_id = 0, 0
+    while True:
+        with bind.begin() as connection:
+            rows = connection.execute(
+                select(table.c.metric_id, table.c.blood_pressure).where(
+                    table.c.metric_id > last_id,
+                    table.c.systolic.is_(None),
+                    table.c.blood_pressure.isnot(None)
+                ).order_by(table.c.metric_id).limit(batch_size)).fetchall()
+            if not rows:
+                if updated:
+                    # Core updates skip the ORM flush events that invalidate cached results.
+                    result_cache.clear()
+                return updated
+            last_id = rows[-1].metric_id
+            parameters = []
+            for row in rows:
+                systolic, diastolic = parse_blood_pressure(row.blood_pressure)
+                if systolic is not None:
+                    parameters.append({'row_id': row.metric_id, 'new_systolic': systolic, 'new_diastolic': diastolic})
+            if parameters:
+                connection.execute(statement, parameters)
+                updated += len(parameters)
+
+def storage_layout(connection, schema='main'):
+    """
+    Storage layout ('standard' or 'compact') of the database attached as `schema`, judged by how Workouts.date is
+    declared; None when there is no Workouts table yet.
+    """
+    columns = {row[1]: row[2].upper() for row in connection.exec_driver_sql(f'PRAGMA {schema}.table_info("Workouts")')}
+    if 'date' not in columns:
+        return None
+    return 'compact' if columns['date'] == 'INTEGER' else 'standard'
+
+def _converted(column, source_compact):
+    """
+    SQL turning a source column into the value the target column stores, for a source in the other layout.
+    """
+    name = f'"{column.name}"'
+    if source_compact == COMPACT_STORAGE:
+        return name
+    if isinstance(column.type, (Date, DayNumber)):
+        if COMPACT_STORAGE:
+            return f"CAST(julianday({name}) - {EPOCH_JULIAN_DAY} AS INTEGER)"
+        return f"date({name} + {EPOCH_JULIAN_DAY})"
+    choices = column.info.get('choices')
+    if choices and COMPACT_STORAGE:
+        return f"CASE {name} {' '.join(f'WHEN {choice!r} THEN {code}' for code, choice in enumerate(choices))} END"
+    if choices:
+        return f"CASE {name} {' '.join(f'WHEN {code} THEN {choice!r}' for code, choice in enumerate(choices))} END"
+    return name
+
+def _check_encodable(connection, table, columns):
+    """
+    Raises ValueError if a category column of the attached source table holds a value outside its choices.
+    """
+    for column in columns:
+        choices = column.info.get('choices')
+        if not choices:
+            continue
+        unknown = connection.exec_driver_sql(
+            f'SELECT DISTINCT "{column.name}" FROM source."{table.name}" '
+            f'WHERE "{column.name}" NOT IN ({", ".join("?" * len(choices))})', choices).fetchall()
+        if unknown:
+            raise ValueError(f"{table.name}.{column.name} holds values the compact layout cannot encode: "
+                             f"{', '.join(repr(row[0]) for row in unknown)}")
+
+def convert_storage(source_path, target_path):
+    """
+    Copies the database at `source_path` (in either storage layout) into a new database at `target_path` in this
+    process's layout (HEALTH_FITNESS_STORAGE). Rows are converted in SQL, table by table, with the rollup triggers
+    dropped; the rollup is rebuilt and planner statistics refreshed at the end. Raises ValueError if a category
+    column holds a value the compact layout cannot encode. Archive databases written by partitions.compact are not
+    copied. Returns the number of rows copied per table.
+    """
+    if os.path.exists(target_path):
+        raise FileExistsError(f"{target_path} already exists")
+    target_engine = create_app_engine(f"sqlite:///{target_path}")
+    counts = {}
+    try:
+        Base.metadata.create_all(target_engine)
+        with target_engine.connect() as connection:
+            connection.exec_driver_sql("ATTACH DATABASE ? AS source", (source_path,))
+            source_compact = storage_layout(connection, 'source') == 'compact'
+            source_tables = {row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM source.sqlite_master WHERE type = 'table'")}
+            with connection.begin():
+                for table in SUMMARY_SOURCES:
+                    connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {summary_trigger_name(table, 'insert')}")
+                # Stored recommendations are copied with their watermarks instead of being created by the log inserts.
+                for table in RECOMMENDATION_SOURCES:
+                    connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {recommendation_trigger_name(table, 'insert')}")
+                # So is the metric state, with the alerts it raised.
+                connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {METRIC_STATE_TRIGGER}")
+                for table in Base.metadata.sorted_tables:
+                    if table is DailyUserSummary.__table__ or table.name not in source_tables:
+                        continue
+                    source_columns = {row[1] for row in connection.exec_driver_sql(f'PRAGMA source.table_info("{table.name}")')}
+                    columns = [column for column in table.columns if column.name in source_columns]
+                    if COMPACT_STORAGE and not source_compact:
+                        _check_encodable(connection, table, columns)
+                    names = ", ".join(f'"{column.name}"' for column in columns)
+                    values = ", ".join(_converted(column, source_compact) for column in columns)
+                    counts[table.name] = connection.exec_driver_sql(
+                        f'INSERT INTO main."{table.name}" ({names}) SELECT {values} FROM source."{table.name}"').rowcount
+                for statement in summary_trigger_ddl() + recommendation_trigger_ddl() + metric_state_trigger_ddl():
+                    connection.exec_driver_sql(statement)
+            connection.exec_driver_sql("DETACH DATABASE source")
+        rebuild_daily_summaries(target_engine)
+        if UserMetricState.__tablename__ not in source_tables:
+            rebuild_metric_states(target_engine)
+        backfill_blood_pressure(target_engine)
+        with target_engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        target_engine.dispose()
+    # The converted file may replace the one cached results were read from.
+    result_cache.clear()
+    return counts
+
+def migrate(bind=engine):
+    """
+    Brings an existing database up to the current schema: creates missing tables (backfilling a newly created
+    Daily_User_Summary and User_Metric_State), adds missing columns, creates missing indexes and backfills the
+    numeric blood pressure columns.
+    Returns the names of the created indexes. Refuses a database in the other storage layout; use convert_storage.
+    """
+    with bind.connect() as connection:
+        layout = storage_layout(connection)
+    if layout not in (None, STORAGE):
+        raise ValueError(f"The database uses the {layout} storage layout but HEALTH_FITNESS_STORAGE is {STORAGE}; "
+                         f"convert it with `python3 migrate.py --convert SOURCE TARGET`")
+    had_summary = inspect(bind).has_table(DailyUserSummary.__tablename__)
+    had_metric_state = inspect(bind).has_table(UserMetricState.__tablename__)
+    Base.metadata.create_all(bind)
+    if not had_summary:
+        rebuild_daily_summaries(bind)
+    if not had_metric_state:
+        rebuild_metric_states(bind)
+    add_missing_columns(bind)
+    created_indexes = create_missing_indexes(bind)
+    backfill_blood_pressure(bind)
+    return created_indexes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upgrade the health and fitness database in place; safe to run repeatedly.")
+    parser.add_argument('--rebuild-summaries', action='store_true', help="recompute Daily_User_Summary from the raw logs")
+    parser.add_argument('--rebuild-metric-states', action='store_true',
+                        help="replay Health_Metrics into User_Metric_State and Health_Metric_Alerts")
+    parser.add_argument('--refresh-metric-states', action='store_true',
+                        help="replay only the users whose metric state is marked stale")
+    parser.add_argument('--convert', nargs=2, metavar=('SOURCE', 'TARGET'),
+                        help="copy the SOURCE database file into a new TARGET file in the HEALTH_FITNESS_STORAGE layout")
+    args = parser.parse_args()
+    if args.convert:
+        counts = convert_storage(*args.convert)
+        print(f"Copied {sum(counts.values())} rows into {args.convert[1]} ({STORAGE} layout)")
+    else:
+        for bind in shards.engines or [engine]:
+            created_indexes = migrate(bind)
+            print(f"{bind.url.database}: created indexes: {', '.join(created_indexes) if created_indexes else 'none'}")
+            if args.rebuild_summaries:
+                print(f"{bind.url.database}: rebuilt {rebuild_daily_summaries(bind)} daily summary rows")
+            if args.rebuild_metric_states:
+                print(f"{bind.url.database}: rebuilt the metric state of {rebuild_metric_states(bind)} users")
+            elif args.refresh_metric_states:
+                print(f"{bind.url.database}: refreshed the stale metric state of "
+                      f"{rebuild_metric_states(bind, stale_only=True)} users")
@@ -0,0 +1,312 @@
+from create import Base, Session, Workout, Nutrition, Sleep, HealthMetrics, SUMMARY_SOURCES, create_app_engine, \
+    shards, summary_trigger_ddl, summary_trigger_name, RECOMMENDATION_SOURCES, recommendation_trigger_ddl, \
+    recommendation_trigger_name, metric_state_trigger_ddl, metric_state_trigger_name
+from sqlalchemy import MetaData, event, select, insert, delete, func, union_all
+from sqlalchemy.orm import aliased
+from sqlalchemy.pool import Pool
+from datetime import date, datetime, timedelta
+import argparse
+import os
+import re
+import threading
+import time
+
+# Time partitioning:
+# Rows older than HOT_DAYS are moved by compact() from the hot database into one archive file per year
+# (health_fitness_app_archive_2025.db, ...) next to it. Queries whose date range starts inside the hot window read
+# the hot tables only; longer ranges read a UNION ALL of the hot table and the archives their range overlaps.
+# Every pooled connection attaches the archives when it is checked out, before any transaction can be open, and again
+# after compaction (in this or another process) changed the archive years; the years are cached per database file
+# and listed again when the mtime of its directory changes.
+# Daily_User_Summary stays complete in the hot database.
+
+# Age (in days) after which rows move to the archives. Every query function reads at most this far back by default,
+# so none of them needs an archive unless asked for an older range or the whole history.
+HOT_DAYS = 180
+
+# Tables that are partitioned by date.
+PARTITIONED_MODELS = (Workout, Nutrition, Sleep, HealthMetrics)
+
+# SQLite attaches at most 10 databases to one connection.
+MAX_ATTACHED = 10
+
+_archive_metadata = MetaData()
+_archive_lock = threading.Lock()
+
+# (directory mtime, archive years) found next to each hot database file (by absolute path).
+_archive_catalog = {}
+
+# A listing taken within this many nanoseconds of the directory's mtime is not cached: on file systems with coarse
+# timestamps an archive created in the same tick would leave the mtime unchanged.
+_CATALOG_SETTLE_NS = 2 * 10 ** 9
+
+def hot_cutoff(today=None):
+    """
+    First date kept in the hot database.
+    """
+    return (today or date.today()) - timedelta(days=HOT_DAYS)
+
+def archive_path(bind, year):
+    """
+    Path of the archive file holding `year`'s rows of the hot database `bind`.
+    """
+    database = bind.url.database
+    if not database or database == ':memory:':
+        raise ValueError("Only file databases can be partitioned")
+    return _archive_file(database, year)
+
+def _archive_file(database, year):
+    stem, extension = os.path.splitext(database)
+    return f"{stem}_archive_{year}{extension or '.db'}"
+
+def _cataloged_years(database):
+    """
+    Sorted tuple of the years with an archive file next to `database` (an absolute path). The listing is cached per
+    file and reused while the directory's mtime is unchanged, so archives created by any process are seen.
+    """
+    directory = os.path.dirname(database)
+    mtime = os.stat(directory).st_mtime_ns
+    cached = _archive_catalog.get(database)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    listed_at = time.time_ns()
+    stem, extension = os.path.splitext(database)
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r'_archive_(\d{4})' + re.escape(extension or '.db'))
+    years = tuple(sorted(int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(directory)) if match))
+    if listed_at - mtime > _CATALOG_SETTLE_NS:
+        with _archive_lock:
+            _archive_catalog[database] = (mtime, years)
+    return years
+
+def refresh_archives(bind):
+    """
+    Drops the cached archive years of `bind`, so the next query lists them again and every pooled connection
+    re-attaches them at its next checkout if they changed. compact() and create_archive() call it; other processes
+    notice new archive files through the directory's mtime.
+    """
+    if bind.url.database and bind.url.database != ':memory:':
+        with _archive_lock:
+            _archive_catalog.pop(os.path.abspath(bind.url.database), None)
+
+def archive_years(bind, start_date=None, today=None):
+    """
+    Years with an archive file for `bind`, from the year of `start_date` (or the earliest) up to the hot cutoff.
+    """
+    if not bind.url.database or bind.url.database == ':memory:':
+        return []
+    first = start_date.year if start_date is not None else 0
+    last = hot_cutoff(today).year
+    return [year for year in _cataloged_years(os.path.abspath(bind.url.database)) if first <= year <= last]
+
+def archive_schema(year):
+    return f"archive_{year}"
+
+def archive_table(table, year):
+    """
+    The copy of `table` living in the attached archive of `year`.
+    """
+    with _archive_lock:
+        key = f"{archive_schema(year)}.{table.name}"
+        if key not in _archive_metadata.tables:
+            table.to_metadata(_archive_metadata, schema=archive_schema(year))
+        return _archive_metadata.tables[key]
+
+@event.listens_for(Pool, 'checkout')
+def _attach_on_checkout(dbapi_connection, connection_record, connection_proxy):
+    """
+    Attaches the newest MAX_ATTACHED archives of a file database to the connection being checked out, when they
+    changed since the connection last attached them. A checked-in connection has no open transaction.
+    """
+    info = connection_record.info
+    cursor = dbapi_connection.cursor()
+    try:
+        if 'database' not in info:
+            cursor.execute("PRAGMA database_list")
+            info['database'] = next((row[2] for row in cursor.fetchall() if row[1] == 'main'), '')
+        if not info['database']:
+            return
+        years = _cataloged_years(info['database'])
+        if info.get('archive_years') == years:
+            return
+        cursor.execute("PRAGMA database_list")
+        attached = {row[1] for row in cursor.fetchall()} - {'main', 'temp'}
+        wanted = {archive_schema(year): year for year in years[-MAX_ATTACHED:]}
+        for schema in attached - set(wanted):
+            cursor.execute(f"DETACH DATABASE {schema}")
+        for schema, year in wanted.items():
+            if schema not in attached:
+                cursor.execute(f"ATTACH DATABASE ? AS {schema}", (_archive_file(info['database'], year),))
+        info['archives'], info['archive_years'] = set(wanted), years
+    finally:
+        cursor.close()
+
+def attach_archives(connection, years):
+    """
+    Makes sure the archives of `years` are attached to `connection` (a SQLAlchemy Connection). Those attached at
+    checkout need no statement; others (a range over more than the newest MAX_ATTACHED years, or an archive created
+    while the connection was checked out) are attached now, which SQLite refuses inside a transaction. Archives the
+    connection no longer needs are detached first when the attach limit would be exceeded.
+    """
+    info = connection.connection.info
+    wanted = {archive_schema(year): year for year in years}
+    if len(wanted) > MAX_ATTACHED:
+        raise ValueError(f"A query can span at most {MAX_ATTACHED} archive years, not {len(wanted)}")
+    if set(wanted) <= info.get('archives', set()):
+        return
+    attached = {row[1] for row in connection.exec_driver_sql("PRAGMA database_list")} - {'main', 'temp'}
+    if len(attached | set(wanted)) > MAX_ATTACHED:
+        for schema in attached - set(wanted):
+            connection.exec_driver_sql(f"DETACH DATABASE {schema}")
+        attached &= set(wanted)
+    for schema, year in wanted.items():
+        if schema not in attached:
+            connection.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (archive_path(connection.engine, year),))
+    info['archives'] = attached | set(wanted)
+
+def partition_source(session, model, start_date=None):
+    """
+    What to select `model` rows dated from `start_date` (None: the whole history) from in `session`: the model
+    itself when the range lies inside the hot window or nothing is archived, otherwise an alias of `model` over a
+    UNION ALL of the hot table and every overlapping archive, which the session's connection attached at checkout.
+    """
+    if isinstance(start_date, datetime):
+        start_date = start_date.date()
+    if start_date is not None and start_date >= hot_cutoff():
+        return model
+    connection = session.connection()
+    years = archive_years(connection.engine, start_date)
+    if not years:
+        return model
+    attach_archives(connection, years)
+    tables = [model.__table__] + [archive_table(model.__table__, year) for year in years]
+    partitions = union_all(*(select(table) for table in tables)).subquery(f"{model.__tablename__}_partitions")
+    return aliased(model, partitions)
+
+def create_archive(bind, year):
+    """
+    Creates the archive file for `year` with the partitioned tables and their indexes, if it does not exist yet.
+    """
+    path = archive_path(bind, year)
+    if os.path.exists(path):
+        return path
+    archive_engine = create_app_engine(f"sqlite:///{path}")
+    try:
+        Base.metadata.create_all(archive_engine, tables=[model.__table__ for model in PARTITIONED_MODELS])
+    finally:
+        archive_engine.dispose()
+    refresh_archives(bind)
+    return path
+
+def _move_batch(connection, model, year, low, high, upper):
+    """
+    Moves the rows of `model` dated in `year` before `upper` with a primary key in [low, high) to the year's archive,
+    in one transaction. The rollup delete triggers are dropped inside the transaction so the archived days stay in
+    Daily_User_Summary, and so are the recommendation and metric state delete triggers, since archiving does not
+    change a user's data. Returns the number of rows moved.
+    """
+    table = model.__table__
+    key = table.primary_key.columns[0]
+    selection = (key >= low) & (key < high) & (table.c.date >= date(year, 1, 1)) & (table.c.date < upper)
+    with connection.begin():
+        if table.name in SUMMARY_SOURCES:
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {summary_trigger_name(table.name, 'delete')}")
+        if table.name in RECOMMENDATION_SOURCES:
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {recommendation_trigger_name(table.name, 'delete')}")
+        if model is HealthMetrics:
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {metric_state_trigger_name('delete')}")
+        # OR REPLACE makes a batch safe to repeat: in WAL mode a crash can commit the copy without the delete.
+        connection.execute(insert(archive_table(table, year)).prefix_with('OR REPLACE').from_select(
+            [column.name for column in table.columns], select(table).where(selection)))
+        moved = connection.execute(delete(table).where(selection)).rowcount
+        if table.name in SUMMARY_SOURCES:
+            for statement in summary_trigger_ddl():
+                connection.exec_driver_sql(statement)
+        if table.name in RECOMMENDATION_SOURCES:
+            for statement in recommendation_trigger_ddl():
+                connection.exec_driver_sql(statement)
+        if model is HealthMetrics:
+            for statement in metric_state_trigger_ddl():
+                connection.exec_driver_sql(statement)
+    return moved
+
+def compact(bind=None, batch_size=50000, today=None):
+    """
+    Moves every row older than the hot window into its year's archive, creating archive files as needed.
+    Rows are moved in primary key ranges of `batch_size`, each in its own short write transaction, so readers and
+    writers keep running. Safe to interrupt and to repeat. Returns the number of rows moved per table.
+    Without `bind` every shard is compacted when sharding is enabled, otherwise Session's database.
+    """
+    if bind is None and shards.sharded:
+        moved = {}
+        for shard_engine in shards.engines:
+            for table, count in compact(shard_engine, batch_size, today).items():
+                moved[table] = moved.get(table, 0) + count
+        return moved
+    bind = bind if bind is not None else Session.kw['bind']
+    refresh_archives(bind)
+    cutoff = hot_cutoff(today)
+    moved = {}
+    for model in PARTITIONED_MODELS:
+        table = model.__table__
+        key = table.primary_key.columns[0]
+        with bind.connect() as connection:
+            oldest, low, high = connection.execute(
+                select(func.min(table.c.date), func.min(key), func.max(key)).where(table.c.date < cutoff)).one()
+        moved[table.name] = 0
+        if oldest is None:
+            continue
+        for year in range(oldest.year, cutoff.year + 1):
+            create_archive(bind, year)
+            upper = min(date(year + 1, 1, 1), cutoff)
+            with bind.connect() as connection:
+                attach_archives(connection, [year])
+                for start in range(low, high + 1, batch_size):
+                    moved[table.name] += _move_batch(connection, model, year, start, start + batch_size, upper)
+    return moved
+
+class Compactor:
+    """
+    Background thread running compact() every `interval` seconds until stopped.
+    """
+
+    def __init__(self, bind=None, interval=3600, batch_size=50000):
+        self.bind = bind
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.moved = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self.moved += sum(compact(self.bind, self.batch_size).values())
+            self.runs += 1
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='compactor', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Move rows older than {HOT_DAYS} days into per-year archive databases.")
+    parser.add_argument('--batch-size', type=int, default=50000, help="primary key range moved per transaction")
+    parser.add_argument('--every', type=float, help="keep running, compacting every EVERY seconds")
+    args = parser.parse_args()
+    while True:
+        for table, count in compact(batch_size=args.batch_size).items():
+            print(f"{table}: moved {count} rows")
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -1,53 +1,163 @@
-from create import User, Workout, Nutrition, Sleep, HealthMetrics, engine
-from recommendations import get_fitness_recommendations, get_nutrition_recommendations
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func
-from datetime import datetime, timedelta
+from create import (User, Workout, Nutrition, Sleep, HealthMetrics, DailyUserSummary, UserMetricState, HealthMetricAlert,
+                    STREAM_METRICS, session_scope)
+from recommendations import get_fitness_recommendations, get_nutrition_recommendations, fitness_advice, nutrition_advice
+from cache import result_cache
+from partitions import partition_source
+from sharding import scatter
+from migrate import replay_metric_state
+from sqlalchemy import select, func, cast, Float, tuple_, union_all, literal, null, case, and_
+from dataclasses import dataclass
+from typing import NamedTuple
+from datetime import date, datetime, timedelta
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import chain
+import binascii
+import math
 
-# Setting up the session to interact with the database.
-Session = sessionmaker(bind=engine)
-session = Session()
+# Health metric columns that may be requested by name.
+HEALTH_METRICS = ('weight', 'bmi', 'heart_rate', 'blood_pressure', 'systolic', 'diastolic')
+
+def encode_cursor(row_date, row_id):
+    """
+    Builds the opaque pagination token pointing just past the row with the given (date, id) key.
+    """
+    return urlsafe_b64encode(f"{row_date.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Turns a pagination token back into its (date, id) key; raises ValueError for malformed tokens.
+    """
+    try:
+        row_date, row_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return date.fromisoformat(row_date), int(row_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error) as error:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from error
+
+def _history_query(session, model, id_key, columns, user_id, days=None, cursor=None, oldest_first=False):
+    """
+    Newest-first (or `oldest_first`) history query over the named columns of `model`, optionally limited to the last
+    `days` days up to now and continued after `cursor`. The (date, id) keyset comparison lets every page start with
+    an index seek, so page N costs the same as page 1 however long the history is. Ranges reaching past the hot
+    window include the archives.
+    """
+    end = datetime.now()
+    start = end - timedelta(days=days) if days is not None else None
+    source = partition_source(session, model, start)
+    id_column = getattr(source, id_key)
+    query = session.query(*(getattr(source, name) for name in columns)).filter(source.user_id == user_id)
+    if start is not None:
+        # Future-dated rows are not part of "the last N days".
+        query = query.filter(source.date >= start, source.date <= end)
+    if oldest_first:
+        return query.order_by(source.date, id_column)
+    if cursor is not None:
+        # Typed like the key columns so the cursor values are bound in the configured storage layout.
+        key = tuple_(*decode_cursor(cursor), types=[model.date.type, getattr(model, id_key).type])
+        query = query.filter(tuple_(source.date, id_column) < key)
+    return query.order_by(source.date.desc(), id_column.desc())
+
+def _page(query, id_key, limit):
+    """
+    Fetches one page of `limit` rows and the cursor for the next page (None on the last page).
+    """
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last.date, getattr(last, id_key))
+
+def _workout_columns():
+    return ('workout_id', 'date', 'type', 'duration', 'intensity')
+
+def _metric_columns(metric):
+    if metric not in HEALTH_METRICS:
+        raise ValueError(f"Unknown health metric {metric!r}; expected one of {', '.join(HEALTH_METRICS)}")
+    return ('metric_id', 'date', metric)
+
+def iter_workout_history(user_id, days=None, batch_size=1000):
+    """
+    Streams a user's workouts newest first as (workout_id, date, type, duration, intensity) rows,
+    fetching `batch_size` rows at a time so memory use does not grow with the length of the history.
+    """
+    with session_scope(user_id) as session:
+        yield from _history_query(session, Workout, 'workout_id', _workout_columns(),
+                                  user_id, days).yield_per(batch_size)
+
+def get_workout_history_page(user_id, cursor=None, limit=50, days=None):
+    """
+    Returns one page of a user's workouts newest first and the cursor for the next page (None when done).
+    Pass the returned cursor back in to continue where the previous page stopped.
+    """
+    with session_scope(user_id) as session:
+        return _page(_history_query(session, Workout, 'workout_id', _workout_columns(),
+                                    user_id, days, cursor), 'workout_id', limit)
+
+def iter_health_metric_history(user_id, metric='weight', days=None, batch_size=1000):
+    """
+    Streams (metric_id, date, <metric>) rows for one health metric newest first, `batch_size` rows at a time.
+    """
+    columns = _metric_columns(metric)
+    with session_scope(user_id) as session:
+        yield from _history_query(session, HealthMetrics, 'metric_id', columns,
+                                  user_id, days).yield_per(batch_size)
+
+def get_health_metric_page(user_id, metric='weight', cursor=None, limit=50, days=None):
+    """
+    Returns one page of (metric_id, date, <metric>) rows newest first and the cursor for the next page (None when done).
+    """
+    columns = _metric_columns(metric)
+    with session_scope(user_id) as session:
+        return _page(_history_query(session, HealthMetrics, 'metric_id', columns,
+                                    user_id, days, cursor), 'metric_id', limit)
 
 def get_user_workout_history(user_id, days=30):
     """
     Retrieves a user's workout history over a specified period, defaulting to the last 30 days.
     This function helps users track their exercise patterns and progress over time.
     """
-    # Calculate the date range for query.
+    # Stream workouts within the date range, oldest first, for the specified user and provide feedback as they arrive.
+    found = False
+    with session_scope(user_id) as session:
+        for workout in _history_query(session, Workout, 'workout_id', _workout_columns(), user_id, days,
+                                      oldest_first=True).yield_per(1000):
+            found = True
+            print(f"Date: {workout.date}, Type: {workout.type}, Duration: {workout.duration} minutes, Intensity: {workout.intensity}")
+    if not found:
+        print(f"No workouts found for user {user_id} in the last {days} days.")
+
+def daily_calorie_totals_statement(user_id, days):
+    """
+    Daily calorie totals of the user's last `days` days from the daily rollup; shared by the sync and async APIs.
+    """
+    # Define the date range for the query.
     end_date = datetime.now()
     start_date = end_date - timedelta(days=days)
-    
-    # Query workouts within the date range for the specified user.
-    workouts = session.query(Workout).filter(
-        Workout.user_id == user_id,
-        Workout.date >= start_date,
-        Workout.date <= end_date
-    ).all()
-
-    # Provide feedback based on the presence of workout data.
-    if not workouts:
-        print(f"No workouts found for user {user_id} in the last {days} days.")
-    for workout in workouts:
-        print(f"Date: {workout.date}, Type: {workout.type}, Duration: {workout.duration} minutes, Intensity: {workout.intensity}")
+
+    return select(
+        DailyUserSummary.date,
+        DailyUserSummary.calories.label('total_calories')
+    ).where(
+        DailyUserSummary.user_id == user_id,
+        DailyUserSummary.date >= start_date,
+        DailyUserSummary.date <= end_date,
+        DailyUserSummary.meal_count > 0
+    )
+
+@result_cache.cached
+def _daily_calorie_totals(user_id, days):
+    """
+    Daily calorie totals of the user's last `days` days, cached until the user logs data.
+    """
+    with session_scope(user_id) as session:
+        return tuple(session.execute(daily_calorie_totals_statement(user_id, days)))
 
 def get_average_daily_calories(user_id, days=7):
     """
     Computes the average daily calorie intake for a user over the last 7 days.
     This insight assists users in managing their dietary habits aligned with their fitness goals.
     """
-    # Define the date range for the query.
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days)
-    
-    # Aggregate calorie data and compute the average.
-    calories = session.query(
-        Nutrition.date, 
-        func.sum(Nutrition.calories).label('total_calories')
-    ).filter(
-        Nutrition.user_id == user_id,
-        Nutrition.date >= start_date,
-        Nutrition.date <= end_date
-    ).group_by(Nutrition.date).all()
+    # Read the pre-aggregated daily calorie totals and compute the average.
+    calories = _daily_calorie_totals(user_id, days)
 
     # Provide feedback based on calorie data availability.
     if not calories:
@@ -59,24 +169,47 @@ def get_average_daily_calories(user_id, days=7):
         print(f"Average daily calories over the last {days} days: {average_calories}")
         return average_calories  # Return the calculated average
 
-def analyze_sleep_quality(user_id, days=30):
+def sleep_quality_totals_statement(user_id, days):
     """
-    Analyzes a user's sleep quality over the last 30 days, providing insights into their rest patterns.
-    Good sleep quality is crucial for recovery and overall health, making this function valuable for wellness tracking.
+    Per-quality night counts of the user's last `days` days from the daily rollup, as one row with a column per quality.
     """
     # Determine the query date range.
     end_date = datetime.now()
     start_date = end_date - timedelta(days=days)
-    
-    # Group sleep records by quality and count occurrences.
-    sleep_quality = session.query(
-        Sleep.quality, 
-        func.count(Sleep.quality).label('count')
-    ).filter(
-        Sleep.user_id == user_id,
-        Sleep.date >= start_date,
-        Sleep.date <= end_date
-    ).group_by(Sleep.quality).all()
+
+    return select(
+        func.sum(DailyUserSummary.excellent_sleep_count).label('Excellent'),
+        func.sum(DailyUserSummary.fair_sleep_count).label('Fair'),
+        func.sum(DailyUserSummary.good_sleep_count).label('Good'),
+        func.sum(DailyUserSummary.poor_sleep_count).label('Poor')
+    ).where(
+        DailyUserSummary.user_id == user_id,
+        DailyUserSummary.date >= start_date,
+        DailyUserSummary.date <= end_date
+    )
+
+def logged_qualities(totals):
+    """
+    (quality, count) pairs of the qualities present in a sleep_quality_totals_statement row.
+    """
+    return tuple((quality, count) for quality, count in totals._asdict().items() if count)
+
+@result_cache.cached
+def _sleep_quality_counts(user_id, days):
+    """
+    (quality, count) pairs for the qualities logged in the user's last `days` days, cached until the user logs data.
+    """
+    with session_scope(user_id) as session:
+        totals = session.execute(sleep_quality_totals_statement(user_id, days)).one()
+    return logged_qualities(totals)
+
+def analyze_sleep_quality(user_id, days=30):
+    """
+    Analyzes a user's sleep quality over the last 30 days, providing insights into their rest patterns.
+    Good sleep quality is crucial for recovery and overall health, making this function valuable for wellness tracking.
+    """
+    # Sum the per-day sleep quality counts from the daily rollup.
+    sleep_quality = _sleep_quality_counts(user_id, days)
 
     # Initialize a dictionary to summarize sleep quality analysis.
     sleep_quality_summary = {}
@@ -85,9 +218,9 @@ def analyze_sleep_quality(user_id, days=30):
     if not sleep_quality:
         print(f"No sleep data found for user {user_id} in the last {days} days.")
         return {}  # Return an empty dict if no data found
-    for quality in sleep_quality:
-        print(f"Quality: {quality.quality}, Count: {quality.count}")
-        sleep_quality_summary[quality.quality] = quality.count
+    for quality, count in sleep_quality:
+        print(f"Quality: {quality}, Count: {count}")
+        sleep_quality_summary[quality] = count
     
     # Return the summary dictionary.
     return sleep_quality_summary
@@ -100,25 +233,17 @@ def correlate_nutrition_and_workout(user_id):
     Correlates a user's nutrition (specifically protein intake) with their workout habits.
     Understanding this correlation can help in tailoring a balanced fitness and nutrition plan.
     """
-    from sqlalchemy.sql import func
-
-    # Subqueries to calculate average daily protein intake and workout duration.
-    protein_intake = session.query(
-        Nutrition.date,
-        func.avg(Nutrition.protein).label('average_protein')
-    ).filter(Nutrition.user_id == user_id).group_by(Nutrition.date).subquery()
-
-    workout_duration = session.query(
-        Workout.date,
-        func.avg(Workout.duration).label('average_duration')
-    ).filter(Workout.user_id == user_id).group_by(Workout.date).subquery()
-
-    # Joining the two subqueries on date
-    correlation_data = session.query(
-        protein_intake.c.date,
-        protein_intake.c.average_protein,
-        workout_duration.c.average_duration
-    ).join(workout_duration, protein_intake.c.date == workout_duration.c.date).all()
+    with session_scope(user_id) as session:
+        # The daily rollup already holds per-day protein and workout totals; days with both give the joined averages.
+        correlation_data = session.query(
+            DailyUserSummary.date,
+            (DailyUserSummary.protein / DailyUserSummary.meal_count).label('average_protein'),
+            (cast(DailyUserSummary.workout_minutes, Float) / DailyUserSummary.workout_count).label('average_duration')
+        ).filter(
+            DailyUserSummary.user_id == user_id,
+            DailyUserSummary.meal_count > 0,
+            DailyUserSummary.workout_count > 0
+        ).order_by(DailyUserSummary.date).all()
 
     # Display the correlation results
     for data in correlation_data:
@@ -126,27 +251,292 @@ def correlate_nutrition_and_workout(user_id):
     
     return correlation_data or []
 
+def metric_history_statement(user_id, metric, source=HealthMetrics):
+    """
+    (date, value) rows of one health metric in date order, read from `source` (see partitions.partition_source).
+    """
+    return select(
+        source.date,
+        getattr(source, metric)
+    ).where(source.user_id == user_id).order_by(source.date)
+
+@result_cache.cached
+def _metric_history(user_id, metric):
+    """
+    (date, value) rows of one health metric in date order, cached until the user logs data.
+    """
+    with session_scope(user_id) as session:
+        source = partition_source(session, HealthMetrics)
+        return tuple(session.execute(metric_history_statement(user_id, metric, source)))
+
 def analyze_health_metric_trends(user_id, metric='weight'):
     """
     Analyzes trends in a specific health metric (default: weight) for a user over time.
     Tracking changes in health metrics can provide valuable feedback on the user's overall progress and health status.
     """
     # Query to get the specified health metric over time
-    metrics_data = session.query(
-        HealthMetrics.date,
-        getattr(HealthMetrics, metric)
-    ).filter(HealthMetrics.user_id == user_id).order_by(HealthMetrics.date).all()
+    metrics_data = _metric_history(user_id, metric)
 
     # Output the trend data for the specified health metric.
     print(f"Trends for {metric}:")
     for data in metrics_data:
         print(f"Date: {data.date}, {metric.capitalize()}: {getattr(data, metric)}")
     
-    return metrics_data or []
+    return list(metrics_data)
 
-if __name__ == '__main__':
-    user_id = 1  # Adjust as needed based on your database data
+def get_blood_pressure_summary(user_id, days=30):
+    """
+    Average, minimum and maximum systolic/diastolic pressure of a user over the last `days` days, aggregated in SQL.
+    Returns None when the user has no numeric readings in the window.
+    """
+    start = datetime.now() - timedelta(days=days)
+    with session_scope(user_id) as session:
+        source = partition_source(session, HealthMetrics, start)
+        summary = session.query(
+            func.count(source.systolic).label('readings'),
+            func.avg(source.systolic).label('average_systolic'),
+            func.min(source.systolic).label('min_systolic'),
+            func.max(source.systolic).label('max_systolic'),
+            func.avg(source.diastolic).label('average_diastolic'),
+            func.min(source.diastolic).label('min_diastolic'),
+            func.max(source.diastolic).label('max_diastolic')
+        ).filter(
+            source.user_id == user_id,
+            source.date >= start
+        ).one()
+    return summary if summary.readings else None
+
+def _hypertension_candidates(session, start, systolic_threshold):
+    source = partition_source(session, HealthMetrics, start)
+    average_systolic = func.avg(source.systolic)
+    return session.query(
+        source.user_id,
+        func.count(source.systolic).label('readings'),
+        average_systolic.label('average_systolic'),
+        func.avg(source.diastolic).label('average_diastolic')
+    ).filter(
+        source.date >= start,
+        source.systolic.isnot(None)
+    ).group_by(
+        # Grouping on an expression stops SQLite from walking the user-leading index just to avoid a sort.
+        source.user_id + 0
+    ).having(
+        average_systolic > systolic_threshold
+    ).order_by(average_systolic.desc()).all()
+
+def find_hypertension_candidates(days=30, systolic_threshold=135):
+    """
+    Users whose mean systolic pressure over the last `days` days exceeds `systolic_threshold`, highest first.
+    The date-leading covering index answers this from the index alone, without reading or parsing any row.
+    With sharding enabled every shard is screened in parallel and the candidates are merged.
+    Returns (user_id, readings, average_systolic, average_diastolic) rows.
+    """
+    parts = scatter(_hypertension_candidates, datetime.now() - timedelta(days=days), systolic_threshold)
+    return sorted(chain.from_iterable(parts), key=lambda row: row.average_systolic, reverse=True)
+
+class MetricTrend(NamedTuple):
+    metric: str
+    readings: int
+    average: float    # Exponentially weighted moving average
+    deviation: float  # Moving standard deviation
+    last: float
+
+class HealthAlert(NamedTuple):
+    user_id: int
+    date: date
+    metric: str
+    value: float
+    average: float  # The user's moving average before the reading
+    sigmas: float   # Moving standard deviations between the reading and the average
+
+def _replayed_metric_state(session, user_id):
+    """
+    The user's metric state and alerts recomputed from their readings, for a state marked stale.
+    """
+    source = partition_source(session, HealthMetrics)
+    readings = session.execute(select(
+        source.user_id, source.metric_id, source.date, *(getattr(source, metric) for metric in STREAM_METRICS)
+    ).where(source.user_id == user_id).order_by(source.date, source.metric_id))
+    return replay_metric_state(user_id, (row._mapping for row in readings))
+
+def get_health_metric_trend(user_id, metric='weight'):
+    """
+    Moving average, standard deviation and last value of a weight, BMI or heart rate series from the user's
+    streaming state (User_Metric_State), read with one primary key lookup however long the history is.
+    A state marked stale is replayed from the history instead. Returns None before the user's first reading
+    of the metric.
+    """
+    if metric not in STREAM_METRICS:
+        raise ValueError(f"No streaming state for {metric!r}; expected one of {', '.join(STREAM_METRICS)}")
+    state = UserMetricState
+    columns = (f'{metric}_readings', f'{metric}_average', f'{metric}_variance', f'last_{metric}')
+    with session_scope(user_id) as session:
+        row = session.execute(select(
+            *(getattr(state, column) for column in columns), state.stale
+        ).where(state.user_id == user_id)).first()
+        if row is not None and row.stale:
+            replayed, _ = _replayed_metric_state(session, user_id)
+            row = tuple(replayed[column] for column in columns)
+    if row is None or not row[0]:
+        return None
+    readings, average, variance, last = row[:4]
+    return MetricTrend(metric, readings, average, math.sqrt(max(variance, 0.0)), last)
+
+def _alert_columns():
+    alert = HealthMetricAlert
+    return alert.user_id, alert.date, alert.metric, alert.value, alert.average, alert.variance
+
+def _health_alert(user_id, date, metric, value, average, variance):
+    deviation = math.sqrt(max(variance, 0.0))
+    sigmas = abs(value - average) / deviation if deviation else math.inf
+    return HealthAlert(user_id, date, metric, value, average, sigmas)
 
+def get_health_metric_alerts(user_id, days=30):
+    """
+    Readings of the last `days` days that the Health_Metrics trigger flagged as anomalies when they arrived (see
+    METRIC_ALERT_RULES in create.py), newest first. A state marked stale is replayed from the history instead.
+    """
+    alert = HealthMetricAlert
+    start = datetime.now() - timedelta(days=days)
+    with session_scope(user_id) as session:
+        if session.execute(select(UserMetricState.stale).where(UserMetricState.user_id == user_id)).scalar():
+            _, replayed = _replayed_metric_state(session, user_id)
+            # Alert rows carry the reading's metric_id second, which HealthAlert leaves out.
+            rows = [(row[0], *row[2:]) for row in reversed(replayed) if row[2] >= start.date()]
+        else:
+            rows = session.execute(select(*_alert_columns()).where(
+                alert.user_id == user_id, alert.date >= start
+            ).order_by(alert.date.desc(), alert.alert_id.desc())).all()
+    return [_health_alert(*row) for row in rows]
+
+def _recent_alerts(session, start, metric):
+    alert = HealthMetricAlert
+    query = select(*_alert_columns()).where(alert.date >= start)
+    if metric is not None:
+        query = query.where(alert.metric == metric)
+    return session.execute(query).all()
+
+def find_health_alerts(days=1, metric=None):
+    """
+    Every user's flagged readings of the last `days` days (optionally only those of `metric`), newest first.
+    Reads only the alerts, never the readings; with sharding enabled every shard is read in parallel.
+    """
+    parts = scatter(_recent_alerts, datetime.now() - timedelta(days=days), metric)
+    alerts = [_health_alert(*row) for row in chain.from_iterable(parts)]
+    return sorted(alerts, key=lambda alert: (alert.date, alert.user_id), reverse=True)
+
+class WorkoutEntry(NamedTuple):
+    date: date
+    type: str
+    duration: int
+    intensity: str
+
+class CorrelationEntry(NamedTuple):
+    date: date
+    average_protein: float
+    average_duration: float
+
+class MetricEntry(NamedTuple):
+    date: date
+    value: float
+
+@dataclass(frozen=True)
+class UserDashboard:
+    """
+    Everything the dashboard shows for one user, as returned by get_user_dashboard.
+    Field values match iter_workout_history (newest first), get_average_daily_calories, analyze_sleep_quality,
+    correlate_nutrition_and_workout, analyze_health_metric_trends('weight') and both recommendation functions.
+    """
+    user_id: int
+    workouts: tuple
+    average_daily_calories: float
+    sleep_quality: dict
+    nutrition_workout_correlation: tuple
+    weight_trend: tuple
+    fitness_recommendation: str
+    nutrition_recommendation: str
+
+# Columns shared by every branch of the dashboard UNION ALL; 'section' says which part of the dashboard a row feeds.
+DASHBOARD_COLUMNS = ('section', 'day', 'row_id', 'label', 'level', 'value1', 'value2', 'value3', 'value4')
+
+def _dashboard_branch(section, **columns):
+    """
+    One SELECT of the dashboard statement, padding the columns it does not use with NULL.
+    """
+    values = {'section': literal(section), **columns}
+    return [values.get(name, null()).label(name) for name in DASHBOARD_COLUMNS]
+
+def dashboard_statement(user_id, workout_days=30, calorie_days=7, sleep_days=30, metrics=HealthMetrics):
+    """
+    A single UNION ALL statement returning every row the dashboard needs. Each branch is an index range scan of one
+    table or of the daily rollup, and the three rollup aggregates are computed in SQL, so the result is a few
+    hundred rows at most however long the user's history is. The weight trend covers the whole history and is
+    read from `metrics` (see partitions.partition_source).
+    """
+    now = datetime.now()
+    summary = DailyUserSummary
+    fitness_window = summary.date >= now - timedelta(days=30)
+    calorie_window = summary.date >= now - timedelta(days=calorie_days)
+    nutrition_window = summary.date >= now - timedelta(days=7)
+    # The workout branch comes first because a compound SELECT takes its result types from its first SELECT.
+    workouts = select(*_dashboard_branch(
+        'workout', day=Workout.date, row_id=Workout.workout_id, label=Workout.type, level=Workout.intensity,
+        value1=Workout.duration
+    )).where(Workout.user_id == user_id, Workout.date >= now - timedelta(days=workout_days), Workout.date <= now)
+    fitness = select(*_dashboard_branch(
+        'fitness', value1=func.sum(summary.workout_count), value2=func.count(),
+        value3=func.sum(summary.high_intensity_count)
+    )).where(summary.user_id == user_id, fitness_window, summary.workout_count > 0)
+    calories = select(*_dashboard_branch(
+        'calories',
+        value1=func.avg(case((and_(calorie_window, summary.date <= now), summary.calories))),
+        value2=func.avg(case((nutrition_window, summary.calories)))
+    )).where(summary.user_id == user_id, summary.date >= now - timedelta(days=max(calorie_days, 7)),
+             summary.meal_count > 0)
+    sleep = select(*_dashboard_branch(
+        'sleep', value1=func.sum(summary.excellent_sleep_count), value2=func.sum(summary.fair_sleep_count),
+        value3=func.sum(summary.good_sleep_count), value4=func.sum(summary.poor_sleep_count)
+    )).where(summary.user_id == user_id, summary.date >= now - timedelta(days=sleep_days), summary.date <= now)
+    correlation = select(*_dashboard_branch(
+        'correlation', day=summary.date, value1=summary.protein / summary.meal_count,
+        value2=cast(summary.workout_minutes, Float) / summary.workout_count
+    )).where(summary.user_id == user_id, summary.meal_count > 0, summary.workout_count > 0)
+    weight = select(*_dashboard_branch(
+        'weight', day=metrics.date, row_id=metrics.metric_id, value1=metrics.weight
+    )).where(metrics.user_id == user_id)
+    return union_all(workouts, fitness, calories, sleep, correlation, weight).order_by('section', 'day', 'row_id')
+
+@result_cache.cached
+def get_user_dashboard(user_id, workout_days=30, calorie_days=7, sleep_days=30):
+    """
+    Loads the whole dashboard of a user with one statement (one database round trip) in one session and returns a
+    UserDashboard. The individual functions above issue eight or more queries for the same data.
+    """
+    sections = {}
+    with session_scope(user_id) as session:
+        metrics = partition_source(session, HealthMetrics)
+        for row in session.execute(dashboard_statement(user_id, workout_days, calorie_days, sleep_days, metrics)):
+            sections.setdefault(row.section, []).append(row)
+    fitness, = sections['fitness']
+    calories, = sections['calories']
+    sleep, = sections['sleep']
+    qualities = zip(('Excellent', 'Fair', 'Good', 'Poor'), (sleep.value1, sleep.value2, sleep.value3, sleep.value4))
+    return UserDashboard(
+        user_id=user_id,
+        workouts=tuple(WorkoutEntry(row.day, row.label, row.value1, row.level) for row in reversed(sections.get('workout', []))),
+        average_daily_calories=calories.value1 or 0,
+        sleep_quality={quality: count for quality, count in qualities if count},
+        nutrition_workout_correlation=tuple(CorrelationEntry(row.day, row.value1, row.value2)
+                                            for row in sections.get('correlation', [])),
+        weight_trend=tuple(MetricEntry(row.day, row.value1) for row in sections.get('weight', [])),
+        fitness_recommendation=fitness_advice(fitness.value1 or 0, fitness.value2, fitness.value3 or 0),
+        nutrition_recommendation=nutrition_advice(calories.value2),
+    )
+
+def print_user_report(user_id):
+    """
+    Prints every query and recommendation for one user.
+    """
     # Demonstrate each query function with example output.
     print(f"--- Workout History for User {user_id} ---")
     get_user_workout_history(user_id, 30)
@@ -171,3 +561,15 @@ if __name__ == '__main__':
     print(f"\n--- Nutrition Recommendation for User {user_id} ---")
     nutrition_recommendation = get_nutrition_recommendations(user_id)
     print(nutrition_recommendation)
+
+    print(f"\n--- Weight Trend and Health Alerts for User {user_id} ---")
+    print(get_health_metric_trend(user_id, 'weight'))
+    for alert in get_health_metric_alerts(user_id):
+        print(alert)
+
+    # The same data in one round trip.
+    print(f"\n--- Dashboard for User {user_id} ---")
+    print(get_user_dashboard(user_id))
+
+if __name__ == '__main__':
+    print_user_report(1)  # Adjust the user id as needed based on your database data
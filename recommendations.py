@@ -1,57 +1,42 @@
-from create import User, Workout, Nutrition, Sleep, HealthMetrics, Session
-from sqlalchemy import func
-from datetime import datetime, timedelta
+from create import User, Workout, Nutrition, Sleep, HealthMetrics, DailyUserSummary, UserRecommendation, session_scope, \
+    engine, shards
+from cache import result_cache
+from sharding import scatter
+from sqlalchemy import select, func, case, true, or_
+from sqlalchemy.dialects.sqlite import insert
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+import argparse
+import time
 
-def get_fitness_recommendations(user_id):
+# Largest number of user ids bound into a single IN (...) clause by the batch engine.
+BATCH_USER_CHUNK = 500
+
+def fitness_advice(workout_count, workout_days, high_intensity_count):
     """
-    Generates personalized fitness recommendations based on the user's recent workout history.
-    The recommendations adjust based on workout frequency and intensity to encourage balanced and consistent exercise habits.
+    Maps the workout statistics of the last 30 days to a fitness recommendation.
+    Shared by the per-user and batch paths so both always give identical advice.
     """
-    session = Session()
-    # Fetch recent workouts for the given user, focusing on the last 30 days to ensure recommendations are current and relevant.
-    recent_workouts = session.query(Workout).filter(
-        Workout.user_id == user_id,
-        Workout.date >= datetime.now() - timedelta(days=30)
-    ).order_by(Workout.date.desc()).all()
-
     # Default recommendation for new users or those without recent workout data.
-    if not recent_workouts:
+    if not workout_count:
         return "We recommend starting with light cardio sessions, 15-30 minutes a day, three times a week."
 
-    # Analyze workout intensity and frequency to tailor recommendations.
-    high_intensity_count = sum(1 for workout in recent_workouts if workout.intensity == 'High')
-    workout_days = {workout.date for workout in recent_workouts}
-
     # Provide specific advice based on the user's workout patterns.
-    if len(workout_days) < 8:
+    if workout_days < 8:
         return "To achieve your goals faster, try to increase your workout frequency to at least twice a week."
-    elif high_intensity_count < len(recent_workouts) / 2:
+    elif high_intensity_count < workout_count / 2:
         return "Consider incorporating more high-intensity workouts into your routine to maximize your fitness gains."
     else:
         return "Great job maintaining a consistent workout routine! Try challenging yourself with varied workout types to improve all aspects of fitness."
 
-def get_nutrition_recommendations(user_id):
+def nutrition_advice(average_calories):
     """
-    Offers nutrition recommendations based on the user's recent calorie intake.
-    Tailored advice helps users align their diet with health and fitness goals.
+    Maps the average daily calorie intake of the last 7 days (None when nothing was logged) to a nutrition recommendation.
     """
-    session = Session()
-    # Aggregate recent nutrition logs to calculate average daily calorie intake.
-    recent_nutrition_logs = session.query(
-        Nutrition.date, 
-        func.sum(Nutrition.calories).label('total_calories')
-    ).filter(
-        Nutrition.user_id == user_id,
-        Nutrition.date >= datetime.now() - timedelta(days=7)
-    ).group_by(Nutrition.date).all()
-
     # Encourage users to start tracking their nutrition if no data is available.
-    if not recent_nutrition_logs:
+    if average_calories is None:
         return "Start tracking your daily nutrition to receive personalized dietary advice."
 
-    # Calculate the average calorie intake and provide recommendations based on it.
-    average_calories = sum(log.total_calories for log in recent_nutrition_logs) / len(recent_nutrition_logs)
-
     # Tailored advice based on calorie intake ranges.
     if average_calories < 1500:
         return "Your calorie intake might be too low for optimal health. Consider consulting a dietitian for a personalized meal plan."
@@ -60,6 +45,250 @@ def get_nutrition_recommendations(user_id):
     else:
         return "Your average calorie intake is within a healthy range. Keep up the good work and ensure you're getting a balanced mix of nutrients."
 
+def recent_workouts_statement(user_id):
+    """
+    Workout count, workout days and high-intensity count of the last 30 days, summarized from the daily rollup.
+    """
+    return select(
+        func.sum(DailyUserSummary.workout_count).label('workout_count'),
+        func.count().label('workout_days'),
+        func.sum(DailyUserSummary.high_intensity_count).label('high_intensity_count')
+    ).where(
+        DailyUserSummary.user_id == user_id,
+        DailyUserSummary.date >= datetime.now() - timedelta(days=30),
+        DailyUserSummary.workout_count > 0
+    )
+
+def average_calories_statement(user_id):
+    """
+    Average of the daily calorie totals of the last 7 days (NULL when nothing was logged).
+    """
+    return select(
+        func.avg(DailyUserSummary.calories)
+    ).where(
+        DailyUserSummary.user_id == user_id,
+        DailyUserSummary.date >= datetime.now() - timedelta(days=7),
+        DailyUserSummary.meal_count > 0
+    )
+
+def stored_recommendation_statement(user_id, column, today=None):
+    """
+    `column` of the user's stored recommendation row, if the row is current: computed today at the latest data_version.
+    """
+    return select(column).where(
+        UserRecommendation.user_id == user_id,
+        UserRecommendation.computed_version == UserRecommendation.data_version,
+        UserRecommendation.computed_on == (today or date.today())
+    )
+
+@result_cache.cached
+def get_fitness_recommendations(user_id):
+    """
+    Generates personalized fitness recommendations based on the user's recent workout history.
+    The recommendations adjust based on workout frequency and intensity to encourage balanced and consistent exercise habits.
+    """
+    with session_scope(user_id) as session:
+        # Serve the stored recommendation with one primary key lookup when refresh_recommendations has kept it current.
+        stored = session.execute(stored_recommendation_statement(user_id, UserRecommendation.fitness)).scalar()
+        if stored is not None:
+            return stored
+        # Summarize the last 30 days from the daily rollup to ensure recommendations are current and relevant.
+        recent_workouts = session.execute(recent_workouts_statement(user_id)).one()
+
+    # Analyze workout intensity and frequency to tailor recommendations.
+    return fitness_advice(recent_workouts.workout_count or 0, recent_workouts.workout_days,
+                          recent_workouts.high_intensity_count or 0)
+
+@result_cache.cached
+def get_nutrition_recommendations(user_id):
+    """
+    Offers nutrition recommendations based on the user's recent calorie intake.
+    Tailored advice helps users align their diet with health and fitness goals.
+    """
+    with session_scope(user_id) as session:
+        stored = session.execute(stored_recommendation_statement(user_id, UserRecommendation.nutrition)).scalar()
+        if stored is not None:
+            return stored
+        # Average the daily calorie totals of the last 7 days from the daily rollup.
+        average_calories = session.execute(average_calories_statement(user_id)).scalar()
+
+    # Provide recommendations based on the average calorie intake.
+    return nutrition_advice(average_calories)
+
+def _user_filter(column, user_ids=None, user_range=None):
+    """
+    Restricts a user_id column to an explicit id list, an inclusive (low, high) range, or nothing.
+    """
+    if user_ids is not None:
+        return column.in_(user_ids)
+    if user_range is not None:
+        return column.between(*user_range)
+    return true()
+
+def _recommendation_inputs(session, user_ids=None, user_range=None):
+    """
+    Per-user workout count, workout days and high-intensity count over 30 days, and the average daily calorie total
+    over 7 days, with a single GROUP BY over the daily rollup. Users without rollup rows in the window are left out.
+    """
+    nutrition_window = DailyUserSummary.date >= datetime.now() - timedelta(days=7)
+    stats = session.query(
+        DailyUserSummary.user_id,
+        func.sum(DailyUserSummary.workout_count).label('workout_count'),
+        func.sum(case((DailyUserSummary.workout_count > 0, 1), else_=0)).label('workout_days'),
+        func.sum(DailyUserSummary.high_intensity_count).label('high_intensity_count'),
+        func.avg(case((nutrition_window & (DailyUserSummary.meal_count > 0), DailyUserSummary.calories))).label('average_calories')
+    ).filter(
+        _user_filter(DailyUserSummary.user_id, user_ids, user_range),
+        DailyUserSummary.date >= datetime.now() - timedelta(days=30)
+    ).group_by(DailyUserSummary.user_id)
+    return {row.user_id: row for row in stats}
+
+def _score_users(session, user_ids=None, user_range=None):
+    """
+    Computes both recommendations for one slice of users from _recommendation_inputs.
+    Returns {user_id: {'fitness': ..., 'nutrition': ...}}.
+    """
+    if user_ids is not None:
+        scored_ids = list(user_ids)
+    else:
+        scored_ids = [row.user_id for row in session.query(User.user_id).filter(
+            _user_filter(User.user_id, user_range=user_range)).order_by(User.user_id)]
+
+    stats_by_user = _recommendation_inputs(session, user_ids, user_range)
+    recommendations = {}
+    for user_id in scored_ids:
+        row = stats_by_user.get(user_id)
+        recommendations[user_id] = {
+            'fitness': fitness_advice(row.workout_count, row.workout_days, row.high_intensity_count) if row else fitness_advice(0, 0, 0),
+            'nutrition': nutrition_advice(row.average_calories if row else None),
+        }
+    return recommendations
+
+def _score_chunks(session, user_ids):
+    """
+    Scores an explicit id list, split into IN-clauses of BATCH_USER_CHUNK ids.
+    """
+    recommendations = {}
+    for start in range(0, len(user_ids), BATCH_USER_CHUNK):
+        recommendations.update(_score_users(session, user_ids[start:start + BATCH_USER_CHUNK]))
+    return recommendations
+
+def _score_slice(user_ids=None, user_range=None):
+    """
+    Scores one slice in its own session.
+    """
+    with session_scope() as session:
+        if user_ids is None:
+            return _score_users(session, user_range=user_range)
+        return _score_chunks(session, user_ids)
+
+def _reset_engine():
+    """
+    Process-pool initializer: drops SQLite connections inherited from the parent process.
+    """
+    engine.dispose()
+
+def _score_slice_task(task):
+    return _score_slice(*task)
+
+def get_batch_recommendations(user_ids=None, processes=None):
+    """
+    Generates fitness and nutrition recommendations for every user, or for the given user ids, in one pass.
+    The decision inputs are computed with a set-based GROUP BY instead of one session and query per user,
+    and the advice is identical to get_fitness_recommendations/get_nutrition_recommendations.
+    With `processes` > 1 the user population is split into contiguous id ranges (or id list slices) scored in a process pool.
+    With sharding enabled each shard is scored by its own worker process instead (`processes` caps the pool).
+    Returns a dict mapping user_id to {'fitness': ..., 'nutrition': ...}.
+    """
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    if shards.sharded:
+        recommendations = {}
+        parts = scatter(_score_users, processes=processes) if user_ids is None else \
+            scatter(_score_chunks, user_ids=user_ids, processes=processes)
+        for part in parts:
+            recommendations.update(part)
+        return recommendations
+    if not processes or processes < 2 or user_ids == []:
+        return _score_slice(user_ids)
+
+    if user_ids is not None:
+        step = -(-len(user_ids) // processes)
+        tasks = [(user_ids[start:start + step], None) for start in range(0, len(user_ids), step)]
+    else:
+        with session_scope() as session:
+            low, high = session.query(func.min(User.user_id), func.max(User.user_id)).one()
+        if low is None:
+            return {}
+        step = -(-(high - low + 1) // processes)
+        tasks = [(None, (start, min(start + step - 1, high))) for start in range(low, high + 1, step)]
+
+    recommendations = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_reset_engine) as pool:
+        for part in pool.map(_score_slice_task, tasks):
+            recommendations.update(part)
+    return recommendations
+
+def _stale_users(session, after, limit, today):
+    """
+    (user_id, data_version) of up to `limit` users after `after` whose stored recommendations are missing or stale.
+    """
+    stored = UserRecommendation
+    return session.execute(select(
+        User.user_id, func.coalesce(stored.data_version, 0)
+    ).outerjoin(
+        stored, stored.user_id == User.user_id
+    ).where(
+        User.user_id > after,
+        or_(stored.computed_version.is_(None), stored.computed_version != stored.data_version, stored.computed_on != today)
+    ).order_by(User.user_id).limit(limit)).all()
+
+def _refresh_stale(session, batch_size, today):
+    """
+    Recomputes the stale stored recommendations of one database, `batch_size` users per write transaction.
+    Returns the number of users refreshed.
+    """
+    columns = ('fitness', 'nutrition', 'workout_count', 'workout_days', 'high_intensity_count', 'average_calories',
+               'computed_version', 'computed_on')
+    statement = insert(UserRecommendation.__table__)
+    statement = statement.on_conflict_do_update(index_elements=['user_id'],
+                                                set_={name: statement.excluded[name] for name in columns})
+    refreshed = after = 0
+    while True:
+        # The versions and the inputs are read in one snapshot, so each row's watermark matches its inputs. A write
+        # committed after the snapshot bumps data_version past the watermark and the user stays stale.
+        stale = _stale_users(session, after, batch_size, today)
+        if not stale:
+            return refreshed
+        inputs = _recommendation_inputs(session, [user_id for user_id, _ in stale])
+        # End the read transaction first; in WAL mode it cannot turn into a write once another writer has committed.
+        session.commit()
+        rows = []
+        for user_id, version in stale:
+            row = inputs.get(user_id)
+            workout_count, workout_days, high_intensity_count = \
+                (row.workout_count, row.workout_days, row.high_intensity_count) if row else (0, 0, 0)
+            average_calories = row.average_calories if row else None
+            rows.append({'user_id': user_id,
+                         'fitness': fitness_advice(workout_count, workout_days, high_intensity_count),
+                         'nutrition': nutrition_advice(average_calories),
+                         'workout_count': workout_count, 'workout_days': workout_days,
+                         'high_intensity_count': high_intensity_count, 'average_calories': average_calories,
+                         'computed_version': version, 'computed_on': today})
+        session.execute(statement, rows)
+        session.commit()
+        refreshed += len(rows)
+        after = stale[-1][0]
+
+def refresh_recommendations(batch_size=BATCH_USER_CHUNK, today=None, processes=None):
+    """
+    Recomputes the stored recommendations (User_Recommendations) of every user whose Workouts or Nutrition rows
+    changed since their watermark, who has none stored yet, or whose advice was computed before today. Unchanged
+    users are not touched. With sharding enabled every shard is refreshed in its own process (`processes` caps the
+    pool). Returns the number of users refreshed.
+    """
+    return sum(scatter(_refresh_stale, batch_size, today or date.today(), processes=processes))
+
 # Separating recommendation logic into a different file (recommendations.py):
 # This modular approach enhances code maintainability and readability, allowing the core querying logic to remain focused on data retrieval,
 # while recommendation-specific logic can evolve independently, incorporating more complex algorithms or external services as needed.
@@ -71,3 +300,14 @@ def get_nutrition_recommendations(user_id):
     # nutrition_advice = get_nutrition_recommendations(user_id)
     # print(f"Fitness Recommendation for User {user_id}: {fitness_advice}")
     # print(f"Nutrition Recommendation for User {user_id}: {nutrition_advice}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refresh the stored recommendations of users whose logs changed.")
+    parser.add_argument('--batch-size', type=int, default=BATCH_USER_CHUNK, help="users recomputed per transaction")
+    parser.add_argument('--every', type=float, help="keep running, refreshing every EVERY seconds")
+    args = parser.parse_args()
+    while True:
+        print(f"Refreshed the recommendations of {refresh_recommendations(args.batch_size)} users")
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,117 @@
+from create import (Base, Session, User, SUMMARY_SOURCES, create_app_engine, shard_url, shards, summary_trigger_ddl,
+                    summary_trigger_name, RECOMMENDATION_SOURCES, recommendation_trigger_ddl, recommendation_trigger_name,
+                    METRIC_STATE_TRIGGER, metric_state_trigger_ddl)
+from migrate import rebuild_daily_summaries
+from sqlalchemy import select, func
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+
+# Scatter-gather over user shards:
+# Cross-user work (batch recommendations, population statistics) runs once per shard, each part in its own process
+# by default, and the caller merges the parts. Every user lives on exactly one shard, so per-user aggregates never
+# need combining across shards. Without sharding the work runs once, in-process, on Session's database.
+
+# Engines opened by pool workers, one per shard URL.
+_worker_engines = {}
+
+def shard_user_ids(user_ids):
+    """
+    Splits `user_ids` by shard: {shard index: [ids]}, omitting shards that hold none of them.
+    """
+    grouped = {}
+    for user_id in user_ids:
+        grouped.setdefault(shards.shard_for(user_id), []).append(user_id)
+    return grouped
+
+def _run(bind, function, args):
+    session = Session(bind=bind)
+    try:
+        return function(session, *args)
+    finally:
+        session.close()
+
+def _reset_shard_engines():
+    """
+    Process-pool initializer: drops SQLite connections inherited from the parent process.
+    """
+    for inherited in shards.engines + [Session.kw['bind']]:
+        inherited.dispose()
+
+def _shard_task(task):
+    url, function, args = task
+    if url not in _worker_engines:
+        _worker_engines[url] = create_app_engine(url, pool_size=1)
+    return _run(_worker_engines[url], function, args)
+
+def scatter(function, *args, user_ids=None, processes=None):
+    """
+    Runs function(session, *args) on every shard and returns the results in shard order. With `user_ids` only the
+    shards holding some of them run, as function(session, ids_on_that_shard, *args). Shards are processed in a pool
+    of `processes` worker processes (default: one per shard; 1 runs them one after another in this process).
+    `function` and `args` must be picklable, so pass module-level functions and plain values.
+    """
+    if not shards.sharded:
+        return [_run(Session.kw['bind'], function, args if user_ids is None else (list(user_ids), *args))]
+    if user_ids is None:
+        tasks = [(shard_engine, args) for shard_engine in shards.engines]
+    else:
+        tasks = [(shards.engines[index], (ids, *args)) for index, ids in sorted(shard_user_ids(user_ids).items())]
+    if not tasks:
+        return []
+    processes = processes or len(tasks)
+    if processes < 2 or len(tasks) == 1:
+        return [_run(shard_engine, function, shard_args) for shard_engine, shard_args in tasks]
+    with ProcessPoolExecutor(max_workers=min(processes, len(tasks)), initializer=_reset_shard_engines) as pool:
+        return list(pool.map(_shard_task, [(str(shard_engine.url), function, shard_args)
+                                           for shard_engine, shard_args in tasks]))
+
+def split_database(source_path, url=None, count=None):
+    """
+    Copies the unsharded database at `source_path` into `count` new shard files of `url` (default: the configured
+    shards), routing every user and their rows by user_id % count, and rebuilds each shard's daily rollup.
+    Returns the number of users per shard.
+    """
+    url = url if url is not None else shards.url
+    count = count if count is not None else shards.count
+    if count < 2:
+        raise ValueError("Splitting needs at least two shards")
+    users = []
+    for index in range(count):
+        shard_engine = create_app_engine(shard_url(url, index))
+        try:
+            if os.path.exists(shard_engine.url.database):
+                raise FileExistsError(f"{shard_engine.url.database} already exists")
+            Base.metadata.create_all(shard_engine)
+            with shard_engine.connect() as connection:
+                connection.exec_driver_sql("ATTACH DATABASE ? AS source", (os.path.abspath(source_path),))
+                with connection.begin():
+                    # The rollup is rebuilt in one pass afterwards instead of row by row.
+                    for table_name in SUMMARY_SOURCES:
+                        connection.exec_driver_sql(f"DROP TRIGGER {summary_trigger_name(table_name, 'insert')}")
+                    # Stored recommendations are copied with their watermarks, metric states with their alerts.
+                    for table_name in RECOMMENDATION_SOURCES:
+                        connection.exec_driver_sql(f"DROP TRIGGER {recommendation_trigger_name(table_name, 'insert')}")
+                    connection.exec_driver_sql(f"DROP TRIGGER {METRIC_STATE_TRIGGER}")
+                    for table in Base.metadata.sorted_tables:
+                        if 'user_id' not in table.c or table.name == 'Daily_User_Summary':
+                            continue
+                        columns = ", ".join(f'"{column.name}"' for column in table.columns)
+                        connection.exec_driver_sql(
+                            f'INSERT INTO main."{table.name}" ({columns}) SELECT {columns} FROM source."{table.name}" '
+                            f'WHERE user_id % {count} = {index}')
+                    for statement in summary_trigger_ddl() + recommendation_trigger_ddl() + metric_state_trigger_ddl():
+                        connection.exec_driver_sql(statement)
+                connection.exec_driver_sql("DETACH DATABASE source")
+                users.append(connection.execute(select(func.count()).select_from(User.__table__)).scalar())
+            rebuild_daily_summaries(shard_engine)
+        finally:
+            shard_engine.dispose()
+    return users
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split an unsharded database into HEALTH_FITNESS_SHARDS shard files.")
+    parser.add_argument('source', help="the unsharded database file, e.g. health_fitness_app.db")
+    args = parser.parse_args()
+    for index, count in enumerate(split_database(args.source)):
+        print(f"{shard_url(shards.url, index)}: {count} users")
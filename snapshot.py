@@ -0,0 +1,148 @@
+from create import Session, shards
+from cache import result_cache
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+# In-memory snapshots for read-only workers:
+# DatabaseSnapshot copies a database file into a shared-cache in-memory SQLite database with the online backup API
+# and serves it through an ordinary pooled engine, so query_data.py and recommendations.py run against it unchanged
+# once it is bound to Session. A refresh loads a fresh copy next to the current one and then switches new connections
+# to it; sessions already running finish on the copy they started on, so queries never stop for a refresh.
+
+# Distinguishes the in-memory databases of successive snapshot generations within the process.
+_generations = itertools.count()
+
+# Source engine of every snapshot engine, for code that must open the database file itself (async_queries.py).
+_sources = weakref.WeakKeyDictionary()
+
+def file_bind(bind):
+    """
+    Engine over the database file behind `bind`: the source of a snapshot engine, otherwise `bind` itself.
+    """
+    return _sources.get(bind, bind)
+
+class DatabaseSnapshot:
+    """
+    Read-only, periodically refreshed in-memory copy of the database file behind `source` (default: Session's
+    engine). `engine` is a pooled engine over the current copy; activate() binds Session to it.
+    The snapshot lives in this process only: process pools keep reading the files, async_queries reads the
+    source file (see file_bind), and archived rows (partitions.py) are not part of it.
+    """
+
+    def __init__(self, source=None, pool_size=5, max_overflow=10):
+        self.source = source if source is not None else Session.kw['bind']
+        if not self.source.url.database or self.source.url.database == ':memory:':
+            raise ValueError("Only file databases can be snapshotted")
+        self.refreshes = 0
+        self.loaded_at = None
+        self._uri = None
+        self._keeper = None
+        self._lock = threading.Lock()
+        self._previous_bind = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.engine = create_engine('sqlite://', creator=self._connect, poolclass=QueuePool, pool_size=pool_size,
+                                    max_overflow=max_overflow)
+        _sources[self.engine] = self.source
+        self.refresh()
+
+    def _connect(self):
+        connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        # Writes would be lost at the next refresh.
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    def refresh(self):
+        """
+        Loads a new copy of the source database and switches the engine to it. Returns the seconds it took.
+        """
+        started = time.perf_counter()
+        uri = f"file:health_fitness_snapshot_{os.getpid()}_{next(_generations)}?mode=memory&cache=shared"
+        # The in-memory database lives as long as one connection to it is open.
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source = self.source.raw_connection()
+        try:
+            # One backup step copies every page under a single read transaction, giving a consistent copy.
+            source.dbapi_connection.backup(keeper)
+        except Exception:
+            keeper.close()
+            raise
+        finally:
+            source.close()
+        with self._lock:
+            previous, self._keeper, self._uri = self._keeper, keeper, uri
+            # Connections pooled on the previous copy are closed; checked-out ones close when their session ends.
+            self.engine.dispose()
+            if previous is not None:
+                previous.close()
+            self.refreshes += 1
+            self.loaded_at = time.time()
+        if self._previous_bind is not None:
+            # Cached results may come from the previous copy.
+            result_cache.clear()
+        return time.perf_counter() - started
+
+    def activate(self):
+        """
+        Binds Session to the snapshot, so the query and recommendation functions read it.
+        """
+        if shards.sharded:
+            raise ValueError("Snapshots cover a single database, not a sharded one")
+        if self._previous_bind is None:
+            self._previous_bind = Session.kw['bind']
+            Session.configure(bind=self.engine)
+            result_cache.clear()
+        return self
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.refresh()
+
+    def start(self, interval):
+        """
+        Refreshes the snapshot every `interval` seconds on a background thread until stop() or close().
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='snapshot-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def close(self):
+        """
+        Stops refreshing, restores Session's previous engine and frees the in-memory copy.
+        """
+        self.stop()
+        if self._previous_bind is not None:
+            Session.configure(bind=self._previous_bind)
+            self._previous_bind = None
+            result_cache.clear()
+        with self._lock:
+            self.engine.dispose()
+            if self._keeper is not None:
+                self._keeper.close()
+                self._keeper = None
+
+def start_snapshot_worker(interval=None, source=None, pool_size=5):
+    """
+    Loads an in-memory snapshot of `source` (default: Session's engine), binds Session to it and, with `interval`,
+    refreshes it every `interval` seconds. Returns the DatabaseSnapshot; call refresh() for an on-demand refresh and
+    close() to go back to the database file.
+    """
+    snapshot = DatabaseSnapshot(source, pool_size=pool_size).activate()
+    if interval:
+        snapshot.start(interval)
+    return snapshot
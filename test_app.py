@@ -1,74 +1,117 @@
+import re
 import unittest
+from unittest import mock
 from datetime import datetime, timedelta, date
-from create import User, Workout, Nutrition, Sleep, HealthMetrics, engine
+from create import (User, Workout, Nutrition, Sleep, HealthMetrics, DailyUserSummary, Session, engine, session_scope,
+                    parse_blood_pressure, EnumCode, DayNumber, INTENSITIES, MEAL_TYPES, STORAGE)
 from query_data import (get_user_workout_history, get_average_daily_calories,
                         analyze_sleep_quality, correlate_nutrition_and_workout,
-                        analyze_health_metric_trends)
-from recommendations import get_fitness_recommendations, get_nutrition_recommendations
+                        analyze_health_metric_trends, iter_workout_history, get_workout_history_page,
+                        iter_health_metric_history, get_health_metric_page, encode_cursor,
+                        get_blood_pressure_summary, find_hypertension_candidates, get_user_dashboard)
+from recommendations import get_fitness_recommendations, get_nutrition_recommendations, get_batch_recommendations
+from insert_data import bulk_load
+from migrate import migrate, rebuild_daily_summaries, backfill_blood_pressure, convert_storage, storage_layout
+from cache import QueryCache, result_cache
+from analytics import (grouped_pearson, grouped_spearman, grouped_slope, rolling_mean,
+                       nutrition_workout_correlations, correlate_protein_and_duration, health_metric_trends,
+                       health_metric_trend)
+import numpy as np
+import asyncio
+import async_queries
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from benchmark import compare, percentiles, dataset_path, build_dataset, pinned_clock, REFERENCE_DATE
+from instrumentation import profile, profile_call
+from load_test import result_cache_disabled
+from create import Base, create_app_engine
+from partitions import compact, archive_years, hot_cutoff, partition_source, create_archive
+from create import shards, shard_url
+from sharding import split_database
+from importer import import_file, _allowed_choices
+from recommendations import refresh_recommendations
+from create import UserRecommendation
+from snapshot import start_snapshot_worker
+import threading
+from cohort import QuantileSketch, cohort_percentiles, build_cohort_sketches, user_percentile
+import json
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+import cli
+from migrate import rebuild_metric_states
+from create import UserMetricState, HealthMetricAlert, ALERT_MIN_READINGS
+from query_data import get_health_metric_trend, get_health_metric_alerts, find_health_alerts, _metric_history
+from sqlalchemy import create_engine, event, select, func, Column, String
 from sqlalchemy.orm import sessionmaker
 
-Session = sessionmaker(bind=engine)
-session = Session()
-
 class TestHealthFitnessApp(unittest.TestCase):
 
+    def setUp(self):
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.close()
+
     def test_user_creation(self):
         """Test user creation and retrieval from the database."""
         new_user = User(name='John Doe', age=30, gender='Male', height=175, weight=80, goal='Muscle Gain')
-        session.add(new_user)
-        session.commit()
-        user = session.query(User).filter_by(name='John Doe').first()
+        self.session.add(new_user)
+        self.session.commit()
+        user = self.session.query(User).filter_by(name='John Doe').first()
         self.assertIsNotNone(user)
         self.assertEqual(user.name, 'John Doe')
         self.assertEqual(user.age, 30)
 
     def test_workout_log(self):
         """Test workout logging and retrieval."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         new_workout = Workout(user_id=user_id, date=datetime.now(), type='Cardio', duration=60, intensity='High')
-        session.add(new_workout)
-        session.commit()
-        workout_log = session.query(Workout).filter_by(user_id=user_id).first()
+        self.session.add(new_workout)
+        self.session.commit()
+        workout_log = self.session.query(Workout).filter_by(user_id=user_id).first()
         self.assertIsNotNone(workout_log)
         self.assertEqual(workout_log.type, 'Cardio')
         self.assertEqual(workout_log.intensity, 'High')
 
     def test_nutrition_log(self):
         """Test nutrition logging and average calorie calculation."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         new_nutrition_log = Nutrition(user_id=user_id, date=datetime.now(), type='Lunch', calories=700, protein=30, carbs=100, fats=20)
-        session.add(new_nutrition_log)
-        session.commit()
+        self.session.add(new_nutrition_log)
+        self.session.commit()
         avg_calories = get_average_daily_calories(user_id, 1)
         self.assertGreaterEqual(avg_calories, 700)
 
     def test_sleep_quality_analysis(self):
         """Test sleep quality logging and analysis."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         new_sleep_log = Sleep(user_id=user_id, date=datetime.now(), duration=8, quality='Good')
-        session.add(new_sleep_log)
-        session.commit()
+        self.session.add(new_sleep_log)
+        self.session.commit()
         sleep_quality_summary = analyze_sleep_quality(user_id, 1)
         self.assertIn('Good', sleep_quality_summary.keys())
         self.assertGreaterEqual(sleep_quality_summary.get('Good', 0), 1)
 
     def test_fitness_recommendations(self):
         """Test generation of fitness recommendations based on user workout history."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         fitness_advice = get_fitness_recommendations(user_id)
         self.assertIsInstance(fitness_advice, str)
         self.assertNotEqual(fitness_advice, "")
 
     def test_nutrition_recommendations(self):
         """Test generation of nutrition recommendations based on user calorie intake."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         nutrition_advice = get_nutrition_recommendations(user_id)
         self.assertIsInstance(nutrition_advice, str)
         self.assertNotEqual(nutrition_advice, "")
 
     def test_correlate_nutrition_and_workout(self):
         """Test the correlation between nutrition and workout."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         correlations = correlate_nutrition_and_workout(user_id)
         self.assertTrue(len(correlations) > 0)  # Ensure the list is not empty
         for date_item, avg_protein, avg_duration in correlations:
@@ -78,12 +121,1074 @@ class TestHealthFitnessApp(unittest.TestCase):
 
     def test_health_metric_trends(self):
         """Test the analysis of health metric trends."""
-        user_id = session.query(User).filter_by(name='John Doe').first().user_id
+        user_id = self.session.query(User).filter_by(name='John Doe').first().user_id
         trends = analyze_health_metric_trends(user_id, 'weight')
         self.assertTrue(len(trends) > 0)  # Ensure the list is not empty
         for date_item, weight in trends:
             self.assertIsInstance(date_item, date)  # Check the first item is a date
             self.assertIsInstance(weight, float)  # Check the second item is a float (weight)
 
+class TestSessionScope(unittest.TestCase):
+
+    def test_commit_and_rollback(self):
+        """Test that session_scope commits on success and rolls back when the block raises."""
+        with session_scope() as session:
+            session.add(User(name='Scope Commit', age=40, gender='Other', height=170, weight=70, goal='Improve Fitness'))
+        with self.assertRaises(RuntimeError):
+            with session_scope() as session:
+                session.add(User(name='Scope Rollback', age=40, gender='Other', height=170, weight=70, goal='Improve Fitness'))
+                session.flush()
+                raise RuntimeError("abort")
+        with session_scope() as session:
+            self.assertGreater(session.query(User).filter_by(name='Scope Commit').count(), 0)
+            self.assertEqual(session.query(User).filter_by(name='Scope Rollback').count(), 0)
+        self.assertEqual(engine.pool.checkedout(), 0)
+
+class TestBatchRecommendations(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_batch_matches_single_user_functions(self):
+        """Test that the batch engine gives every user the same advice as the per-user functions."""
+        recommendations = get_batch_recommendations()
+        user_ids = [user.user_id for user in self.session.query(User)]
+        self.assertEqual(sorted(recommendations), sorted(user_ids))
+        for user_id in user_ids:
+            self.assertEqual(recommendations[user_id], {
+                'fitness': get_fitness_recommendations(user_id),
+                'nutrition': get_nutrition_recommendations(user_id),
+            })
+
+    def test_batch_with_user_ids_and_process_pool(self):
+        """Test scoring an explicit id list, including an unknown user, across a process pool."""
+        user_ids = [user.user_id for user in self.session.query(User).limit(5)] + [10 ** 9]
+        recommendations = get_batch_recommendations(user_ids, processes=2)
+        self.assertEqual(sorted(recommendations), sorted(user_ids))
+        self.assertEqual(recommendations, get_batch_recommendations(user_ids))
+        self.assertEqual(recommendations[10 ** 9]['fitness'], get_fitness_recommendations(10 ** 9))
+        self.assertEqual(get_batch_recommendations(processes=2), get_batch_recommendations())
+
+class TestBulkLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+
+    def test_bulk_load_counts(self):
+        """Test that the bulk loader writes the requested number of rows across several batches."""
+        counts = bulk_load(7, workouts=3, nutrition_logs=5, sleep_records=2, health_metrics=4,
+                           chunk_size=10, commit_interval=2, seed=1, bind=self.engine)
+        self.assertEqual(counts, {'Users': 7, 'Workouts': 21, 'Nutrition': 35, 'Sleep': 14, 'Health_Metrics': 28})
+        bulk_session = sessionmaker(bind=self.engine)()
+        self.assertEqual(bulk_session.query(Workout).count(), 21)
+        user = bulk_session.query(User).first()
+        self.assertEqual(len(user.nutrition_logs), 5)
+        metric = user.health_metrics[0]
+        self.assertIsInstance(metric.date, date)
+        self.assertAlmostEqual(metric.bmi, metric.weight / (user.height / 100) ** 2, places=1)
+        bulk_session.close()
+
+    def test_bulk_load_is_reproducible(self):
+        """Test that a seeded bulk load generates the same rows and appends after existing users."""
+        bulk_load(2, workouts=2, nutrition_logs=0, sleep_records=0, health_metrics=0, seed=3, bind=self.engine)
+        bulk_load(2, workouts=2, nutrition_logs=0, sleep_records=0, health_metrics=0, seed=3, bind=self.engine)
+        bulk_session = sessionmaker(bind=self.engine)()
+        workouts = bulk_session.query(Workout).order_by(Workout.workout_id).all()
+        self.assertEqual([w.user_id for w in workouts], [1, 1, 2, 2, 3, 3, 4, 4])
+        first, second = workouts[:4], workouts[4:]
+        self.assertEqual([(w.date, w.type, w.duration) for w in first], [(w.date, w.type, w.duration) for w in second])
+        bulk_session.close()
+
+class TestDailyUserSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def summary_rows(self):
+        rows = self.session.query(DailyUserSummary).order_by(DailyUserSummary.user_id, DailyUserSummary.date).all()
+        return [{column.name: round(getattr(row, column.key), 6) if isinstance(getattr(row, column.key), float)
+                 else getattr(row, column.key) for column in DailyUserSummary.__table__.columns} for row in rows]
+
+    def test_triggers_track_inserts_updates_and_deletes(self):
+        """Test that the trigger-maintained rollup always equals a full rebuild."""
+        bulk_load(3, workouts=20, nutrition_logs=30, sleep_records=20, health_metrics=0, seed=5, bind=self.engine)
+        day = date(2024, 2, 29)
+        self.session.add_all([
+            Nutrition(user_id=1, date=day, type='Lunch', calories=700, protein=30, carbs=100, fats=20),
+            Nutrition(user_id=1, date=day, type='Dinner', calories=900, protein=50, carbs=80, fats=30),
+            Workout(user_id=1, date=day, type='Cardio', duration=45, intensity='High'),
+            Sleep(user_id=1, date=day, duration=7.5, quality='Good'),
+        ])
+        self.session.commit()
+        summary = self.session.query(DailyUserSummary).filter_by(user_id=1, date=day).one()
+        self.assertEqual((summary.meal_count, summary.calories, summary.high_intensity_minutes, summary.good_sleep_count),
+                         (2, 1600, 45, 1))
+
+        self.session.query(Workout).filter_by(user_id=2).limit(1).one().intensity = 'High'
+        self.session.query(Sleep).filter_by(user_id=3).update({'user_id': 1})
+        self.session.delete(self.session.query(Nutrition).filter_by(user_id=2).first())
+        self.session.query(Workout).filter(Workout.date == day).delete()
+        self.session.commit()
+        maintained = self.summary_rows()
+        self.session.commit()
+        rebuild_daily_summaries(self.engine)
+        self.assertEqual(maintained, self.summary_rows())
+
+class TestHistoryPagination(unittest.TestCase):
+
+    def collect_pages(self, fetch_page, limit):
+        rows, cursor, pages = [], None, 0
+        while True:
+            page, cursor = fetch_page(cursor, limit)
+            rows.extend(page)
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    def test_workout_pages_cover_the_stream(self):
+        """Test that walking the keyset pages returns exactly the streamed history, newest first."""
+        streamed = list(iter_workout_history(1, batch_size=7))
+        self.assertGreater(len(streamed), 10)
+        keys = [(row.date, row.workout_id) for row in streamed]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        paged, pages = self.collect_pages(lambda cursor, limit: get_workout_history_page(1, cursor, limit), 10)
+        self.assertEqual(paged, streamed)
+        self.assertEqual(pages, -(-len(streamed) // 10))
+
+    def test_metric_pages_cover_the_stream(self):
+        """Test health metric paging, including a page size that divides the history exactly."""
+        streamed = list(iter_health_metric_history(1, 'bmi'))
+        self.assertEqual(streamed[0]._fields, ('metric_id', 'date', 'bmi'))
+        paged, _ = self.collect_pages(lambda cursor, limit: get_health_metric_page(1, 'bmi', cursor, limit), len(streamed))
+        self.assertEqual(paged, streamed)
+
+    def test_day_window_excludes_future_rows(self):
+        """Test that "the last N days" stops at today and that the printed history runs oldest first."""
+        with session_scope(1) as session:
+            future = Workout(user_id=1, date=datetime.now() + timedelta(days=3), type='Cardio', duration=45,
+                             intensity='Low')
+            session.add(future)
+            session.flush()
+            workout_id = future.workout_id
+        try:
+            self.assertNotIn(workout_id, [row.workout_id for row in iter_workout_history(1, 30)])
+            self.assertIn(workout_id, [row.workout_id for row in iter_workout_history(1)])
+            output = StringIO()
+            with redirect_stdout(output):
+                get_user_workout_history(1, 30)
+            printed = re.findall(r"^Date: (\S+),", output.getvalue(), re.MULTILINE)
+            self.assertEqual(printed, sorted(printed))
+            self.assertTrue(all(day <= date.today().isoformat() for day in printed))
+        finally:
+            with session_scope(1) as session:
+                session.delete(session.get(Workout, workout_id))
+
+    def test_invalid_arguments(self):
+        """Test that malformed cursors and unknown metrics are rejected."""
+        with self.assertRaises(ValueError):
+            get_workout_history_page(1, cursor='not-a-cursor')
+        with self.assertRaises(ValueError):
+            get_health_metric_page(1, 'name')
+
+class TestAnalytics(unittest.TestCase):
+
+    def test_grouped_statistics_match_per_group_numpy(self):
+        """Test the grouped reductions against NumPy applied to each group separately."""
+        rng = np.random.default_rng(0)
+        groups = np.repeat([3, 5, 8], [12, 7, 20]).astype(float)
+        x = rng.integers(0, 6, size=len(groups)).astype(float)  # small integers force ties for the rank test
+        y = 2 * x + rng.normal(size=len(groups))
+        ids, counts, pearson = grouped_pearson(groups, x, y)
+        _, _, spearman = grouped_spearman(groups, x, y)
+        _, _, slope = grouped_slope(groups, x, y)
+        self.assertEqual(ids.tolist(), [3, 5, 8])
+        self.assertEqual(counts.tolist(), [12, 7, 20])
+        for i, group in enumerate(ids):
+            gx, gy = x[groups == group], y[groups == group]
+            self.assertAlmostEqual(pearson[i], np.corrcoef(gx, gy)[0, 1])
+            self.assertAlmostEqual(slope[i], np.polyfit(gx, gy, 1)[0])
+            rank = lambda values: np.array([(values < v).sum() + ((values == v).sum() + 1) / 2 for v in values])
+            self.assertAlmostEqual(spearman[i], np.corrcoef(rank(gx), rank(gy))[0, 1])
+        self.assertEqual(rolling_mean([1, 2, 3, 4, 10, 20], 2, [1, 1, 1, 1, 2, 2]).tolist(), [1, 1.5, 2.5, 3.5, 10, 15])
+
+    def test_multi_user_mode_matches_single_user(self):
+        """Test that the columnar correlations agree with the joined per-date averages of correlate_nutrition_and_workout."""
+        correlations = nutrition_workout_correlations()
+        user_id = int(correlations['user_id'][np.argmax(correlations['days'])])
+        single = correlate_protein_and_duration(user_id)
+        rows = correlate_nutrition_and_workout(user_id)
+        self.assertEqual(single['days'], len(rows))
+        expected = np.corrcoef([row.average_protein for row in rows], [row.average_duration for row in rows])[0, 1]
+        self.assertAlmostEqual(single['pearson'], expected)
+        trends = health_metric_trends('bmi', [user_id])
+        history = analyze_health_metric_trends(user_id, 'bmi')
+        self.assertEqual(trends['points'].tolist(), [len(history)])
+        self.assertEqual(trends['latest'].tolist(), [history[-1].bmi])
+        trend = health_metric_trend(user_id, 'bmi')
+        self.assertEqual(sorted(trend['dates'].astype(object)), sorted(row.date for row in history))
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare_flags_only_real_regressions(self):
+        """Test that the baseline comparison ignores noise and new functions but flags slowdowns."""
+        row = lambda function, p50, p95: {'scale': 10, 'function': function, 'phase': 'cold', 'p50_ms': p50, 'p95_ms': p95}
+        baseline = {'results': [row('a', 10.0, 20.0), row('b', 0.1, 0.2)]}
+        report = {'results': [row('a', 16.0, 21.0), row('b', 0.3, 0.4), row('c', 99.0, 99.0)]}
+        regressions = compare(report, baseline, tolerance=0.5, min_delta_ms=0.5)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('a (cold, 10 users): p50_ms 10.000 -> 16.000', regressions[0])
+        self.assertEqual(percentiles([0.001] * 10), {'p50_ms': 1.0, 'p95_ms': 1.0, 'p99_ms': 1.0, 'samples': 10})
+
+    def test_datasets_are_keyed_and_dated_reproducibly(self):
+        """Test that the dataset file depends on the rows per user and that its dates stay in the pinned windows."""
+        per_user = {'workouts': 0, 'nutrition_logs': 60, 'sleep_records': 0, 'health_metrics': 0}
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertNotEqual(dataset_path(directory, 3, 1, per_user), dataset_path(directory, 3, 1, {}))
+            path = build_dataset(directory, 3, 1, per_user)
+            self.assertEqual(build_dataset(directory, 3, 1, per_user), path)
+            original_bind, bench_engine = Session.kw['bind'], create_app_engine(f"sqlite:///{path}")
+            Session.configure(bind=bench_engine)
+            result_cache.clear()
+            try:
+                with session_scope() as session:
+                    self.assertLessEqual(session.query(func.max(Nutrition.date)).scalar(), REFERENCE_DATE)
+                with pinned_clock(), redirect_stdout(StringIO()):
+                    self.assertGreater(sum(get_average_daily_calories(user_id, 30) for user_id in (1, 2, 3)), 0)
+            finally:
+                Session.configure(bind=original_bind)
+                result_cache.clear()
+                bench_engine.dispose()
+        self.assertIs(sys.modules['query_data'].datetime, datetime)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_relationship_lazy_loads_are_flagged(self):
+        """Test that lazy-loading User.workouts per user shows up as an N+1 suspect with hydration counts."""
+        with profile() as profiler:
+            with session_scope() as session:
+                users = session.query(User).order_by(User.user_id).limit(4).all()
+                workouts = sum(len(user.workouts) for user in users)
+        summary = profiler.summary()
+        self.assertEqual(summary['hydrated'], {'User': 4, 'Workout': workouts})
+        self.assertEqual(len(summary['n_plus_one']), 1)
+        self.assertEqual(summary['n_plus_one'][0]['calls'], 4)
+        self.assertIn('FROM "Workouts"', summary['n_plus_one'][0]['sql'])
+
+    def test_profile_call_attributes_statements(self):
+        """Test per-statement latency and caller attribution for a recommendation call, and that profiling stops."""
+        # A current stored recommendation is served with a single statement.
+        refresh_recommendations()
+        result_cache.clear()
+        advice, profiler = profile_call(get_nutrition_recommendations, 1)
+        self.assertIsInstance(advice, str)
+        [entry] = profiler.stats()
+        self.assertEqual(dict(entry['callers']), {'recommendations.get_nutrition_recommendations': 1})
+        self.assertGreater(entry['total_ms'], 0)
+        self.assertEqual(profiler.n_plus_one(), [])
+        result_cache.clear()
+        get_nutrition_recommendations(1)
+        self.assertEqual(len(profiler.records), 1)
+
+    def test_records_are_bounded(self):
+        """Test that only the last max_records statements are kept while the statistics cover all of them."""
+        with profile(max_records=2) as profiler:
+            with session_scope() as session:
+                users = session.query(User).order_by(User.user_id).limit(4).all()
+                for user in users:
+                    len(user.workouts)
+        self.assertEqual(len(profiler.records), 2)
+        self.assertEqual(profiler.summary()['statements'], 5)
+        self.assertEqual(profiler.n_plus_one()[0]['calls'], 4)
+        self.assertEqual(sum(entry['hydrated'] for entry in profiler.stats()), sum(profiler.hydrated.values()))
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_lru_bound_and_ttl(self):
+        """Test that the cache evicts the least recently used entry and expires entries after the TTL."""
+        cache = QueryCache(maxsize=2, ttl=60)
+        calls = []
+
+        @cache.cached
+        def lookup(user_id, days=7):
+            calls.append((user_id, days))
+            return user_id * days
+
+        self.assertEqual(lookup(1), 7)
+        self.assertEqual(lookup(1, days=7), 7)
+        lookup(2)
+        lookup(1)
+        lookup(3)  # evicts user 2, the least recently used entry
+        lookup(1)
+        lookup(2)
+        self.assertEqual(calls, [(1, 7), (2, 7), (3, 7), (2, 7)])
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 4, 'invalidations': 0, 'size': 2, 'maxsize': 2})
+        cache.ttl = 0
+        lookup(3)
+        lookup(3)
+        self.assertEqual(calls[-2:], [(3, 7), (3, 7)])
+
+    def test_flush_invalidates_only_that_user(self):
+        """Test that logging a meal for one user refreshes that user's cached analytics and keeps other users' entries."""
+        with session_scope() as session:
+            user_id, other_user_id = [user.user_id for user in session.query(User).order_by(User.user_id).limit(2)]
+        result_cache.clear()
+        before = get_average_daily_calories(user_id, 1)
+        get_average_daily_calories(other_user_id, 1)
+        self.assertEqual(get_average_daily_calories(user_id, 1), before)
+        size = result_cache.stats()['size']
+        with session_scope() as session:
+            session.add(Nutrition(user_id=user_id, date=datetime.now(), type='Snack', calories=5000, protein=1, carbs=1, fats=1))
+        self.assertEqual(result_cache.stats()['size'], size - 1)
+        self.assertGreaterEqual(get_average_daily_calories(user_id, 1), 5000)
+
+    def test_load_test_bypasses_the_cache(self):
+        """Test that the load test's cache switch makes repeated reads miss the cache and restores its size after."""
+        maxsize = result_cache.maxsize
+        with result_cache_disabled():
+            hits = result_cache.stats()['hits']
+            get_average_daily_calories(1, 7)
+            get_average_daily_calories(1, 7)
+            self.assertEqual(result_cache.stats()['hits'], hits)
+            self.assertEqual(result_cache.stats()['size'], 0)
+        self.assertEqual(result_cache.maxsize, maxsize)
+
+class TestBloodPressure(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_parse_blood_pressure(self):
+        """Test that readings are split into integers and bad readings are rejected."""
+        self.assertEqual(parse_blood_pressure('120/80'), (120, 80))
+        self.assertEqual(parse_blood_pressure(' 135 / 90 '), (135, 90))
+        for reading in (None, '', '120', '120/80/60', 'high', '20/10', '120/250'):
+            self.assertEqual(parse_blood_pressure(reading), (None, None))
+
+    def test_backfill_and_screening(self):
+        """Test that legacy string readings are backfilled in batches and screened with SQL aggregates."""
+        self.session.add_all([User(user_id=i, name=f'User {i}', age=40, gender='Female', height=170, weight=70,
+                                   goal='Weight Loss') for i in (1, 2)])
+        readings = {1: ['150/95', '140/90', 'n/a'], 2: ['118/76', '122/80', None]}
+        for user_id, values in readings.items():
+            for offset, value in enumerate(values):
+                self.session.add(HealthMetrics(user_id=user_id, date=date.today() - timedelta(days=offset),
+                                               weight=70, bmi=24.2, heart_rate=70, blood_pressure=value))
+        self.session.commit()
+        self.assertEqual(self.session.query(HealthMetrics).filter_by(blood_pressure='150/95').one().diastolic, 95)
+        # Simulate rows written before the numeric columns existed.
+        self.session.query(HealthMetrics).update({'systolic': None, 'diastolic': None})
+        self.session.commit()
+
+        # Core updates bypass the flush events, so the backfill itself must drop cached results.
+        result_cache.set(('marker',), 1, 'stale')
+        self.assertEqual(backfill_blood_pressure(self.engine, batch_size=2), 4)
+        self.assertEqual(result_cache.get(('marker',)), (False, None))
+        self.assertEqual(backfill_blood_pressure(self.engine), 0)
+        Session.configure(bind=self.engine)
+        try:
+            summary = get_blood_pressure_summary(1)
+            self.assertEqual((summary.readings, summary.average_systolic, summary.max_diastolic), (2, 145, 95))
+            self.assertIsNone(get_blood_pressure_summary(3))
+            candidates = find_hypertension_candidates(30, 135)
+            self.assertEqual([(row.user_id, row.readings) for row in candidates], [(1, 2)])
+        finally:
+            Session.configure(bind=engine)
+
+class TestUserDashboard(unittest.TestCase):
+
+    def test_dashboard_matches_individual_functions_in_one_statement(self):
+        """Test that the dashboard equals the individual functions' results and costs a single statement."""
+        with session_scope() as session:
+            user_id = session.query(Workout.user_id).order_by(Workout.date.desc()).first().user_id
+        result_cache.clear()
+        with profile() as profiler:
+            dashboard = get_user_dashboard(user_id)
+        self.assertEqual(profiler.summary()['statements'], 1)
+        self.assertTrue(dashboard.workouts)
+        self.assertEqual([tuple(entry) for entry in dashboard.workouts],
+                         [(w.date, w.type, w.duration, w.intensity) for w in iter_workout_history(user_id, 30)])
+        self.assertEqual(dashboard.average_daily_calories, get_average_daily_calories(user_id, 7))
+        self.assertEqual(dashboard.sleep_quality, analyze_sleep_quality(user_id, 30))
+        self.assertEqual([tuple(entry) for entry in dashboard.nutrition_workout_correlation],
+                         [tuple(row) for row in correlate_nutrition_and_workout(user_id)])
+        self.assertEqual([tuple(entry) for entry in dashboard.weight_trend],
+                         [tuple(row) for row in analyze_health_metric_trends(user_id, 'weight')])
+        self.assertEqual(dashboard.fitness_recommendation, get_fitness_recommendations(user_id))
+        self.assertEqual(dashboard.nutrition_recommendation, get_nutrition_recommendations(user_id))
+        self.assertIs(get_user_dashboard(user_id), dashboard)
+
+class TestAsyncQueries(unittest.TestCase):
+
+    def run_async(self, coroutine_function, *args):
+        async def run():
+            try:
+                return await coroutine_function(*args)
+            finally:
+                await async_queries.dispose_async_engines()
+        return asyncio.run(run())
+
+    def test_dashboard_matches_sync_functions(self):
+        """Test that the concurrently gathered async dashboard returns what the blocking functions return."""
+        with session_scope() as session:
+            user_id = session.query(User.user_id).order_by(User.user_id).first().user_id
+        result_cache.clear()
+        dashboard = self.run_async(async_queries.get_dashboard, user_id)
+        self.assertEqual(dashboard, {
+            'average_daily_calories': get_average_daily_calories(user_id, 7),
+            'sleep_quality': analyze_sleep_quality(user_id, 30),
+            'metric_trend': analyze_health_metric_trends(user_id, 'weight'),
+            'fitness_recommendation': get_fitness_recommendations(user_id),
+            'nutrition_recommendation': get_nutrition_recommendations(user_id),
+        })
+        with self.assertRaises(ValueError):
+            self.run_async(async_queries.analyze_health_metric_trends, user_id, 'mood')
+
+class TestCompactStorage(unittest.TestCase):
+
+    def test_types_round_trip(self):
+        """Test that the compact types encode to small integers and decode to the ORM values."""
+        intensity = EnumCode(INTENSITIES)
+        self.assertEqual(intensity.process_bind_param('High', None), 2)
+        self.assertEqual(intensity.process_result_value(2, None), 'High')
+        self.assertEqual(intensity.encode_array(np.array(['Low', 'High'])).tolist(), [0, 2])
+        with self.assertRaises(ValueError):
+            intensity.process_bind_param('Extreme', None)
+        day = DayNumber()
+        self.assertEqual(day.process_bind_param(date(1970, 1, 2), None), 1)
+        self.assertEqual(day.process_bind_param(datetime(2024, 2, 29, 23, 59), None),
+                         day.process_bind_param(date(2024, 2, 29), None))
+        self.assertEqual(day.process_result_value(19782, None), date(2024, 2, 29))
+        self.assertEqual(day.encode_array(np.array(['2024-02-29'])).tolist(), [19782])
+
+    def test_convert_between_layouts(self):
+        """Test that a database survives conversion to the other storage layout and back unchanged."""
+        other = 'compact' if STORAGE == 'standard' else 'standard'
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ('original.db', 'other.db', 'back.db')]
+            original_engine = create_engine(f'sqlite:///{paths[0]}')
+            Base.metadata.create_all(original_engine)
+            bulk_load(3, workouts=5, nutrition_logs=5, sleep_records=5, health_metrics=5, seed=9, bind=original_engine)
+            # Workout types are free-form in both layouts.
+            with sessionmaker(bind=original_engine)() as session:
+                session.add(Workout(user_id=1, date=date.today(), type='Yoga', duration=40, intensity='Low'))
+                session.commit()
+                self.assertEqual(session.query(Workout.type).filter_by(type='Yoga').scalar(), 'Yoga')
+            subprocess.run([sys.executable, 'migrate.py', '--convert', paths[0], paths[1]], check=True,
+                           stdout=subprocess.DEVNULL, env={**os.environ, 'HEALTH_FITNESS_STORAGE': other},
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+            convert_storage(paths[1], paths[2])
+            engines = [original_engine, create_engine(f'sqlite:///{paths[1]}'), create_engine(f'sqlite:///{paths[2]}')]
+            try:
+                with engines[1].connect() as connection:
+                    self.assertEqual(storage_layout(connection), other)
+                    self.assertEqual(connection.exec_driver_sql("SELECT COUNT(*) FROM Workouts WHERE type = 'Yoga'").scalar(), 1)
+                tables = []
+                for bind in (engines[0], engines[2]):
+                    with bind.connect() as connection:
+                        tables.append({table.name: connection.execute(table.select().order_by(*table.primary_key)).fetchall()
+                                       for table in Base.metadata.sorted_tables})
+                self.assertEqual(tables[0], tables[1])
+            finally:
+                for bind in engines:
+                    bind.dispose()
+
+class TempDatabaseTestCase(unittest.TestCase):
+    """Runs each test on a fresh temporary database, seeded with bulk_load(**bulk_load_args) and bound to Session
+    unless bind_session is False. tearDown rebinds Session to the app database and clears the result cache."""
+
+    bulk_load_args = {'n_users': 3}
+    bind_session = True
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_app_engine(f"sqlite:///{os.path.join(self.directory.name, 'test.db')}")
+        Base.metadata.create_all(self.engine)
+        bulk_load(**self.bulk_load_args, bind=self.engine)
+        if self.bind_session:
+            Session.configure(bind=self.engine)
+        result_cache.clear()
+
+    def tearDown(self):
+        Session.configure(bind=engine)
+        result_cache.clear()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+class TestPartitions(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=4, workouts=40, nutrition_logs=20, sleep_records=20, health_metrics=40, seed=5)
+
+    def _snapshot(self):
+        result_cache.clear()
+        with self.engine.connect() as connection:
+            summaries = connection.execute(DailyUserSummary.__table__.select().order_by(
+                DailyUserSummary.user_id, DailyUserSummary.date)).fetchall()
+        return (list(iter_workout_history(2)), get_workout_history_page(2, limit=500),
+                analyze_health_metric_trends(3, 'bmi'),
+                {key: values.tolist() for key, values in health_metric_trends('weight').items()}, summaries)
+
+    def _settle_directory(self):
+        # Backdates the database directory, so the archive listing is cached as on a long-running server.
+        settled = time.time_ns() - 60 * 10 ** 9
+        os.utime(self.directory.name, ns=(settled, settled))
+
+    def test_compact_moves_old_rows_to_archives(self):
+        """Test that compaction archives old rows in batches without changing any query result or the rollup."""
+        before = self._snapshot()
+        moved = compact(self.engine, batch_size=7)
+        self.assertGreater(moved['Workouts'], 0)
+        years = archive_years(self.engine)
+        self.assertTrue(years)
+        self.assertLessEqual(set(years), {hot_cutoff().year - 1, hot_cutoff().year})
+        with self.engine.connect() as connection:
+            self.assertFalse(connection.execute(Workout.__table__.select().where(Workout.date < hot_cutoff())).first())
+            self.assertEqual(connection.execute(select(func.count()).select_from(Workout.__table__)).scalar(),
+                             160 - moved['Workouts'])
+        self.assertEqual(self._snapshot(), before)
+        self.assertEqual(compact(self.engine), dict.fromkeys(moved, 0))
+        rebuild_daily_summaries(self.engine)
+        self.assertEqual(self._snapshot()[-1], before[-1])
+
+    def test_compact_keeps_stored_recommendations_fresh(self):
+        """Test that archiving rows does not mark any user's stored recommendations as stale."""
+        refresh_recommendations()
+        self.assertEqual(refresh_recommendations(), 0)
+        self.assertGreater(compact(self.engine)['Workouts'], 0)
+        self.assertEqual(refresh_recommendations(), 0)
+
+    def test_recent_queries_stay_on_hot_tables(self):
+        """Test that a date range inside the hot window reads the hot table only."""
+        compact(self.engine)
+        with session_scope() as session:
+            self.assertIs(partition_source(session, Workout, date.today() - timedelta(days=30)), Workout)
+
+    def test_archives_readable_after_a_flushed_write(self):
+        """Test that a session can read the archives after it has written, since they are attached at checkout."""
+        moved = compact(self.engine)['Workouts']
+        session = Session()
+        try:
+            session.add(Workout(user_id=1, date=datetime.now(), type='Running', duration=30, intensity='Low'))
+            session.flush()
+            statements = []
+            event.listen(self.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            source = partition_source(session, Workout)
+            self.assertIsNot(source, Workout)
+            # Older SQLite versions refuse ATTACH inside the transaction the flush opened.
+            self.assertFalse([statement for statement in statements if 'ATTACH' in statement])
+            self.assertEqual(session.execute(select(func.count()).select_from(source)).scalar(), 161)
+            self.assertEqual(session.execute(select(func.count()).select_from(Workout)).scalar(), 161 - moved)
+        finally:
+            session.rollback()
+            session.close()
+
+    def test_archive_years_are_listed_once(self):
+        """Test that queries reuse the cached archive years and that creating an archive refreshes them."""
+        compact(self.engine)
+        self._settle_directory()
+        years = archive_years(self.engine)
+        with mock.patch('partitions.os.listdir', side_effect=AssertionError("archive years listed again")):
+            self.assertEqual(archive_years(self.engine), years)
+            self.assertTrue(list(iter_workout_history(2)))
+            self.assertTrue(analyze_health_metric_trends(3, 'bmi'))
+        create_archive(self.engine, years[0] - 1)
+        self.assertEqual(archive_years(self.engine), [years[0] - 1] + years)
+        with self.engine.connect() as connection:
+            attached = {row[1] for row in connection.exec_driver_sql("PRAGMA database_list")}
+        self.assertIn(f"archive_{years[0] - 1}", attached)
+
+    def test_archives_compacted_by_another_process_are_read(self):
+        """Test that whole-history reads include the rows another process archived after the years were listed."""
+        self._settle_directory()
+        before = analyze_health_metric_trends(3, 'weight')
+        self.assertEqual(archive_years(self.engine), [])
+        script = ("from create import create_app_engine; from partitions import compact; "
+                  f"print(compact(create_app_engine({str(self.engine.url)!r}))['Health_Metrics'])")
+        moved = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertGreater(int(moved), 0)
+        result_cache.clear()
+        self.assertTrue(archive_years(self.engine))
+        self.assertEqual(analyze_health_metric_trends(3, 'weight'), before)
+
+class TestSharding(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=9, workouts=20, nutrition_logs=20, sleep_records=10, health_metrics=20, seed=4)
+    # self.engine holds the same users unsharded; Session only reads it inside _unsharded.
+    bind_session = False
+
+    def setUp(self):
+        super().setUp()
+        self.url = f"sqlite:///{os.path.join(self.directory.name, 'sharded.db')}"
+        self.original_shards = (shards.url, shards.count)
+        shards.configure(self.url, 3)
+        for shard_engine in shards.engines:
+            Base.metadata.create_all(shard_engine)
+        bulk_load(**self.bulk_load_args)
+
+    def tearDown(self):
+        shards.configure(*self.original_shards)
+        super().tearDown()
+
+    def _unsharded(self, function, *args):
+        """Runs `function` against the unsharded copy of the same data."""
+        shards.configure(self.url, 1)
+        Session.configure(bind=self.engine)
+        result_cache.clear()
+        try:
+            return function(*args)
+        finally:
+            shards.configure(self.url, 3)
+            Session.configure(bind=engine)
+            result_cache.clear()
+
+    def test_users_are_routed_to_one_shard(self):
+        """Test that every user's rows live on one shard and per-user queries only touch that shard."""
+        for index, shard_engine in enumerate(shards.engines):
+            with shard_engine.connect() as connection:
+                user_ids = {row.user_id for row in connection.execute(select(Workout.__table__.c.user_id))}
+            self.assertEqual(user_ids, {user_id for user_id in range(1, 10) if user_id % 3 == index})
+        statements = [0, 0, 0]
+        for index, shard_engine in enumerate(shards.engines):
+            event.listen(shard_engine, 'before_cursor_execute',
+                         lambda *args, index=index: statements.__setitem__(index, statements[index] + 1))
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            sharded = [get_user_dashboard(4), analyze_health_metric_trends(4)]
+        self.assertEqual(statements, [0, 2, 0])
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            self.assertEqual(self._unsharded(lambda: [get_user_dashboard(4), analyze_health_metric_trends(4)]), sharded)
+
+    def test_new_users_are_created_on_their_shard(self):
+        """Test that users added through the ORM get ids routing to the shard they are written to."""
+        profile = dict(age=30, gender='Other', height=170, weight=70, goal='Improve Fitness')
+        user_ids = [shards.allocate_user_id() for _ in range(4)]
+        self.assertEqual(len(set(user_ids)), 4)
+        self.assertGreater(min(user_ids), 9)
+        self.assertEqual({shards.shard_for(user_id) for user_id in user_ids[:3]}, {0, 1, 2})
+        for user_id in user_ids:
+            with session_scope(user_id) as session:
+                session.add(User(user_id=user_id, name=f'Sharded {user_id}', **profile))
+                session.add(Workout(user_id=user_id, date=datetime.now(), type='Running', duration=30, intensity='Low'))
+        for user_id in user_ids:
+            with session_scope(user_id) as session:
+                self.assertEqual(session.get(User, user_id).name, f'Sharded {user_id}')
+            self.assertEqual(len(list(iter_workout_history(user_id))), 1)
+        self.assertEqual(shards.allocate_user_id(), user_ids[1] + 3)
+        with self.assertRaises(ValueError):
+            with session_scope() as session:
+                session.add(User(name='Unrouted', **profile))
+        with self.assertRaises(ValueError):
+            with session_scope(user_ids[0]) as session:
+                session.add(User(name='Autoincremented', **profile))
+
+    def test_profiler_sees_shard_statements(self):
+        """Test that the default profiler records statements run on the shard engines."""
+        result_cache.clear()
+        _, profiler = profile_call(get_user_dashboard, 4)
+        self.assertEqual({caller for entry in profiler.stats() for caller in entry['callers']},
+                         {'query_data.get_user_dashboard'})
+        with profile() as profiler:
+            with session_scope(5) as session:
+                users = session.query(User).all()
+                sum(len(user.workouts) for user in users)
+        self.assertEqual(len(users), 3)
+        self.assertEqual(profiler.n_plus_one()[0]['calls'], 3)
+
+    def test_scatter_gather_matches_unsharded(self):
+        """Test that cross-user work fanned out over the shards equals the same work on one database."""
+        self.assertEqual(get_batch_recommendations(), self._unsharded(get_batch_recommendations))
+        self.assertEqual(get_batch_recommendations([2, 3, 8], processes=1),
+                         self._unsharded(get_batch_recommendations, [2, 3, 8]))
+        candidates = find_hypertension_candidates(365, 100)
+        self.assertEqual(sorted(map(tuple, candidates)),
+                         sorted(map(tuple, self._unsharded(find_hypertension_candidates, 365, 100))))
+        self.assertEqual([row.average_systolic for row in candidates],
+                         sorted((row.average_systolic for row in candidates), reverse=True))
+        trends, expected = health_metric_trends('weight'), self._unsharded(health_metric_trends, 'weight')
+        for key in expected:
+            np.testing.assert_allclose(trends[key], expected[key])
+
+    def test_split_database(self):
+        """Test that splitting an unsharded database reproduces the shards the loader wrote."""
+        split_url = f"sqlite:///{os.path.join(self.directory.name, 'split.db')}"
+        self.assertEqual(split_database(self.engine.url.database, split_url, 3), [3, 3, 3])
+        for index, shard_engine in enumerate(shards.engines):
+            split_engine = create_engine(shard_url(split_url, index))
+            try:
+                for table in Base.metadata.sorted_tables:
+                    # Names come from an unseeded Faker pool, and log ids (and references to them) are only unique
+                    # within a shard.
+                    log_id = next(iter(table.primary_key)) if table.name not in ('Users', 'Daily_User_Summary') else None
+                    columns = [column for column in table.columns if column.name not in ('name', 'metric_id', 'last_metric_id')
+                               and column is not log_id]
+                    rows = []
+                    for bind in (shard_engine, split_engine):
+                        with bind.connect() as connection:
+                            rows.append(sorted(connection.execute(select(*columns)).fetchall()))
+                    self.assertEqual(rows[0], rows[1])
+            finally:
+                split_engine.dispose()
+
+class TestImporter(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=3, workouts=0, nutrition_logs=0, sleep_records=0, health_metrics=0, seed=2)
+
+    def _write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as export:
+            export.write(text)
+        return path
+
+    def test_csv_import_is_idempotent(self):
+        """Test that a CSV export is validated, deduplicated on its natural key and safe to import twice."""
+        path = self._write('workouts.csv', "user_id,date,type,duration,intensity\n"
+                                           "1,2024-03-01,Cardio,30,High\n"
+                                           "1,2024-03-01,Cardio,45,High\n"     # same natural key
+                                           "2,2024-03-01,Balance,30,Low\n"
+                                           "2,2024-03-02,Strength,thirty,Low\n"
+                                           "3,2024-03-02,Yoga,40,Low\n"        # free-form type
+                                           "3,2024-03-03,Strength,40,Extreme\n"
+                                           "3,,Strength,40,Low\n"
+                                           "9,2024-03-02,Strength,40,Low\n")    # no such user
+        report = import_file(path, 'workouts', batch_size=2, bind=self.engine)
+        self.assertEqual((report.read, report.inserted, report.duplicates, report.rejected), (8, 3, 1, 4))
+        self.assertEqual(report.rejected_by_field, {'duration': 1, 'intensity': 1, 'date': 1, 'user_id': 1})
+        self.assertEqual(report.examples[0], (5, "duration: 'thirty' is not an integer"))
+        again = import_file(path, 'workouts', bind=self.engine)
+        self.assertEqual((again.inserted, again.duplicates), (0, 4))
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(select(func.count()).select_from(Workout.__table__)).scalar(), 3)
+            self.assertEqual(connection.execute(select(Workout.type).where(Workout.user_id == 3)).scalar(), 'Yoga')
+            self.assertEqual(connection.execute(select(DailyUserSummary.workout_minutes).where(
+                DailyUserSummary.user_id == 1)).scalar(), 30)
+
+    def test_choices_follow_the_table_constraints(self):
+        """Test that listed values are only enforced where the table enforces them too."""
+        self.assertIsNone(_allowed_choices(Workout.__table__.c.type))
+        self.assertIsNone(_allowed_choices(Column('label', String, info={'choices': ('a', 'b')})))
+        self.assertEqual(_allowed_choices(Workout.__table__.c.intensity), INTENSITIES)
+        self.assertEqual(_allowed_choices(Nutrition.__table__.c.type), MEAL_TYPES)
+
+    def test_ndjson_timestamps_and_blood_pressure(self):
+        """Test that timestamped NDJSON records are keyed by timestamp and derive the numeric blood pressure."""
+        records = [
+            {'user_id': 1, 'timestamp': '2024-03-01T07:00:00Z', 'weight': 70.5, 'bmi': 22.1, 'blood_pressure': '128/84'},
+            {'user_id': 1, 'timestamp': '2024-03-01T19:00:00Z', 'weight': 70.1, 'bmi': 22.0, 'heart_rate': 64},
+            {'user_id': 1, 'timestamp': '2024-03-01T19:00:00Z', 'weight': 70.1, 'bmi': 22.0},
+            {'user_id': 2, 'date': '2024-03-02', 'weight': 80, 'bmi': 'n/a'},
+        ]
+        path = self._write('metrics.ndjson', "\n".join(map(json.dumps, records)) + "\n{not json\n")
+        report = import_file(path, 'health_metrics', bind=self.engine)
+        self.assertEqual((report.inserted, report.duplicates, report.rejected), (2, 1, 2))
+        self.assertEqual(report.rejected_by_field, {'bmi': 1, 'record': 1})
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(HealthMetrics.date, HealthMetrics.systolic, HealthMetrics.heart_rate)
+                                      .order_by(HealthMetrics.metric_id)).fetchall()
+        self.assertEqual(rows, [(date(2024, 3, 1), 128, None), (date(2024, 3, 1), None, 64)])
+        older = self._write('older.ndjson', json.dumps({'user_id': 1, 'date': '2024-02-01', 'weight': 71.0, 'bmi': 22.3}) + "\n")
+        self.assertEqual(import_file(older, 'health_metrics', bind=self.engine).inserted, 1)
+        with self.engine.connect() as connection:
+            state = connection.execute(UserMetricState.__table__.select().where(UserMetricState.user_id == 1)).one()
+        self.assertEqual((state.weight_readings, state.last_weight, state.last_date, state.stale),
+                         (3, 70.1, date(2024, 3, 1), False))
+
+class TestStoredRecommendations(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=6, workouts=60, nutrition_logs=60, sleep_records=0, health_metrics=0, seed=7)
+
+    def _stored(self):
+        with self.engine.connect() as connection:
+            return {row.user_id: row for row in connection.execute(UserRecommendation.__table__.select())}
+
+    def test_refresh_recomputes_only_changed_users(self):
+        """Test that the refresh job stores the batch advice and afterwards recomputes only users with new logs."""
+        self.assertEqual(refresh_recommendations(batch_size=4), 6)
+        expected = get_batch_recommendations()
+        stored = self._stored()
+        self.assertEqual({user_id: {'fitness': row.fitness, 'nutrition': row.nutrition} for user_id, row in stored.items()},
+                         expected)
+        self.assertEqual(refresh_recommendations(), 0)
+        with session_scope(2) as session:
+            session.add(Nutrition(user_id=2, date=datetime.now(), type='Snack', calories=9000, protein=1.0, carbs=1.0,
+                                  fats=1.0))
+        self.assertGreater(self._stored()[2].data_version, stored[2].computed_version)
+        self.assertEqual(refresh_recommendations(), 1)
+        refreshed = self._stored()[2]
+        self.assertEqual(refreshed.computed_version, refreshed.data_version)
+        self.assertEqual(refreshed.nutrition, get_batch_recommendations([2])[2]['nutrition'])
+        self.assertEqual(refresh_recommendations(today=date.today() + timedelta(days=1)), 6)
+
+    def test_read_path_serves_current_stored_value(self):
+        """Test that the per-user functions serve a current stored row and fall back to the logs once it is stale."""
+        refresh_recommendations()
+        with self.engine.begin() as connection:
+            connection.execute(UserRecommendation.__table__.update().where(UserRecommendation.user_id == 3)
+                               .values(fitness='stored fitness', nutrition='stored nutrition'))
+        self.assertEqual((get_fitness_recommendations(3), get_nutrition_recommendations(3)),
+                         ('stored fitness', 'stored nutrition'))
+        with session_scope(3) as session:
+            session.add(Workout(user_id=3, date=datetime.now(), type='Cardio', duration=30, intensity='High'))
+        self.assertEqual(get_fitness_recommendations(3), get_batch_recommendations([3])[3]['fitness'])
+
+class TestSnapshot(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=5, workouts=30, nutrition_logs=30, sleep_records=30, health_metrics=10, seed=9)
+
+    def _results(self):
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            return (get_batch_recommendations(), [get_average_daily_calories(user_id, 30) for user_id in range(1, 6)],
+                    get_user_dashboard(2))
+
+    def test_snapshot_serves_queries_until_refreshed(self):
+        """Test that queries give the file's results on the snapshot, ignore later writes until a refresh, and never fail during one."""
+        expected = self._results()
+        snapshot = start_snapshot_worker()
+        try:
+            self.assertIs(Session.kw['bind'], snapshot.engine)
+            self.assertEqual(self._results(), expected)
+            with self.engine.begin() as connection:
+                connection.execute(Nutrition.__table__.insert().values(
+                    user_id=1, date=date.today(), type='Snack', calories=9000, protein=1.0, carbs=1.0, fats=1.0))
+            result_cache.clear()
+            self.assertEqual(get_average_daily_calories(1, 30), expected[1][0])
+            errors, stop = [], threading.Event()
+
+            def read():
+                while not stop.is_set():
+                    try:
+                        with session_scope() as session:
+                            session.execute(select(func.count()).select_from(Nutrition.__table__)).scalar()
+                    except Exception as error:
+                        errors.append(error)
+            reader = threading.Thread(target=read)
+            reader.start()
+            for _ in range(3):
+                snapshot.refresh()
+            stop.set()
+            reader.join()
+            self.assertEqual(errors, [])
+            self.assertGreater(get_average_daily_calories(1, 30), expected[1][0])
+        finally:
+            snapshot.close()
+        self.assertIs(Session.kw['bind'], self.engine)
+
+    def test_async_queries_read_the_source_file_during_a_snapshot(self):
+        """Test that the async dashboard runs while a snapshot is active and reads the snapshot's source file."""
+        async def dashboard():
+            try:
+                return await async_queries.get_dashboard(2)
+            finally:
+                await async_queries.dispose_async_engines()
+        expected = asyncio.run(dashboard())
+        snapshot = start_snapshot_worker()
+        try:
+            result_cache.clear()
+            self.assertEqual(asyncio.run(dashboard()), expected)
+        finally:
+            snapshot.close()
+
+class TestCohorts(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=60, workouts=20, nutrition_logs=40, sleep_records=20, health_metrics=20, seed=4)
+
+    def test_sketch_quantiles_merge_within_relative_accuracy(self):
+        """Test that merged sketches estimate every quantile within their relative accuracy."""
+        values = np.random.default_rng(0).lognormal(3, 1, 20000)
+        sketch = QuantileSketch(0.02).add(values[:7000]).merge(QuantileSketch(0.02).add(values[7000:]))
+        self.assertEqual(sketch.count, len(values))
+        qs = np.linspace(0, 1, 41)
+        exact = np.quantile(values, qs, method='lower')
+        self.assertLessEqual(np.max(np.abs(sketch.quantiles(qs) - exact) / exact), 0.02)
+        self.assertAlmostEqual(sketch.percentile_rank(np.median(values)), 50, delta=1)
+        with self.assertRaises(ValueError):
+            sketch.merge(QuantileSketch(0.01))
+
+    def test_exact_and_sketch_cohorts_agree(self):
+        """Test that both modes see the same cohorts and that a user's percentile is ranked within their cohort."""
+        exact = cohort_percentiles('calories', percentiles=(0, 50, 100), by=('gender',))
+        sketch = cohort_percentiles('calories', percentiles=(0, 50, 100), by=('gender',), mode='sketch')
+        self.assertEqual({key: cohort['users'] for key, cohort in exact.items()},
+                         {key: cohort['users'] for key, cohort in sketch.items()})
+        self.assertLessEqual(sum(cohort['users'] for cohort in exact.values()), 60)
+        for key, cohort in exact.items():
+            for p in (0, 100):
+                self.assertAlmostEqual(sketch[key]['percentiles'][p], cohort['percentiles'][p],
+                                       delta=cohort['percentiles'][p] * 0.01)
+        ranked = user_percentile(1, 'calories', by=('gender',))
+        self.assertEqual(ranked['users'], exact[ranked['cohort']]['users'])
+        self.assertTrue(0 < ranked['percentile'] < 100)
+        estimated = user_percentile(1, 'calories', by=('gender',), mode='sketch',
+                                    sketches=build_cohort_sketches('calories', by=('gender',)))
+        self.assertAlmostEqual(estimated['percentile'], ranked['percentile'], delta=100 / ranked['users'])
+
+class TestMetricState(TempDatabaseTestCase):
+
+    bulk_load_args = dict(n_users=8, workouts=0, nutrition_logs=0, sleep_records=0, health_metrics=30, seed=5)
+
+    def _tables(self):
+        with self.engine.connect() as connection:
+            return (connection.execute(UserMetricState.__table__.select().order_by(UserMetricState.user_id)).fetchall(),
+                    connection.execute(select(HealthMetricAlert.metric_id, HealthMetricAlert.metric, HealthMetricAlert.value,
+                                              HealthMetricAlert.average, HealthMetricAlert.variance)
+                                       .order_by(HealthMetricAlert.metric_id, HealthMetricAlert.metric)).fetchall())
+
+    def test_heart_rate_spike_raises_alert(self):
+        """Test that a resting heart-rate spike is flagged on insert and the trend reflects every reading."""
+        user = User(name='Steady Pulse', age=40, gender='Other', height=170, weight=70, goal='Improve Fitness')
+        with session_scope() as session:
+            session.add(user)
+            session.flush()
+            user_id = user.user_id
+            for day in range(ALERT_MIN_READINGS + 2):
+                session.add(HealthMetrics(user_id=user_id, date=date.today() - timedelta(days=20 - day), weight=70.0,
+                                          bmi=24.2, heart_rate=60 + day % 3, blood_pressure='120/80'))
+        self.assertEqual(get_health_metric_alerts(user_id), [])
+        with session_scope(user_id) as session:
+            session.add(HealthMetrics(user_id=user_id, date=date.today(), weight=70.4, bmi=24.4, heart_rate=92,
+                                      blood_pressure='125/82'))
+        alert, = get_health_metric_alerts(user_id)
+        self.assertEqual((alert.metric, alert.value, alert.date), ('heart_rate', 92, date.today()))
+        self.assertGreater(alert.sigmas, 3)
+        self.assertIn(alert, find_health_alerts(days=1, metric='heart_rate'))
+        trend = get_health_metric_trend(user_id, 'heart_rate')
+        self.assertEqual((trend.readings, trend.last), (ALERT_MIN_READINGS + 3, 92))
+        self.assertTrue(61 < trend.average < 92)
+        self.assertEqual(get_health_metric_trend(1, 'weight').readings, len(_metric_history(1, 'weight')))
+
+    def test_rebuild_replays_trigger_state(self):
+        """Test that replaying the history reproduces the state and alerts the insert trigger maintained."""
+        with session_scope(2) as session:
+            session.add(HealthMetrics(user_id=2, date=date.today(), weight=150.0, bmi=45.0, heart_rate=140,
+                                      blood_pressure='150/95'))
+        maintained = self._tables()
+        self.assertTrue(maintained[1])
+        self.assertEqual(rebuild_metric_states(self.engine), 8)
+        rebuilt = self._tables()
+        self.assertEqual((len(rebuilt[0]), len(rebuilt[1])), (len(maintained[0]), len(maintained[1])))
+        for expected, actual in zip(maintained[0] + maintained[1], rebuilt[0] + rebuilt[1]):
+            for expected_value, actual_value in zip(expected, actual):
+                if isinstance(expected_value, float):
+                    self.assertAlmostEqual(expected_value, actual_value)
+                else:
+                    self.assertEqual(expected_value, actual_value)
+
+    def _stale_users(self):
+        with self.engine.connect() as connection:
+            return {row.user_id for row in connection.execute(
+                select(UserMetricState.user_id).where(UserMetricState.stale))}
+
+    def test_out_of_order_writes_mark_state_stale(self):
+        """Test that late, edited and deleted readings mark the state stale and readers replay it until refreshed."""
+        compact(self.engine)
+        self.assertEqual(self._stale_users(), set())
+        trends = [get_health_metric_trend(3, 'weight'), get_health_metric_trend(5, 'weight')]
+        with session_scope(3) as session:
+            session.add(HealthMetrics(user_id=3, date=date.today() - timedelta(days=400), weight=150.0, bmi=45.0,
+                                      heart_rate=140, blood_pressure='150/95'))
+        with self.engine.begin() as connection:
+            table = HealthMetrics.__table__
+            connection.execute(table.update().where(table.c.user_id == 4).values(weight=table.c.weight + 1))
+            connection.execute(table.delete().where(table.c.user_id == 5))
+            connection.execute(table.update().where(table.c.user_id == 6).values(systolic=None))
+        self.assertEqual(self._stale_users(), {3, 4, 5})
+        replayed = [get_health_metric_trend(3, 'weight'), get_health_metric_alerts(3, days=3650),
+                    get_health_metric_trend(4, 'weight'), get_health_metric_trend(5, 'weight')]
+        self.assertEqual(replayed[0].readings, trends[0].readings + 1)
+        # The delete only reached the hot table; user 5's archived readings remain.
+        self.assertLess(replayed[3].readings, trends[1].readings)
+        self.assertEqual(rebuild_metric_states(self.engine, stale_only=True), 3)
+        self.assertEqual(self._stale_users(), set())
+        refreshed = [get_health_metric_trend(3, 'weight'), get_health_metric_alerts(3, days=3650),
+                     get_health_metric_trend(4, 'weight'), get_health_metric_trend(5, 'weight')]
+        self.assertEqual(refreshed, replayed)
+        tables = self._tables()
+        rebuild_metric_states(self.engine)
+        self.assertEqual(self._tables(), tables)
+
+class TestCommandLine(unittest.TestCase):
+    def test_help_loads_no_heavy_modules(self):
+        """Test that `cli.py --help` loads no heavy module and that importing insert_data does not load Faker."""
+        script = ("import sys, cli\n"
+                  "try:\n    cli.main(['--help'])\nexcept SystemExit as exit:\n    assert exit.code == 0\n"
+                  "print(sorted(m for m in ('sqlalchemy', 'numpy', 'faker') if m in sys.modules))\n"
+                  "import insert_data\n"
+                  "print('faker' in sys.modules)\n")
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.splitlines()[-2:], ['[]', 'False'])
+
+    def test_recommend_prints_stored_recommendations(self):
+        """Test that `cli.py recommend` prints the same advice as the recommendation functions."""
+        output = StringIO()
+        with redirect_stdout(output):
+            cli.main(['recommend', '1'])
+        self.assertEqual(output.getvalue().splitlines(), [f"User 1 fitness: {get_fitness_recommendations(1)}",
+                                                          f"User 1 nutrition: {get_nutrition_recommendations(1)}"])
+        with self.assertRaises(SystemExit) as exit, redirect_stderr(StringIO()):
+            cli.main(['query', '1', '--unknown'])
+        self.assertEqual(exit.exception.code, 2)
+
+class TestQueryPlans(unittest.TestCase):
+    """Runs EXPLAIN QUERY PLAN on every statement a query function issues and fails on full scans of fact tables."""
+
+    TABLE_SCAN = re.compile(r"^SCAN (Workouts|Nutrition|Sleep|Health_Metrics|Daily_User_Summary)\b")
+
+    @classmethod
+    def setUpClass(cls):
+        migrate(engine)
+
+    def capture_selects(self, function, *args):
+        result_cache.clear()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            function(*args)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        return statements
+
+    def test_no_table_scans(self):
+        """Test that every query and recommendation function is served by an index."""
+        functions = [
+            (get_user_workout_history, 1, 30),
+            (get_average_daily_calories, 1, 7),
+            (analyze_sleep_quality, 1, 30),
+            (correlate_nutrition_and_workout, 1),
+            (analyze_health_metric_trends, 1, 'weight'),
+            (get_fitness_recommendations, 1),
+            (get_nutrition_recommendations, 1),
+            (get_workout_history_page, 1, encode_cursor(date.today(), 10 ** 9)),
+            (get_health_metric_page, 1, 'weight', encode_cursor(date.today(), 10 ** 9)),
+            (get_blood_pressure_summary, 1, 30),
+            (find_hypertension_candidates, 30, 135),
+            (get_user_dashboard, 1),
+        ]
+        with engine.connect() as connection:
+            for function, *args in functions:
+                with self.subTest(function=function.__name__):
+                    statements = self.capture_selects(function, *args)
+                    self.assertTrue(statements)
+                    for statement, parameters in statements:
+                        plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                        scans = [row[-1] for row in plan if self.TABLE_SCAN.match(row[-1])]
+                        self.assertEqual(scans, [], f"{function.__name__} scans a table:\n{statement}")
+
 if __name__ == '__main__':
     unittest.main()